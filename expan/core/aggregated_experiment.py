@@ -0,0 +1,466 @@
+"""Experiments given by the sufficient statistics of their kpis instead of the data of their entities.
+"""
+
+import importlib
+import re
+import warnings
+
+import numpy as np
+import pandas as pd
+
+import expan.core.statistics as statx
+from expan.core.binning import Bin, assign_bins
+from expan.core.util import get_column_names_by_type
+from expan.core.version import __version__
+
+kpi_name_pattern = '([a-zA-Z][0-9a-zA-Z_]*)'
+
+
+def summary_columns(data, report_kpi_names, reference_kpis):
+    """
+    Columns of the entities whose sufficient statistics summarise the kpis.
+
+    The weights of a derived kpi (see Experiment) are constant within a variant and subgroup but for its
+    reference kpi, so that its statistics follow from those of kpi * reference and the number of non-zeros
+    and the sum of the reference kpi.
+
+    Args:
+        data (DataFrame): data of the entities, including the derived kpis
+        report_kpi_names (iterable): names of the kpis to summarise
+        reference_kpis (dict): name of the reference kpi of every derived kpi
+
+    Returns:
+        dict: summary column name to values, 'rows' counts the entities
+    """
+    columns = {'rows': np.ones(len(data))}
+    for kpi in report_kpi_names:
+        values = np.asarray(data[kpi], dtype=float)
+        if kpi in reference_kpis:
+            reference = np.asarray(data[reference_kpis[kpi]], dtype=float)
+            values = values * reference
+            columns['non_zeros ' + kpi] = ((reference != 0) & ~np.isnan(reference)).astype(float)
+            columns['reference ' + kpi] = reference
+        columns['kpi ' + kpi] = values
+    return columns
+
+
+def grouped_statistics(columns, keys):
+    """
+    Sufficient statistics of columns per group, computed in a single grouped reduction.
+
+    Args:
+        columns (dict): column name to values
+        keys (array_like): group of every row, or a list of such arrays for a hierarchical index
+
+    Returns:
+        tuple: data frames of the sample size, mean and sum of squared deviations per group (index)
+            and column, nans ignored
+    """
+    aggregated = pd.DataFrame(columns).groupby(keys).agg(['count', 'mean', 'var'])
+    n = aggregated.xs('count', axis=1, level=1)
+    mean = aggregated.xs('mean', axis=1, level=1).fillna(0.)
+    # the sample variance of a single value is nan, its sum of squared deviations 0
+    m2 = (aggregated.xs('var', axis=1, level=1) * (n - 1)).fillna(0.)
+    return n, mean, m2
+
+
+def merge_grouped_statistics(statistics, other):
+    """
+    Combines the grouped statistics of disjoint data, e.g. of chunks of a file, group by group.
+
+    Args:
+        statistics (tuple): grouped statistics as returned by grouped_statistics, or None
+        other (tuple): grouped statistics of other data with the same columns
+
+    Returns:
+        tuple: grouped statistics of both data
+    """
+    if statistics is None:
+        return other
+    index = statistics[0].index.union(other[0].index)
+    columns = statistics[0].columns
+    first = [frame.reindex(index=index, columns=columns).fillna(0) for frame in statistics]
+    second = [frame.reindex(index=index, columns=columns).fillna(0) for frame in other]
+    n, mean, m2 = statx.merge_sufficient_statistics(first, second)
+    return n.astype(np.int64), mean, m2
+
+
+def summary_table_statistics(table, keys):
+    """
+    Grouped statistics of the summary columns from a summary table of counts, sums and sums of squares.
+
+    Args:
+        table (DataFrame): one row per group and kpi with the columns of keys, 'kpi', 'count', 'sum',
+            'sum_squares' and optionally 'entities', the number of entities of the group (by default the
+            largest count of any kpi of the group)
+        keys (list): names of the columns identifying a group
+
+    Returns:
+        tuple: data frames of the sample size, mean and sum of squared deviations per group (index)
+            and summary column, like grouped_statistics
+    """
+    for column in keys + ['kpi', 'count', 'sum', 'sum_squares']:
+        if column not in table:
+            raise ValueError('No column %s provided' % column)
+    if table.duplicated(keys + ['kpi']).any():
+        raise ValueError('Every kpi needs a single row per group')
+
+    index = keys[0] if len(keys) == 1 else keys
+    wide = table.pivot_table(index=index, columns='kpi', values=['count', 'sum', 'sum_squares'], aggfunc='sum')
+    n = wide['count'].fillna(0)
+    total = wide['sum'].fillna(0.)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        mean = (total / n).where(n > 0, 0.)
+        # loses precision if the mean is large compared to the standard deviation
+        m2 = (wide['sum_squares'].fillna(0.) - total * mean).clip(lower=0.)
+
+    if 'entities' in table:
+        rows = table.groupby(index)['entities'].max().reindex(n.index).fillna(0)
+    else:
+        rows = n.max(axis=1)
+    n, mean, m2 = [frame.rename(columns=lambda kpi: 'kpi ' + str(kpi)) for frame in (n, mean, m2)]
+    n['rows'], mean['rows'], m2['rows'] = rows, 1., 0.
+    return n.astype(np.int64), mean, m2
+
+
+def kpi_statistics(statistics, kpi, reference_kpis):
+    """
+    Sufficient statistics of a kpi from the grouped statistics of the summary columns.
+
+    Args:
+        statistics (tuple): grouped statistics of the summary columns
+        kpi (str): name of the kpi
+        reference_kpis (dict): name of the reference kpi of every derived kpi
+
+    Returns:
+        tuple: series of the sample size, mean, sum of squared deviations and number of nans per group
+    """
+    n, mean, m2 = statistics
+    column = 'kpi ' + kpi
+    kpi_n, kpi_mean, kpi_m2 = n[column], mean[column], m2[column]
+    if kpi in reference_kpis:
+        non_zeros = mean['non_zeros ' + kpi] * n['non_zeros ' + kpi]
+        reference_sum = mean['reference ' + kpi] * n['reference ' + kpi]
+        weight = non_zeros / reference_sum
+        kpi_mean, kpi_m2 = kpi_mean * weight, kpi_m2 * weight ** 2
+    return kpi_n, kpi_mean, kpi_m2, n['rows'] - kpi_n
+
+
+def segment_cells(data, features, feature_bins):
+    """
+    Labels entities with the cell of their bins of crossed features.
+
+    Args:
+        data (DataFrame): data of the entities
+        features (tuple): names of the features
+        feature_bins (list): a list of Bin objects or a BinSet per feature
+
+    Returns:
+        tuple: boolean array of the entities that are in a bin of every feature, and the cell of these
+            entities as raveled index of their bins
+    """
+    labels = np.array([assign_bins(data, feature, bins) for feature, bins in zip(features, feature_bins)])
+    binned = (labels >= 0).all(axis=0)
+    cells = np.ravel_multi_index(tuple(labels[:, binned]), tuple(len(bins) for bins in feature_bins))
+    return binned, cells
+
+
+def subgroup_validity(sample_sizes, min_observations):
+    """
+    Check whether a subgroup has enough entities of every variant to perform analysis.
+
+    Args:
+        sample_sizes (dict): variant name to the number of entities of the subgroup in this variant
+        min_observations (int): minimum number of entities of every variant
+
+    Returns:
+        dict: whether the subgroup is valid, its sample sizes and the reason if it is not valid
+    """
+    too_small = sorted(str(variant) for variant in sample_sizes if sample_sizes[variant] < min_observations)
+    if sum(sample_sizes.values()) == 0:
+        reason = 'no data'
+    elif too_small:
+        reason = 'less than {} entities in variants: {}'.format(min_observations, ', '.join(too_small))
+    else:
+        reason = None
+    return {'valid': reason is None,
+            'sample_sizes': dict((variant, int(n)) for variant, n in sample_sizes.items()),
+            'reason': reason}
+
+
+class AggregatedExperiment(object):
+    """
+    Experiment given by the sufficient statistics of its kpis per variant instead of the data of its entities,
+    e.g. accumulated chunk by chunk from data that does not fit into memory.
+
+    It supports the methods based on the normal distribution, 'fixed_horizon' and 'group_sequential',
+    and the subgroup analysis of the segments its statistics were aggregated for.
+    """
+    def __init__(self, control_variant_name, statistics, metadata, report_kpi_names, reference_kpis=None,
+                 segments=None, row_loader=None):
+        """
+        Args:
+            control_variant_name (str): name of the control variant
+            statistics (tuple): data frames of the sample size, mean and sum of squared deviations per variant
+                (index) and summary column (see summary_columns)
+            metadata (dict): metadata of the experiment
+            report_kpi_names (iterable): names of the kpis to analyse
+            reference_kpis (dict): name of the reference kpi of every derived kpi
+            segments (dict): dimension, i.e. a feature name or a tuple of crossed feature names, to a tuple of
+                the bins per feature and the statistics per cell and variant (hierarchical index); the cells
+                are the raveled indices of the bins
+            row_loader (callable): function without arguments returning the Experiment of the entities, e.g.
+                from their rows in a database; delta falls back to it for methods needing the samples
+        """
+        self.statistics           = statistics
+        self.metadata             = dict(metadata or {})
+        self.report_kpi_names     = set(report_kpi_names)
+        self.reference_kpis       = reference_kpis or {}
+        self.segments             = segments or {}
+        self.variant_names        = set(statistics[0].index)
+        self.control_variant_name = control_variant_name
+        self.row_loader           = row_loader
+        self._experiment          = None
+
+    @classmethod
+    def from_chunks(cls, control_variant_name, chunks, metadata, report_kpi_names=None, derived_kpis=None,
+                    feature_name_to_bins=None):
+        """
+        Accumulates the statistics of an experiment from chunks of its data, e.g. from
+        pd.read_csv(..., chunksize=...), holding no more than a chunk in memory.
+
+        Args:
+            control_variant_name (str): name of the control variant
+            chunks (iterable): data frames with the columns entity, variant and the kpis;
+                entities need to be unique within every chunk
+            metadata (dict): metadata of the experiment
+            report_kpi_names (list): names of the kpis to analyse, by default all numerical columns
+            derived_kpis (list): derived kpis as for Experiment
+            feature_name_to_bins (dict): bins of features as for Experiment.sga, whose statistics are
+                accumulated per segment for sga
+
+        Returns:
+            AggregatedExperiment: the accumulated experiment
+        """
+        derived_kpis = derived_kpis or []
+        feature_name_to_bins = feature_name_to_bins or {}
+        reference_kpis = dict((kpi['name'], re.sub(kpi_name_pattern + '/', '', kpi['formula']))
+                              for kpi in derived_kpis)
+
+        statistics = None
+        segment_statistics = dict((dimension, None) for dimension in feature_name_to_bins)
+        for chunk in chunks:
+            if chunk.entity.duplicated().any():
+                raise ValueError('Entities in data should be unique')
+            if report_kpi_names is None:
+                report_kpi_names = [column for column in get_column_names_by_type(chunk, np.number)
+                                    if column not in ('entity', 'variant')]
+            if derived_kpis:
+                chunk = chunk.copy()
+                for kpi in derived_kpis:
+                    chunk[kpi['name']] = eval(re.sub(kpi_name_pattern, r'chunk.\1.astype(float)', kpi['formula']))
+
+            columns = summary_columns(chunk, report_kpi_names, reference_kpis)
+            variants = chunk.variant.values
+            statistics = merge_grouped_statistics(statistics, grouped_statistics(columns, variants))
+
+            for dimension in feature_name_to_bins:
+                features, feature_bins = _dimension_bins(dimension, feature_name_to_bins[dimension])
+                binned, cells = segment_cells(chunk, features, feature_bins)
+                cell_columns = dict((name, values[binned]) for name, values in columns.items())
+                segment_statistics[dimension] = merge_grouped_statistics(
+                    segment_statistics[dimension], grouped_statistics(cell_columns, [cells, variants[binned]]))
+
+        if statistics is None:
+            raise ValueError('Empty input data!')
+
+        segments = dict((dimension, (_dimension_bins(dimension, feature_name_to_bins[dimension])[1],
+                                     segment_statistics[dimension]))
+                        for dimension in feature_name_to_bins)
+        return cls(control_variant_name, statistics, metadata, report_kpi_names, reference_kpis, segments)
+
+    @classmethod
+    def from_summary_tables(cls, control_variant_name, summary, metadata, segment_summary=None):
+        """
+        Creates an experiment from tables of the count, sum and sum of squares of every kpi per variant,
+        e.g. as produced by an upstream pipeline, instead of the data of its entities.
+
+        Args:
+            control_variant_name (str): name of the control variant
+            summary (DataFrame): columns 'variant', 'kpi', 'count', 'sum', 'sum_squares' and optionally
+                'entities', see summary_table_statistics
+            metadata (dict): metadata of the experiment
+            segment_summary (DataFrame): the same columns and 'dimension' and 'segment' for the statistics of
+                pre-binned segments, e.g. dimension 'country' and segment 'DE', analysed by sga
+
+        Returns:
+            AggregatedExperiment: the experiment of the summary tables
+        """
+        statistics = summary_table_statistics(summary, ['variant'])
+        report_kpi_names = [str(kpi) for kpi in summary['kpi'].unique()]
+
+        segments = {}
+        if segment_summary is not None:
+            for column in ['dimension', 'segment']:
+                if column not in segment_summary:
+                    raise ValueError('No column %s provided' % column)
+            for dimension, dimension_summary in segment_summary.groupby('dimension'):
+                # a segment is a categorical bin of its label, its cell the index of the label
+                labels = sorted(dimension_summary['segment'].unique(), key=str)
+                cells = dimension_summary['segment'].map(dict((label, i) for i, label in enumerate(labels)))
+                segment_statistics = summary_table_statistics(dimension_summary.assign(cell=cells.values),
+                                                              ['cell', 'variant'])
+                segments[dimension] = ([[Bin("categorical", [label]) for label in labels]], segment_statistics)
+
+        return cls(control_variant_name, statistics, metadata, report_kpi_names, segments=segments)
+
+    def merge(self, other):
+        """
+        Combines the statistics of two experiments on disjoint entities, e.g. on shards of the same export.
+
+        Args:
+            other (AggregatedExperiment): experiment with the same report kpis, derived kpis and segments
+
+        Returns:
+            AggregatedExperiment: the experiment of the entities of both
+        """
+        if self.report_kpi_names != other.report_kpi_names or self.reference_kpis != other.reference_kpis:
+            raise ValueError('Only experiments with the same kpis can be merged')
+        if set(self.segments) != set(other.segments):
+            raise ValueError('Only experiments with the same segments can be merged')
+
+        statistics = merge_grouped_statistics(self.statistics, other.statistics)
+        segments = dict((dimension, (bins, merge_grouped_statistics(segment_statistics,
+                                                                    other.segments[dimension][1])))
+                        for dimension, (bins, segment_statistics) in self.segments.items())
+        return AggregatedExperiment(self.control_variant_name, statistics, self.metadata, self.report_kpi_names,
+                                    self.reference_kpis, segments)
+
+    def __str__(self):
+        variants = self.variant_names
+
+        return 'Aggregated experiment "{:s}" with {:d} report kpis, {:d} entities and {:d} variants: {}'.format(
+            self.metadata.get('experiment', ''), len(self.report_kpi_names),
+            int(self.statistics[0]['rows'].sum()), len(variants),
+            ', '.join([('*' + k + '*') if (k == self.control_variant_name) else k for k in variants]))
+
+    def delta(self, method='fixed_horizon', **worker_args):
+        needs_samples = (method not in ('fixed_horizon', 'group_sequential') or
+                         not worker_args.get('assume_normal', True) or worker_args.get('joint', False))
+        if needs_samples and self.row_loader is not None:
+            # loaded once, the rows are only needed for bootstrapping and the Bayesian methods
+            if self._experiment is None:
+                self._experiment = self.row_loader()
+            return self._experiment.delta(method, **worker_args)
+        return self._delta(method, self.statistics, **worker_args)
+
+    def _delta(self, method, statistics, **worker_args):
+        """
+        Args:
+            method: name of the analysis method, 'fixed_horizon' or 'group_sequential'
+            statistics (tuple): statistics of the summary columns per variant
+            worker_args: arguments of the worker of the method
+
+        Returns:
+            dict: statistics per kpi and variant, like Experiment.delta
+        """
+        # workers analysing the sufficient statistics (n, mean, M2) of the samples
+        statistics_worker_table = {
+            'fixed_horizon'    : ('expan.core.statistics',     'make_delta_from_statistics'),
+            'group_sequential' : ('expan.core.early_stopping', 'make_group_sequential_from_statistics')
+        }
+        if not method in statistics_worker_table:
+            raise NotImplementedError
+
+        module_name, factory_name = statistics_worker_table[method]
+        make_worker = getattr(importlib.import_module(module_name), factory_name)
+
+        if 'multi_test_correction' in worker_args:
+            worker_args['num_tests'] = len(self.report_kpi_names)
+
+        worker = make_worker(**worker_args)
+
+        result = {'warnings': [],
+                  'errors': [],
+                  'expan_version': __version__,
+                  'control_variant': self.control_variant_name}
+        kpis = []
+
+        control = self.control_variant_name
+        for kpi in self.report_kpi_names:
+            n, mean, m2, nans = kpi_statistics(statistics, kpi, self.reference_kpis)
+            control_statistics = (int(n[control]), float(mean[control]), float(m2[control]))
+            res_kpi = {'name': kpi,
+                       'variants': []}
+            for variant in self.variant_names:
+                treatment_statistics = (int(n[variant]), float(mean[variant]), float(m2[variant]))
+                with warnings.catch_warnings(record=True) as w:
+                    # like delta on the samples
+                    if method == 'fixed_horizon' and nans[variant] > 0:
+                        warnings.warn('Discarding ' + str(int(nans[variant])) + ' NaN(s) in the x array!')
+                    if method == 'fixed_horizon' and nans[control] > 0:
+                        warnings.warn('Discarding ' + str(int(nans[control])) + ' NaN(s) in the y array!')
+                    variant_statistics = worker(x=treatment_statistics, y=control_statistics)
+                    # add statistical power
+                    power = statx.statistical_power_from_statistics(*(treatment_statistics + control_statistics))
+                    variant_statistics['statistical_power'] = power
+                if len(w):
+                    result['warnings'].append('kpi: {}, variant: {}: {}'.format(kpi, variant, w[-1].message))
+                res_kpi['variants'].append({'name': variant, 'delta_statistics': variant_statistics})
+            kpis.append(res_kpi)
+
+        result['kpis'] = kpis
+        return result
+
+    def sga(self, multi_test_correction=False, min_observations=1, include_invalid=False):
+        """
+        Perform subgroup analysis on the segments the statistics were aggregated for, like Experiment.sga.
+
+        Args:
+            multi_test_correction (boolean): flag of whether the correction for multiple testing is needed.
+            min_observations (int): minimum number of entities of every variant for a subgroup to be analysed.
+            include_invalid (boolean): flag of whether subgroups that are not analysed are reported as well.
+
+        Returns:
+            Analysis results per subgroup.
+        """
+        variants = list(self.variant_names)
+        subgroups = []
+        for dimension in self.segments:
+            feature_bins, statistics = self.segments[dimension]
+            shape = tuple(len(bins) for bins in feature_bins)
+
+            # entities per cell and variant
+            rows = statistics[0]['rows']
+            if len(rows):
+                counts = rows.unstack(level=1).reindex(columns=variants).fillna(0).astype(np.int64)
+            else:
+                counts = pd.DataFrame(columns=variants, dtype=np.int64)
+
+            cells = np.arange(int(np.prod(shape))) if include_invalid else counts.index.values
+            for cell in cells:
+                cell_counts = counts.loc[cell].values if cell in counts.index else np.zeros(len(variants))
+                segment = [str(bins[label].representation)
+                           for bins, label in zip(feature_bins, np.unravel_index(cell, shape))]
+                subgroup = {'dimension': list(dimension) if type(dimension) is tuple else dimension,
+                            'segment': segment if type(dimension) is tuple else segment[0],
+                            'validity': subgroup_validity(dict(zip(variants, cell_counts)), min_observations)}
+
+                if not subgroup['validity']['valid']:
+                    if include_invalid:
+                        subgroups.append(subgroup)
+                    continue
+
+                cell_statistics = tuple(frame.xs(cell, level=0) for frame in statistics)
+                subgroup['result'] = self._delta(method='fixed_horizon', statistics=cell_statistics,
+                                                 multi_test_correction=multi_test_correction)
+                subgroups.append(subgroup)
+
+        return subgroups
+
+
+def _dimension_bins(dimension, bins):
+    """ Names and bins of the features of a dimension of feature_name_to_bins. """
+    if type(dimension) is tuple:
+        return dimension, list(bins)
+    return (dimension,), [bins]
@@ -1,10 +1,12 @@
+import hashlib
+import json
 import logging
+import os
 import warnings
 from heapq import heapify, heappush, heappop
 
 import numpy as np
-
-from expan.core.util import is_number_and_nan
+import pandas as pd
 
 logger = logging.getLogger(__name__)
 
@@ -15,6 +17,7 @@ class Bin(object):
     # see https://stackoverflow.com/a/29690198
     # note that if we only use python3, assertCountEqual in python3 solves this problem
     __hash__ = None
+    __slots__ = ('bin_type', 'representation')
 
     def __init__(self, bin_type, *repr_args):
         """
@@ -40,7 +43,8 @@ class Bin(object):
         return "\nbin: " + str(self.representation)
 
     def __eq__(self, other):
-        return isinstance(other, self.__class__) and self.__dict__ == other.__dict__
+        return isinstance(other, self.__class__) and self.bin_type == other.bin_type and \
+               self.representation == other.representation
 
     def __ne__(self, other):
         return not self.__eq__(other)
@@ -54,12 +58,44 @@ class Bin(object):
         """
         return self.representation.apply_to_data(data, feature)
 
+    def mask(self, data, feature):
+        """
+        Flag the rows of data that belong to the bin.
+        :param data: pandas data frame
+        :param feature: feature name on which this bin is defined
+        :return: boolean array with one entry per row of the data
+        """
+        return self.representation.mask(data, feature)
+
+    def to_dict(self):
+        """
+        :return: JSON serializable form of the bin
+        """
+        result = self.representation.to_dict()
+        result['type'] = self.bin_type
+        return result
+
+    @classmethod
+    def from_dict(cls, state):
+        """
+        :param state: dict as returned by to_dict()
+        :return: the restored Bin object
+        """
+        if state['type'] == "numerical":
+            representation = NumericalRepresentation.from_dict(state)
+            return cls("numerical", representation.lower, representation.upper,
+                       representation.lower_closed, representation.upper_closed)
+        elif state['type'] == "categorical":
+            return cls("categorical", list(CategoricalRepresentation.from_dict(state).categories))
+        raise ValueError("Unknown bin type %s." % state['type'])
+
 
 class NumericalRepresentation(object):
     # this is a necessary hack for the buggy implementation of assertItemsEqual in python2
     # see https://stackoverflow.com/a/29690198
     # note that if we only use python3, assertCountEqual in python3 solves this problem
     __hash__ = None
+    __slots__ = ('lower', 'upper', 'lower_closed', 'upper_closed')
 
     def __init__(self, lower, upper, lower_closed, upper_closed):
         """
@@ -90,7 +126,9 @@ class NumericalRepresentation(object):
         return repr
 
     def __eq__(self, other):
-        return isinstance(other, self.__class__) and self.__dict__ == other.__dict__
+        return isinstance(other, self.__class__) and \
+               _equal_or_nan(self.lower, other.lower) and _equal_or_nan(self.upper, other.upper) and \
+               self.lower_closed == other.lower_closed and self.upper_closed == other.upper_closed
 
     def __ne__(self, other):
         return not self.__eq__(other)
@@ -102,11 +140,20 @@ class NumericalRepresentation(object):
         :param feature: feature name on which this bin is defined
         :return: subset of input dataframe which belongs to this bin
         """
+        return data[self.mask(data, feature)]
+
+    def mask(self, data, feature):
+        """
+        Flag the rows of data that belong to the bin.
+        :param data: pandas data frame
+        :param feature: feature name on which this bin is defined
+        :return: boolean array with one entry per row of the data
+        """
         data_feature_column = data[feature]
 
         # if either bound is nan, only nans exist in the bin.
         if np.isnan(self.lower) or np.isnan(self.upper):
-            return data[np.isnan(data_feature_column)]
+            return np.asarray(np.isnan(data_feature_column))
 
         if self.lower_closed:
             filter_lower = (data_feature_column >= self.lower)
@@ -117,7 +164,25 @@ class NumericalRepresentation(object):
         else:
             filter_upper = (data_feature_column < self.upper)
 
-        return data[filter_lower & filter_upper]
+        return np.asarray(filter_lower & filter_upper)
+
+    def to_dict(self):
+        """
+        :return: JSON serializable form of the representation, nan bounds become None
+        """
+        return {'lower'        : _to_json_value(self.lower),
+                'upper'        : _to_json_value(self.upper),
+                'lower_closed' : bool(self.lower_closed),
+                'upper_closed' : bool(self.upper_closed)}
+
+    @classmethod
+    def from_dict(cls, state):
+        """
+        :param state: dict as returned by to_dict()
+        :return: the restored NumericalRepresentation object
+        """
+        return cls(_from_json_value(state['lower']), _from_json_value(state['upper']),
+                   state['lower_closed'], state['upper_closed'])
 
 
 class CategoricalRepresentation(object):
@@ -125,6 +190,7 @@ class CategoricalRepresentation(object):
     # see https://stackoverflow.com/a/29690198
     # note that if we only use python3, assertCountEqual in python3 solves this problem
     __hash__ = None
+    __slots__ = ('categories',)
 
     def __init__(self, categories):
         """
@@ -142,7 +208,13 @@ class CategoricalRepresentation(object):
         return str(list(self.categories))
 
     def __eq__(self, other):
-        return isinstance(other, self.__class__) and self.__dict__ == other.__dict__
+        if not isinstance(other, self.__class__):
+            return False
+        # nans are equal to each other as categories
+        return set(category for category in self.categories if not _is_nan(category)) == \
+               set(category for category in other.categories if not _is_nan(category)) and \
+               any(_is_nan(category) for category in self.categories) == \
+               any(_is_nan(category) for category in other.categories)
 
     def __ne__(self, other):
         return not self.__eq__(other)
@@ -154,18 +226,442 @@ class CategoricalRepresentation(object):
         :param feature: feature name on which this bin is defined
         :return: subset of input dataframe which belongs to this bin
         """
+        return data[self.mask(data, feature)]
+
+    def mask(self, data, feature):
+        """
+        Flag the rows of data that belong to the bin.
+        :param data: pandas data frame
+        :param feature: feature name on which this bin is defined
+        :return: boolean array with one entry per row of the data
+        """
         data_feature_column = data[feature]
-        return data[data_feature_column.isin(self.categories)]
+        return np.asarray(data_feature_column.isin(self.categories))
+
+    def to_dict(self):
+        """
+        :return: JSON serializable form of the representation, a nan category becomes None
+        """
+        return {'categories': sorted([_to_json_value(category) for category in self.categories], key=str)}
+
+    @classmethod
+    def from_dict(cls, state):
+        """
+        :param state: dict as returned by to_dict()
+        :return: the restored CategoricalRepresentation object
+        """
+        return cls([_from_json_value(category) for category in state['categories']])
+
+
+def _to_json_value(value):
+    """ Converts numpy scalars to python values and nan to None. """
+    if isinstance(value, np.generic):
+        value = value.item()
+    if isinstance(value, float) and np.isnan(value):
+        return None
+    return value
+
+
+def _from_json_value(value):
+    """ Converts None back to nan. """
+    return np.nan if value is None else value
+
+
+def _is_nan(value):
+    return isinstance(value, (float, np.floating)) and np.isnan(value)
+
+
+def _equal_or_nan(value, other):
+    return value == other or (_is_nan(value) and _is_nan(other))
+
+
+#------- bin collections -------#
+class BinSet(object):
+    """
+    Compact collection of disjoint bins of one type, as created by create_bins.
+
+    Numerical bins are stored as arrays of their bounds and closedness flags, categorical bins as an array
+    of all categories with the index of the bin of every category. Indexing and iteration yield Bin objects
+    as views on single bins, so that a BinSet can be used wherever a list of Bin objects is expected.
+    """
+    __hash__ = None
+
+    def __init__(self, bin_type, lower=None, upper=None, lower_closed=None, upper_closed=None,
+                 categories=None, codes=None, n_bins=None):
+        """
+        Constructor for a collection of bins.
+        :param bin_type: "numerical" or "categorical"
+        :param lower: array of the lower bounds of numerical bins
+        :param upper: array of the upper bounds of numerical bins
+        :param lower_closed: boolean array of whether the lower bounds are closed
+        :param upper_closed: boolean array of whether the upper bounds are closed
+        :param categories: array of the categories of categorical bins, every category belongs to a single bin
+        :param codes: array of the index of the bin of every category
+        :param n_bins: number of categorical bins, by default the number of distinct codes
+        """
+        self.bin_type = bin_type
+        if bin_type == "numerical":
+            self.lower = np.asarray(lower)
+            self.upper = np.asarray(upper)
+            self.lower_closed = np.asarray(lower_closed, dtype=bool)
+            self.upper_closed = np.asarray(upper_closed, dtype=bool)
+            if not len(self.lower) == len(self.upper) == len(self.lower_closed) == len(self.upper_closed):
+                raise ValueError("Bounds and closedness flags of numerical bins need to have the same length.")
+            self.n_bins = len(self.lower)
+        elif bin_type == "categorical":
+            self.categories = np.empty(len(categories), dtype=object)
+            self.categories[:] = list(categories)
+            self.codes = np.asarray(codes, dtype=np.int64)
+            if len(self.categories) != len(self.codes):
+                raise ValueError("Every category of categorical bins needs a bin index.")
+            self.n_bins = int(self.codes.max()) + 1 if n_bins is None and len(self.codes) else (n_bins or 0)
+            # categories sorted by bin, bin i owns the slice between offsets i and i + 1
+            self._order = np.argsort(self.codes, kind='mergesort')
+            self._offsets = np.searchsorted(self.codes[self._order], np.arange(self.n_bins + 1))
+        else:
+            raise ValueError("bin_type needs to be 'numerical' or 'categorical'.")
+
+    @classmethod
+    def from_bins(cls, bins, bin_type=None):
+        """
+        Collect bins of one type into a BinSet.
+        :param bins: a list of Bin objects
+        :param bin_type: "numerical" or "categorical", needed if the list is empty
+        :return: BinSet object
+        """
+        bin_types = set(bin.bin_type for bin in bins) | (set([bin_type]) if bin_type else set())
+        if len(bin_types) != 1:
+            raise ValueError("A BinSet holds bins of a single type.")
+        bin_type = bin_types.pop()
+        if bin_type == "numerical":
+            representations = [bin.representation for bin in bins]
+            return cls("numerical",
+                       lower=[r.lower for r in representations], upper=[r.upper for r in representations],
+                       lower_closed=[r.lower_closed for r in representations],
+                       upper_closed=[r.upper_closed for r in representations])
+        categories = [list(bin.representation.categories) for bin in bins]
+        codes = np.repeat(np.arange(len(bins)), [len(bin_categories) for bin_categories in categories])
+        categories = sum(categories, [])
+        if len(set(_to_json_value(category) for category in categories)) < len(categories):
+            raise ValueError("Categorical bins of a BinSet need to be disjoint.")
+        return cls("categorical", categories=categories, codes=codes, n_bins=len(bins))
+
+    def __len__(self):
+        return self.n_bins
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return BinSet.from_bins([self[i] for i in range(*index.indices(len(self)))], self.bin_type)
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError("BinSet index out of range.")
+        if self.bin_type == "numerical":
+            return Bin("numerical", self.lower[index], self.upper[index],
+                       bool(self.lower_closed[index]), bool(self.upper_closed[index]))
+        return Bin("categorical",
+                   list(self.categories[self._order[self._offsets[index]:self._offsets[index + 1]]]))
+
+    def __iter__(self):
+        for index in range(len(self)):
+            yield self[index]
+
+    def __repr__(self):
+        return "[" + ", ".join(repr(bin) for bin in self) + "]"
+
+    def __eq__(self, other):
+        try:
+            return len(self) == len(other) and all(bin == other_bin for bin, other_bin in zip(self, other))
+        except TypeError:
+            return False
+
+    def __ne__(self, other):
+        return not self.__eq__(other)
+
+    def assign(self, data, feature):
+        """
+        Label every row of the data with the bin it belongs to.
+        :param data: pandas data frame
+        :param feature: feature name on which the bins are defined
+        :return: integer array of bin indices per row, -1 for rows in none of the bins
+        """
+        if self.bin_type == "numerical":
+            return self._assign_numerical(data[feature])
+
+        # a single lookup of the category of every row
+        column = data[feature]
+        missing = np.array([_is_nan(category) for category in self.categories], dtype=bool)
+        positions = pd.Index(self.categories[~missing]).get_indexer(column)
+        labels = np.where(positions >= 0, self.codes[~missing][positions], -1)
+        if missing.any():
+            labels[np.asarray(pd.isnull(column))] = self.codes[missing][0]
+        return labels
+
+    def _assign_numerical(self, column):
+        """
+        Label the values with their numerical bin by a binary search of the lower bounds. Rows are only
+        labelled with the first bin containing them if the bins overlap, which needs a pass per bin.
+        """
+        labels = np.full(len(column), -1, dtype=np.int64)
+        if not len(self):
+            return labels
+        nan_bins = np.isnan(self.lower.astype(float)) | np.isnan(self.upper.astype(float))
+        # bins like (1, 1] contain no value and are left out of the search
+        with np.errstate(invalid='ignore'):
+            searched = ~nan_bins & ((self.lower < self.upper) |
+                                    ((self.lower == self.upper) & self.lower_closed & self.upper_closed))
+        if not np.issubdtype(np.asarray(column).dtype, np.number) or self._overlapping(searched):
+            for index in reversed(range(len(self))):
+                labels[self[index].mask(pd.DataFrame({'feature': column}), 'feature')] = index
+            return labels
+
+        values = np.asarray(column, dtype=float)
+        missing = np.isnan(values)
+        # if either bound is nan, only nans exist in the bin
+        if nan_bins.any():
+            labels[missing] = np.flatnonzero(nan_bins)[0]
+
+        bins = np.flatnonzero(searched)
+        if not len(bins):
+            return labels
+        bins = bins[np.lexsort((self.upper[bins], self.lower[bins]))]
+        rows = np.flatnonzero(~missing)
+        # the last bin starting at or below the value, or the one before if that one ends at the value
+        position = np.searchsorted(self.lower[bins], values[rows], side='right') - 1
+        for _ in range(2):
+            valid = position >= 0
+            rows, position = rows[valid], position[valid]
+            index, value = bins[position], values[rows]
+            contained = np.where(self.lower_closed[index], value >= self.lower[index], value > self.lower[index]) & \
+                np.where(self.upper_closed[index], value <= self.upper[index], value < self.upper[index])
+            labels[rows[contained]] = index[contained]
+            rows, position = rows[~contained], position[~contained] - 1
+        return labels
+
+    def _overlapping(self, selected):
+        """ Whether any two of the selected numerical bins share a value. """
+        bins = np.flatnonzero(selected)
+        bins = bins[np.lexsort((self.upper[bins], self.lower[bins]))]
+        upper, lower = self.upper[bins[:-1]], self.lower[bins[1:]]
+        touching = (upper == lower) & self.upper_closed[bins[:-1]] & self.lower_closed[bins[1:]]
+        return bool(((upper > lower) | touching).any())
+
+
+#------- bin cache -------#
+def data_fingerprint(data):
+    """
+    Fingerprint of the values of a feature, e.g. to look up cached bins of the same data.
+    :param data: a list, 1-dim array or series of values
+    :return: hex digest of the hashes of the values
+    """
+    hashes = pd.util.hash_pandas_object(pd.Series(data), index=False).values
+    return hashlib.sha1(hashes.tobytes()).hexdigest()
+
+
+class BinCache(object):
+    """
+    Cache of bins keyed by feature, fingerprint and number of bins, so that the bins of a feature are created
+    once and reused across experiments. The fingerprint identifies the data the bins are created from, e.g.
+    data_fingerprint() of the values or a date range of the data. If a directory is given, the bins are
+    persisted there as JSON files and reused across runs as well.
+    """
+    def __init__(self, directory=None):
+        """
+        :param directory: directory to persist the bins in, None to cache them in memory only
+        """
+        self.directory = directory
+        self._bins = {}
+
+    def _path(self, key):
+        name = hashlib.sha1(json.dumps(list(key)).encode('utf-8')).hexdigest()
+        return os.path.join(self.directory, 'expan_bins_' + name + '.json')
+
+    def get(self, feature, fingerprint, n_bins):
+        """
+        :param feature: feature name
+        :param fingerprint: fingerprint of the data the bins are created from
+        :param n_bins: number of requested bins
+        :return: the cached BinSet, None if there are none
+        """
+        key = (feature, str(fingerprint), int(n_bins))
+        if key not in self._bins and self.directory is not None and os.path.isfile(self._path(key)):
+            with open(self._path(key)) as f:
+                state = json.load(f)
+            self._bins[key] = BinSet.from_bins([Bin.from_dict(bin) for bin in state['bins']], state.get('bin_type'))
+        return self._bins.get(key)
+
+    def put(self, feature, fingerprint, n_bins, bins):
+        """
+        :param feature: feature name
+        :param fingerprint: fingerprint of the data the bins are created from
+        :param n_bins: number of requested bins
+        :param bins: a BinSet or a list of Bin objects of one type
+        """
+        key = (feature, str(fingerprint), int(n_bins))
+        if not isinstance(bins, BinSet):
+            bins = BinSet.from_bins(bins)
+        self._bins[key] = bins
+        if self.directory is not None:
+            with open(self._path(key), 'w') as f:
+                json.dump({'feature'     : key[0],
+                           'fingerprint' : key[1],
+                           'n_bins'      : key[2],
+                           'bin_type'    : bins.bin_type,
+                           'bins'        : [bin.to_dict() for bin in bins]}, f)
+
+    def create_bins(self, feature, data, n_bins, fingerprint=None, **kwargs):
+        """
+        Create bins from the data value like create_bins, unless they are cached already.
+        :param feature: feature name
+        :param data: a list or a 1-dim array of data to determine the bins
+        :param n_bins: number of bins to create
+        :param fingerprint: fingerprint of the data, e.g. a date range; data_fingerprint(data) if None
+        :param kwargs: further arguments of create_bins
+        :return: the created or cached bins
+        """
+        if fingerprint is None:
+            fingerprint = data_fingerprint(data)
+        bins = self.get(feature, fingerprint, n_bins)
+        if bins is None:
+            bins = create_bins(data, n_bins, **kwargs)
+            self.put(feature, fingerprint, n_bins, bins)
+        return bins
+
+
+#------- approximate quantiles -------#
+class QuantileSketch(object):
+    """
+    Mergeable quantile sketch of numerical data (KLL, Karnin, Lang and Liberty, 2016).
+
+    The sketch keeps a hierarchy of compactors. Items at level h stand for 2^h values; a full level is
+    sorted and every other item, starting at a random offset, is promoted to the next level. The memory
+    is about 3k items independent of the number of values. Sketches of separate chunks or partitions
+    can be merged into a sketch of the union. Minimum, maximum and the number of nans are exact.
+
+    The rank of any value is estimated within a normalized error of roughly 2.296 / k^0.9723
+    (the bound established for KLL sketches), with 99% confidence, i.e. about 1.3% for k=200 and
+    0.3% for k=1000. As long as fewer than k values have been added, quantiles are exact.
+    """
+    def __init__(self, k=200, seed=None):
+        """
+        :param k: accuracy parameter, the capacity of the top compactor
+        :param seed: seed of the random offsets of the compactions
+        """
+        if k < 8:
+            raise ValueError('k should be at least 8.')
+        self.k = k
+        self.n = 0
+        self.n_nans = 0
+        self.min = np.nan
+        self.max = np.nan
+        self.levels = [np.array([], dtype=float)]
+        self._random_state = np.random.RandomState(seed)
+
+    def __len__(self):
+        return self.n
+
+    def _capacity(self, level):
+        depth = len(self.levels) - 1 - level
+        return max(2, int(np.ceil(self.k * (2. / 3.) ** depth)))
+
+    def _compress(self):
+        level = 0
+        while level < len(self.levels):
+            items = self.levels[level]
+            if len(items) >= self._capacity(level):
+                if level + 1 == len(self.levels):
+                    self.levels.append(np.array([], dtype=float))
+                items = np.sort(items)
+                # an odd item stays behind
+                kept = items[:len(items) % 2]
+                offset = self._random_state.randint(2)
+                self.levels[level] = kept
+                self.levels[level + 1] = np.concatenate([self.levels[level + 1], items[len(kept) + offset::2]])
+            level += 1
+
+    def update(self, values):
+        """
+        Add values to the sketch; nans are counted, but do not enter the quantiles.
+        :param values: array-like of numbers
+        :return: the sketch itself
+        """
+        values = np.asarray(values, dtype=float).ravel()
+        nans = np.isnan(values)
+        self.n_nans += int(nans.sum())
+        values = values[~nans]
+        if len(values) == 0:
+            return self
+
+        self.n += len(values)
+        self.min = np.fmin(self.min, values.min())
+        self.max = np.fmax(self.max, values.max())
+        self.levels[0] = np.concatenate([self.levels[0], values])
+        self._compress()
+        return self
+
+    def merge(self, other):
+        """
+        Merge another sketch into this one.
+        :param other: QuantileSketch object
+        :return: the sketch itself, summarizing the values of both sketches
+        """
+        while len(self.levels) < len(other.levels):
+            self.levels.append(np.array([], dtype=float))
+        for level, items in enumerate(other.levels):
+            self.levels[level] = np.concatenate([self.levels[level], items])
+        self.n += other.n
+        self.n_nans += other.n_nans
+        self.min = np.fmin(self.min, other.min)
+        self.max = np.fmax(self.max, other.max)
+        self._compress()
+        return self
+
+    def rank_error(self):
+        """
+        :return: normalized rank error that holds with 99% confidence
+        """
+        return 2.296 / self.k ** 0.9723
 
+    def sorted_view(self):
+        """
+        Retained items in sorted order with the number of values they stand for. The exact minimum
+        and maximum are included with weight zero, so that bins derived from the view cover all values.
+        :return: tuple of arrays of values and weights
+        """
+        if self.n == 0:
+            return np.array([], dtype=float), np.array([], dtype=int)
+        values = np.concatenate([[self.min]] + self.levels + [[self.max]])
+        weights = np.concatenate([[0]] + [np.full(len(items), 2 ** level, dtype=np.int64)
+                                          for level, items in enumerate(self.levels)] + [[0]])
+        order = np.argsort(values, kind='mergesort')
+        return values[order], weights[order]
+
+    def quantile(self, q):
+        """
+        Approximate quantiles of the values.
+        :param q: quantile or array of quantiles in [0, 1]
+        :return: the smallest retained value whose estimated rank reaches q of all values
+        """
+        values, weights = self.sorted_view()
+        if len(values) == 0:
+            return np.nan * np.asarray(q, dtype=float)
+        cumulative = np.cumsum(weights)
+        index = np.searchsorted(cumulative, np.asarray(q, dtype=float) * cumulative[-1], side='left')
+        return values[np.clip(index, 1, len(values) - 1)]
 
 
 #------- public methods -------#
-def create_bins(data, n_bins):
+def create_bins(data, n_bins, approximate=False, exact_below=100000, k=200):
     """
     Create bins from the data value
-    :param data: a list or a 1-dim array of data to determine the bins
+    :param data: a list or a 1-dim array of data to determine the bins, or a QuantileSketch of numerical
+                 data, e.g. built and merged per partition of data that does not fit into memory
     :param n_bins: number of bins to create
-    :return: a list of Bin object
+    :param approximate: whether numerical bins are derived from a QuantileSketch of the data,
+                        which needs no sorting of the full data
+    :param exact_below: inputs with fewer values are binned exactly even if approximate is set
+    :param k: accuracy parameter of the sketch, see QuantileSketch
+    :return: a BinSet, which is a sequence of Bin objects
     """
     if data is None or len(data) <= 0:
         raise ValueError('Empty input array!')
@@ -173,22 +669,44 @@ def create_bins(data, n_bins):
     if n_bins <= 0:
         raise ValueError('Less than one bin makes no sense.')
 
+    if isinstance(data, QuantileSketch):
+        return _create_bins_from_sketch(data, n_bins)
+
+    if pd.api.types.is_categorical_dtype(data) and \
+            not np.issubdtype(pd.Series(data).cat.categories.dtype, np.number):
+        # categorical series are counted from their codes, without casting the values
+        data_as_array = None
+        is_numeric = False
+    else:
+        # cast into a numpy array to infer the dtype
+        data_as_array = np.array(data)
+        is_numeric = np.issubdtype(data_as_array.dtype, np.number)
+
+    if is_numeric and approximate and len(data_as_array) >= exact_below:
+        return _create_bins_from_sketch(QuantileSketch(k).update(data_as_array), n_bins)
+
+    if is_numeric:
+        # sorting once serves counting the distinct values and all bin bounds; nans are sorted to the end
+        sorted_data = np.sort(data_as_array)
+        n_nans = int(np.isnan(sorted_data).sum()) if np.issubdtype(sorted_data.dtype, np.inexact) else 0
+        sorted_data = sorted_data[:len(sorted_data) - n_nans]
+        n_unique_values = int(np.count_nonzero(np.diff(sorted_data))) + 1 if len(sorted_data) else 0
+    else:
+        categories, counts, n_missing = _count_categories(data, data_as_array)
+        # missing values form a category of their own, but are not a distinct value
+        n_unique_values = len(categories) - int(n_missing > 0)
+
     insufficient_distinct = False
-    n_unique_values = len(np.unique([value for value in data if not is_number_and_nan(value)]))
     if n_unique_values < n_bins:
         insufficient_distinct = True
         warnings.warn("Insufficient unique values for requested number of bins. " +
                       "Number of bins will be reset to number of unique values.")
         n_bins = n_unique_values
 
-    # cast into a numpy array to infer the dtype
-    data_as_array = np.array(data)
-    is_numeric = np.issubdtype(data_as_array.dtype, np.number)
-
     if is_numeric:
-        bins = _create_numerical_bins(data_as_array, n_bins)
+        bins = _create_numerical_bins(sorted_data, n_bins, n_nans > 0)
     else:
-        bins = _create_categorical_bins(data_as_array, n_bins)
+        bins = _create_categorical_bins(categories, counts, n_bins)
 
     if (not insufficient_distinct) and (len(bins) < n_bins):
         warnings.warn('Created less bins than requested.')
@@ -196,84 +714,141 @@ def create_bins(data, n_bins):
     return bins
 
 
-#------- private methods for numerical binnings-------#
-
-def _create_numerical_bins(data_as_array, n_bins):
-    return _create_next_numerical_bin(data_as_array, n_bins, [])
+def assign_bins(data, feature, bins):
+    """
+    Label every row of the data with the bin it belongs to.
+    :param data: pandas data frame
+    :param feature: feature name on which the bins are defined
+    :param bins: a list of Bin objects
+    :return: integer array of bin indices per row, -1 for rows in none of the bins;
+             a row in several bins gets the first of them
+    """
+    if isinstance(bins, BinSet):
+        return bins.assign(data, feature)
+    labels = np.full(len(data), -1, dtype=np.int64)
+    for index in reversed(range(len(bins))):
+        labels[bins[index].mask(data, feature)] = index
+    return labels
 
 
-def _create_next_numerical_bin(x, n_bins, result):
+def _create_bins_from_sketch(sketch, n_bins):
     """
-    Create bins for numerical data
-    :param x: array of data
-    :param n_bins: number of bins
-    :return: a list of bins object
+    Create numerical bins from the items retained by a quantile sketch.
+    :param sketch: QuantileSketch object
+    :param n_bins: number of bins to create
+    :return: a BinSet of numerical bins
     """
-    # no more data
-    if len(x) == 0:
-        return result
+    values, weights = sketch.sorted_view()
+    n_unique_values = int(np.count_nonzero(np.diff(values))) + 1 if len(values) else 0
+    if n_unique_values < n_bins:
+        warnings.warn("Insufficient unique values for requested number of bins. " +
+                      "Number of bins will be reset to number of unique values.")
+        n_bins = n_unique_values
+    return _create_numerical_bins(values, n_bins, sketch.n_nans > 0, weights)
 
-    # if data has nan
-    if any(np.isnan(x)):
-        cur_bin = Bin("numerical", np.nan, np.nan, True, True)
-        result.append(cur_bin)
-        return _create_next_numerical_bin(x[~np.isnan(x)], n_bins-1, result)
 
-    # the last bin is a closed-closed interval
-    if n_bins == 1:
-        cur_bin = Bin("numerical", min(x), max(x), True, True)
-        result.append(cur_bin)
-        return result
+#------- private methods for numerical binnings-------#
+
+def _create_numerical_bins(sorted_data, n_bins, has_nan=False, weights=None):
+    """
+    Create equal-frequency bins for numerical data by index arithmetic on the sorted data.
+    Every bin covers the values up to the 1/k-th 'higher' percentile of the values not yet
+    binned, where k is the number of bins still to create. A bin consisting of a single
+    repeated value is closed, other bins are closed-open; the last bin is closed.
+    :param sorted_data: sorted array of data without nans
+    :param n_bins: number of bins, including the bin of nans
+    :param has_nan: whether the data contained nans, which get the first bin
+    :param weights: number of values every item stands for, e.g. for the items of a QuantileSketch;
+                    None if every item is a single value
+    :return: a BinSet of numerical bins
+    """
+    # lower, upper, lower_closed and upper_closed of every bin
+    result = []
+    if has_nan:
+        result.append((np.nan, np.nan, True, True))
+        n_bins -= 1
+
+    if weights is None:
+        n = len(sorted_data)
+        rank_of = lambda index: index
+        index_of = lambda rank: rank
+    else:
+        # number of values preceding every item
+        ranks = np.concatenate([[0], np.cumsum(weights)[:-1]])
+        n = int(np.sum(weights))
+        rank_of = lambda index: int(ranks[index])
+        index_of = lambda rank: int(np.searchsorted(ranks, rank, side='right')) - 1
+
+    start = 0
+    while start < len(sorted_data):
+        # the last bin is a closed-closed interval
+        if n_bins <= 1:
+            result.append((sorted_data[start], sorted_data[-1], True, True))
+            break
+
+        # same index as np.percentile(remaining data, 100 / n_bins, interpolation='higher')
+        offset = int(np.ceil(np.linspace(0., 100., n_bins + 1)[1] / 100. * (n - rank_of(start) - 1)))
+        lower = sorted_data[start]
+        upper = sorted_data[index_of(rank_of(start) + max(offset, 0))]
+
+        if lower == upper:
+            result.append((lower, upper, True, True))
+            start = int(np.searchsorted(sorted_data, upper, side='right'))
+        else:
+            result.append((lower, upper, True, False))
+            start = int(np.searchsorted(sorted_data, upper, side='left'))
+        n_bins -= 1
 
-    lower, upper, lower_closed, upper_closed = _first_interval(x, n_bins)
-    cur_bin = Bin("numerical", lower, upper, lower_closed, upper_closed)
-    result.append(cur_bin)
+    lower, upper, lower_closed, upper_closed = zip(*result) if result else ([], [], [], [])
+    return BinSet("numerical", lower=lower, upper=upper, lower_closed=lower_closed, upper_closed=upper_closed)
 
-    next_data = x[x > upper] if upper_closed else x[x >= upper]
-    return _create_next_numerical_bin(next_data, n_bins-1, result)
 
+#------- private methods for categorical binnings-------#
 
-def _first_interval(x, n_bins):
+def _count_categories(data, data_as_array):
     """
-    Gets the first interval based on the percentiles, 
-    either a closed interval containing the same value multiple times
-    or a closed-open interval with a different lower and upper bound.
+    Counts the occurrences of every category by factorization. Missing values are counted
+    as one category, represented by nan.
+    :param data: the data as given to create_bins, possibly a categorical pandas series
+    :param data_as_array: the data cast into a numpy array, None for a categorical series
+    :return: list of categories, array of their counts and number of missing values
     """
-    # calculate the percentiles
-    percentiles = np.linspace(0., 100., n_bins + 1)
-    bounds = np.percentile(x, q=percentiles, interpolation='higher')
-    lower = bounds[0]
-    upper = bounds[1]
-
-    if lower == upper:
-        return lower, upper, True, True
+    if pd.api.types.is_categorical_dtype(data):
+        data = pd.Series(data)
+        codes = data.cat.codes.values
+        categories = list(data.cat.categories)
     else:
-        return lower, upper, True, False
+        codes, uniques = pd.factorize(data_as_array)
+        categories = list(uniques)
 
+    counts = np.bincount(codes[codes >= 0], minlength=len(categories))
+    n_missing = len(codes) - counts.sum()
 
-#------- private methods for categorical binnings-------#
+    # drop categories of a categorical series that do not occur
+    occurring = counts > 0
+    categories = [category for category, occurs in zip(categories, occurring) if occurs]
+    counts = counts[occurring]
+    if n_missing > 0:
+        categories.append(np.nan)
+        counts = np.append(counts, n_missing)
+    return categories, counts, n_missing
 
-def _create_categorical_bins(data_as_array, n_bins):
+
+def _create_categorical_bins(categories, counts, n_bins):
     """ 
     Performs greedy (non-optimal) binning
-    :param data_as_array: array of data to bin according to their frequencies
-    :return: a list of Bin object
+    :param categories: list of categories to bin according to their frequencies
+    :param counts: array of the frequencies of the categories
+    :param n_bins: number of bins
+    :return: a BinSet of categorical bins
     """
-    # count items
-    weights = {}
-    for item in data_as_array:
-        if not item in weights:
-            weights[item] = 1
-        else:
-            weights[item] += 1
-
     # we need items sorted in decreasing order
-    pairs = sorted([(weight, [item]) for (item, weight) in weights.items()], reverse=True)
+    pairs = sorted([(int(weight), [item]) for (item, weight) in zip(categories, counts)], reverse=True)
     bins = pairs[:min(n_bins, len(pairs))]
 
     # too little data, just return what we have so far
     if len(pairs) <= n_bins:
-        return toBinObject(bins)
+        return _toBinSet(bins)
 
     heapify(bins)
 
@@ -284,7 +859,13 @@ def _create_categorical_bins(data_as_array, n_bins):
         # add the heaviest item to it
         heappush(bins, (bin_weight + pair_weight, bin_labels + pair_labels))
 
-    return toBinObject(bins)
+    return _toBinSet(bins)
+
+
+def _toBinSet(bins):
+    categories = [category for bin in bins for category in bin[1]]
+    codes = np.repeat(np.arange(len(bins)), [len(bin[1]) for bin in bins])
+    return BinSet("categorical", categories=categories, codes=codes, n_bins=len(bins))
 
 
 def toBinObject(bins):
@@ -2,14 +2,17 @@ import os
 import pickle
 import sys
 import tempfile
+import time
+import warnings
+from collections import OrderedDict
 from os.path import dirname, join, realpath
 
 import numpy as np
-from pystan import StanModel
-from scipy.stats import gaussian_kde, norm, cauchy
+from scipy.stats import norm, cauchy
+from scipy.stats import t as stats_t
 
 import expan.core.statistics as statx
-from expan.core.util import drop_nan
+from expan.core.util import drop_nan, fingerprint, MemoCache
 
 __location__ = realpath(join(os.getcwd(), dirname(__file__)))
 
@@ -31,11 +34,239 @@ def obrien_fleming(information_fraction, alpha=0.05):
     return (1 - norm.cdf(norm.ppf(1 - alpha / 2) / np.sqrt(information_fraction))) * 2
 
 
+def pocock(information_fraction, alpha=0.05):
+    """
+    Calculate the Lan-DeMets approximation of the Pocock alpha spending function.
+
+    Args:
+        information_fraction (scalar or array_like): share of the information
+            amount at the point of evaluation, e.g. the share of the maximum
+            sample size
+        alpha: type-I error rate
+
+    Returns:
+        float: redistributed alpha value at the time point with the given
+               information fraction
+    """
+    return alpha * np.log(1 + (np.e - 1) * np.asarray(information_fraction))
+
+
+def hwang_shih_decani(information_fraction, alpha=0.05, gamma=-4.):
+    """
+    Calculate the Hwang-Shih-DeCani family of alpha spending functions.
+
+    Args:
+        information_fraction (scalar or array_like): share of the information
+            amount at the point of evaluation, e.g. the share of the maximum
+            sample size
+        alpha: type-I error rate
+        gamma: shape of the spending function; negative values spend less alpha
+            early on (gamma=-4 resembles O'Brien-Fleming, gamma=1 resembles Pocock),
+            gamma=0 spends alpha linearly
+
+    Returns:
+        float: redistributed alpha value at the time point with the given
+               information fraction
+    """
+    t = np.asarray(information_fraction, dtype=float)
+    if gamma == 0:
+        return alpha * t
+    return alpha * (1 - np.exp(-gamma * t)) / (1 - np.exp(-gamma))
+
+
+spending_functions = {
+    'obrien_fleming'    : obrien_fleming,
+    'pocock'            : pocock,
+    'hwang_shih_decani' : hwang_shih_decani
+}
+
+
+def _get_spending_function(spending_function):
+    if callable(spending_function):
+        return spending_function
+    if spending_function not in spending_functions:
+        raise NotImplementedError
+    return spending_functions[spending_function]
+
+
+def _continuation_grid(intervals, points_per_interval=401):
+    """
+    Grid points and Simpson weights for integrating over a union of intervals.
+    """
+    points, weights = [], []
+    for lower, upper in intervals:
+        if upper <= lower:
+            continue
+        interval_weights = np.ones(points_per_interval)
+        interval_weights[1:-1:2] = 4
+        interval_weights[2:-1:2] = 2
+        points.append(np.linspace(lower, upper, points_per_interval))
+        weights.append(interval_weights * (upper - lower) / (points_per_interval - 1) / 3.)
+    if not points:
+        return np.array([]), np.array([])
+    return np.concatenate(points), np.concatenate(weights)
+
+
+def _stage_distribution(points, masses, previous_fraction, fraction, drift):
+    # conditional mean and standard deviation of sqrt(t_k) * Z_k given Z_{k-1} at the grid points
+    increment = fraction - previous_fraction
+    return points * np.sqrt(previous_fraction) + drift * increment, np.sqrt(increment)
+
+
+def _outside_probability(points, masses, previous_fraction, fraction, drift, bound):
+    """
+    Probability of continuing up to the previous look and ending up with |Z_k| > bound.
+    """
+    mean, scale = _stage_distribution(points, masses, previous_fraction, fraction, drift)
+    scaled_bound = bound * np.sqrt(fraction)
+    return np.sum(masses * (norm.sf((scaled_bound - mean) / scale) + norm.cdf((-scaled_bound - mean) / scale)))
+
+
+def _propagate(points, masses, previous_fraction, fraction, drift, intervals):
+    """
+    Probability masses of the continuation region of the next look on its integration grid.
+    """
+    mean, scale = _stage_distribution(points, masses, previous_fraction, fraction, drift)
+    new_points, new_weights = _continuation_grid(intervals)
+    if len(new_points) == 0:
+        return new_points, new_weights
+    density = norm.pdf((new_points[:, np.newaxis] * np.sqrt(fraction) - mean[np.newaxis, :]) / scale).dot(masses)
+    return new_points, new_weights * density * np.sqrt(fraction) / scale
+
+
+class GroupSequentialDesign(object):
+    """
+    Two-sided group sequential design with error spending boundaries for a planned set of looks.
+
+    Efficacy boundaries are chosen such that the probability under the null hypothesis of
+    crossing a boundary for the first time at look k equals the alpha spent between look k-1
+    and look k. Optional futility boundaries are non-binding and spend the type-II error
+    beta = 1 - power with the same spending function, under the alternative of the fixed-horizon
+    design with the given power. Crossing probabilities are computed by recursive numerical
+    integration (Armitage, McPherson and Rowe, 1969).
+    """
+    def __init__(self, information_fractions, alpha=0.05, spending_function='obrien_fleming',
+                 futility=False, power=0.8, cap=8):
+        """
+        Args:
+            information_fractions (list): increasing information fractions of the planned looks in (0, 1]
+            alpha: type-I error rate
+            spending_function: name of the alpha spending function ('obrien_fleming', 'pocock',
+                'hwang_shih_decani') or a function of (information_fraction, alpha)
+            futility (boolean): whether futility boundaries are computed
+            power: power of the design the futility boundaries are computed for
+            cap: upper bound of the efficacy boundaries
+        """
+        from scipy.optimize import brentq
+
+        fractions = np.array(information_fractions, dtype=float)
+        if len(fractions) == 0 or np.any(np.diff(fractions) <= 0) or fractions[0] <= 0 or fractions[-1] > 1:
+            raise ValueError('Information fractions should be increasing and within (0, 1].')
+
+        spend = _get_spending_function(spending_function)
+        self.information_fractions = fractions
+        self.alpha                 = alpha
+        self.cumulative_alpha      = np.array([spend(t, alpha=alpha) for t in fractions], dtype=float)
+
+        # efficacy boundaries under the null hypothesis, starting from Z_0 = 0
+        bounds = []
+        points, masses, previous_fraction, spent = np.zeros(1), np.ones(1), 0., 0.
+        for fraction, cumulative_alpha in zip(fractions, self.cumulative_alpha):
+            target = cumulative_alpha - spent
+            crossing = lambda b: _outside_probability(points, masses, previous_fraction, fraction, 0., b) - target
+            if target <= 0 or crossing(cap) >= 0:
+                bound = cap
+            else:
+                bound = brentq(crossing, 0., cap, xtol=1e-8)
+            bounds.append(bound)
+            spent += _outside_probability(points, masses, previous_fraction, fraction, 0., bound)
+            points, masses = _propagate(points, masses, previous_fraction, fraction, 0., [(-bound, bound)])
+            previous_fraction = fraction
+        self.efficacy_bounds = np.array(bounds)
+        # two-sided significance level at which each look is tested
+        self.nominal_alpha   = 2 * norm.sf(self.efficacy_bounds)
+
+        self.futility_bounds = None
+        if futility:
+            self.futility_bounds = self._futility_bounds(spend, 1 - power, norm.ppf(1 - alpha / 2) + norm.ppf(power))
+
+    def _futility_bounds(self, spend, beta, drift):
+        from scipy.optimize import brentq
+
+        futility_bounds = []
+        points, masses, previous_fraction, spent = np.zeros(1), np.ones(1), 0., 0.
+        for k, fraction in enumerate(self.information_fractions):
+            efficacy_bound = self.efficacy_bounds[k]
+            target = spend(fraction, alpha=beta) - spent
+            inside = lambda f: np.sum(masses) - _outside_probability(points, masses, previous_fraction, fraction,
+                                                                     drift, f)
+            # at the last look, the futility boundary meets the efficacy boundary
+            if k == len(self.information_fractions) - 1 or inside(efficacy_bound) - target <= 0:
+                bound = efficacy_bound
+            elif target <= 0:
+                bound = 0.
+            else:
+                bound = brentq(lambda f: inside(f) - target, 0., efficacy_bound, xtol=1e-8)
+            futility_bounds.append(bound)
+            spent += inside(bound)
+            if bound >= efficacy_bound:
+                points, masses = np.array([]), np.array([])
+            else:
+                points, masses = _propagate(points, masses, previous_fraction, fraction, drift,
+                                            [(-efficacy_bound, -bound), (bound, efficacy_bound)])
+            previous_fraction = fraction
+        return np.array(futility_bounds)
+
+    def look(self, information_fraction):
+        """
+        Index of the latest planned look reached at the given information fraction (scalar or array);
+        analyses before the first planned look use the boundaries of the first look.
+        """
+        looks = np.maximum(0, np.searchsorted(self.information_fractions, np.asarray(information_fraction) + 1e-12,
+                                              side='right') - 1)
+        return int(looks) if np.ndim(looks) == 0 else looks
+
+
+# planned designs, keyed by their parameters
+group_sequential_designs = {}
+
+
+def get_group_sequential_design(looks, alpha=0.05, spending_function='obrien_fleming', futility=False, power=0.8,
+                                cap=8):
+    """
+    Returns the (cached) group sequential design for the given parameters.
+
+    Args:
+        looks (int or list): number of equally spaced looks, or their information fractions
+        alpha: type-I error rate
+        spending_function: name of the alpha spending function or a function of (information_fraction, alpha)
+        futility (boolean): whether futility boundaries are computed
+        power: power of the design the futility boundaries are computed for
+        cap: upper bound of the efficacy boundaries
+
+    Returns:
+        GroupSequentialDesign object
+    """
+    if np.isscalar(looks):
+        fractions = tuple(np.arange(1, looks + 1) / float(looks))
+    else:
+        fractions = tuple(float(t) for t in looks)
+
+    key = (fractions, alpha, spending_function, futility, power, cap)
+    if key not in group_sequential_designs:
+        group_sequential_designs[key] = GroupSequentialDesign(fractions, alpha, spending_function, futility, power, cap)
+    return group_sequential_designs[key]
+
+
 def make_group_sequential(spending_function='obrien_fleming', estimated_sample_size=None, alpha=0.05, cap=8,
-                          multi_test_correction=False, num_tests=1):
+                          multi_test_correction=False, num_tests=1, looks=None, futility=False, power=0.8):
+    design = None
+    if looks is not None:
+        design = get_group_sequential_design(looks, alpha, spending_function, futility, power, cap)
+
     def f(x, y):
         return group_sequential(x, y, spending_function, estimated_sample_size,
-                                alpha, cap, multi_test_correction, num_tests)
+                                alpha, cap, multi_test_correction, num_tests, design)
     return f
 
 
@@ -46,7 +277,8 @@ def group_sequential(x,
                      alpha=0.05,
                      cap=8,
                      multi_test_correction=False,
-                     num_tests=1):
+                     num_tests=1,
+                     design=None):
     """
     Group sequential method to determine whether to stop early or not.
 
@@ -54,13 +286,15 @@ def group_sequential(x,
         x (array_like): sample of a treatment group
         y (array_like): sample of a control group
         spending_function: name of the alpha spending function, currently
-            supports: 'obrien_fleming'
+            supports: 'obrien_fleming', 'pocock' and 'hwang_shih_decani'
         estimated_sample_size: sample size to be achieved towards
             the end of experiment
         alpha: type-I error rate
         cap: upper bound of the adapted z-score
         multi_test_correction (boolean): flag of whether the correction for multiple testing is needed
         num_tests (integer): number of tests or reported kpis used for multiple correction
+        design (GroupSequentialDesign): planned boundaries to look up; if None, the bound is derived
+            from the alpha spent at the current information fraction alone
         
     Returns:
         EarlyStoppingStatistics object
@@ -69,77 +303,413 @@ def group_sequential(x,
     if x is None or y is None:
         raise ValueError('Please provide two non-None samples.')
 
-    # Coercing missing values to right format
-    _x = np.array(x, dtype=float)
-    _y = np.array(y, dtype=float)
+    return _group_sequential_result(statx.sufficient_statistics(x), statx.sufficient_statistics(y),
+                                    spending_function, estimated_sample_size, alpha, cap, multi_test_correction,
+                                    num_tests, design)
+
+
+def make_group_sequential_from_statistics(spending_function='obrien_fleming', estimated_sample_size=None, alpha=0.05,
+                                          cap=8, multi_test_correction=False, num_tests=1, looks=None,
+                                          futility=False, power=0.8):
+    """ a closure to group_sequential on the sufficient statistics (n, mean, M2) of the samples """
+    design = None
+    if looks is not None:
+        design = get_group_sequential_design(looks, alpha, spending_function, futility, power, cap)
+
+    def f(x, y):
+        return _group_sequential_result(x, y, spending_function, estimated_sample_size,
+                                        alpha, cap, multi_test_correction, num_tests, design)
+    return f
 
-    n_x = statx.sample_size(_x)
-    n_y = statx.sample_size(_y)
+
+def _group_sequential_result(stats_x, stats_y, spending_function, estimated_sample_size, alpha, cap,
+                             multi_test_correction, num_tests, design):
+    """ Result of group_sequential from the sufficient statistics of both samples. """
+    n_x, mean_x, m2_x = stats_x
+    n_y, mean_y, m2_y = stats_y
+
+    res = group_sequential_from_statistics(n_x, mean_x, m2_x, n_y, mean_y, m2_y, spending_function,
+                                           estimated_sample_size, alpha, cap, multi_test_correction, num_tests,
+                                           design)
+
+    interval = [{'percentile': round(float(res['lower_percentile']), 5), 'value': float(res['lower_bound'])},
+                {'percentile': round(float(res['upper_percentile']), 5), 'value': float(res['upper_bound'])}]
+    return {'stop'                  : bool(res['stop']),
+            'delta'                 : float(res['delta']),
+            'confidence_interval'   : interval,
+            'treatment_sample_size' : int(n_x),
+            'control_sample_size'   : int(n_y),
+            'treatment_mean'        : float(mean_x),
+            'control_mean'          : float(mean_y),
+            'treatment_variance'    : float(res['treatment_variance']),
+            'control_variance'      : float(res['control_variance'])}
+
+
+def group_sequential_from_statistics(n_x, mean_x, m2_x, n_y, mean_y, m2_y,
+                                     spending_function='obrien_fleming',
+                                     estimated_sample_size=None,
+                                     alpha=0.05,
+                                     cap=8,
+                                     multi_test_correction=False,
+                                     num_tests=1,
+                                     design=None):
+    """
+    Group sequential method on the sufficient statistics of the samples, e.g. from a pre-aggregated
+    table. All statistics may be arrays, so that many kpis, variants and looks are decided in one call.
+
+    Args:
+        n_x (array_like): sample sizes of the treatment groups
+        mean_x (array_like): means of the treatment groups
+        m2_x (array_like): sums of squared deviations from the mean of the treatment groups
+        n_y (array_like): sample sizes of the control groups
+        mean_y (array_like): means of the control groups
+        m2_y (array_like): sums of squared deviations from the mean of the control groups
+        spending_function: name of the alpha spending function
+        estimated_sample_size: sample size to be achieved towards the end of experiment
+        alpha: type-I error rate
+        cap: upper bound of the adapted z-score
+        multi_test_correction (boolean): flag of whether the correction for multiple testing is needed
+        num_tests (integer): number of tests or reported kpis used for multiple correction
+        design (GroupSequentialDesign): planned boundaries to look up, see group_sequential
+
+    Returns:
+        dict: arrays of the stopping decisions, deltas, z-scores, confidence bounds with their
+            percentiles and variances (ddof=0) of treatment and control
+    """
+    n_x, mean_x, m2_x, n_y, mean_y, m2_y = np.broadcast_arrays(
+        *[np.asarray(v, dtype=float) for v in (n_x, mean_x, m2_x, n_y, mean_y, m2_y)])
 
     if not estimated_sample_size:
-        information_fraction = 1.0
+        information_fraction = np.ones_like(n_x)
     else:
-        information_fraction = min(1.0, (n_x + n_y) / estimated_sample_size)
+        information_fraction = np.minimum(1.0, (n_x + n_y) / estimated_sample_size)
 
-    # alpha spending function
-    if spending_function in ('obrien_fleming'):
-        func = eval(spending_function)
+    futility_bound = None
+    if design is not None:
+        look = design.look(information_fraction)
+        alpha_new = design.nominal_alpha[look]
+        bound = design.efficacy_bounds[look]
+        if design.futility_bounds is not None:
+            futility_bound = design.futility_bounds[look]
     else:
-        raise NotImplementedError
-    alpha_new = func(information_fraction, alpha=alpha)
+        # alpha spending function
+        alpha_new = np.asarray(_get_spending_function(spending_function)(information_fraction, alpha=alpha),
+                               dtype=float)
+        # calculate the z-score bound, replacing potential inf with an upper bound
+        bound = norm.ppf(1 - alpha_new / 2)
+        bound = np.where(np.isinf(bound), cap, bound)
 
-    # calculate the z-score bound
-    bound = norm.ppf(1 - alpha_new / 2)
-    # replace potential inf with an upper bound
-    if bound == np.inf:
-        bound = cap
+    with np.errstate(invalid='ignore', divide='ignore'):
+        var_x = m2_x / n_x
+        var_y = m2_y / n_y
+        delta = mean_x - mean_y
+        standard_error = np.sqrt(var_x / n_x + var_y / n_y)
+        # without variance, a difference is either certain or absent
+        z = np.where(standard_error > 0, delta / standard_error, np.sign(delta) * np.inf)
 
-    mu_x = np.nanmean(_x)
-    mu_y = np.nanmean(_y)
-    sigma_x = np.nanstd(_x)
-    sigma_y = np.nanstd(_y)
-    z = (mu_x - mu_y) / np.sqrt(sigma_x ** 2 / n_x + sigma_y ** 2 / n_y)
+        stop = np.abs(z) > bound
+        if futility_bound is not None:
+            stop |= np.abs(z) < futility_bound
 
-    if z > bound or z < -bound:
-        stop = True
-    else:
-        stop = False
+        ratio = var_x / var_y
+        if np.any(~((0.5 < ratio) & (ratio < 2.))):
+            warnings.warn('Sample variances differ too much to assume that '
+                          'population variances are equal.')
+        d_free = n_x + n_y - 2
+        pooled_std = np.sqrt(((n_x - 1) * var_x + (n_y - 1) * var_y) / d_free)
+        interval_error = pooled_std * np.sqrt(1. / n_x + 1. / n_y)
 
-    interval = statx.normal_difference(mu_x, sigma_x, n_x, mu_y, sigma_y, n_y,
-                                       [alpha_new * 100 / 2, 100 - alpha_new * 100 / 2],
-                                       multi_test_correction=multi_test_correction, num_tests=num_tests)
+    lower_percentile = alpha_new * 100 / 2
+    upper_percentile = 100 - alpha_new * 100 / 2
+    # Bonferroni correction
+    if multi_test_correction:
+        lower_percentile = lower_percentile / num_tests
+        upper_percentile = 100 - (100 - upper_percentile) / num_tests
 
-    # return stop, mu_x - mu_y, interval, n_x, n_y, mu_x, mu_y
-    interval = [{'percentile': p, 'value': v} for (p, v) in interval.items()]
-    return {'stop'                  : bool(stop),
+    return {'stop'               : stop,
+            'delta'              : delta,
+            'z_score'            : z,
+            'lower_bound'        : delta + stats_t.ppf(lower_percentile / 100.0, df=d_free) * interval_error,
+            'upper_bound'        : delta + stats_t.ppf(upper_percentile / 100.0, df=d_free) * interval_error,
+            'lower_percentile'   : lower_percentile,
+            'upper_percentile'   : upper_percentile,
+            'treatment_variance' : var_x,
+            'control_variance'   : var_y}
+
+
+class AlwaysValidTest(object):
+    """
+    Running state of a mixture sequential probability ratio test (Johari et al., 2017) on the
+    difference of means. The p-value and confidence interval stay valid however often they are
+    looked at, and are updated from running sufficient statistics in constant time per batch.
+    """
+    def __init__(self, alpha=0.05, mixing_variance=None):
+        """
+        Args:
+            alpha: type-I error rate
+            mixing_variance: variance of the normal mixture over the effect; if None, it is set at the
+                first evaluation to the squared tenth of the pooled standard deviation
+        """
+        self.alpha           = alpha
+        self.mixing_variance = mixing_variance
+        self.treatment       = (0, 0., 0.)
+        self.control         = (0, 0., 0.)
+        self.p_value         = 1.0
+        self.lower           = -np.inf
+        self.upper           = np.inf
+
+    def update(self, x, y):
+        """
+        Adds a batch of observations and updates the running p-value and confidence interval.
+
+        Args:
+            x (array_like): new observations of the treatment group
+            y (array_like): new observations of the control group
+
+        Returns:
+            AlwaysValidTest: the updated state
+        """
+        self.treatment = statx.merge_sufficient_statistics(self.treatment, statx.sufficient_statistics(x))
+        self.control = statx.merge_sufficient_statistics(self.control, statx.sufficient_statistics(y))
+
+        n_x, mean_x, m2_x = self.treatment
+        n_y, mean_y, m2_y = self.control
+        if n_x < 2 or n_y < 2:
+            return self
+        variance = m2_x / n_x ** 2 + m2_y / n_y ** 2
+        if variance == 0:
+            return self
+        if self.mixing_variance is None:
+            self.mixing_variance = 0.01 * (m2_x + m2_y) / (n_x + n_y)
+
+        tau2 = self.mixing_variance
+        delta = mean_x - mean_y
+        log_likelihood_ratio = 0.5 * np.log(variance / (variance + tau2)) + \
+                               tau2 * delta ** 2 / (2 * variance * (variance + tau2))
+        self.p_value = min(self.p_value, float(np.exp(-max(log_likelihood_ratio, 0.))))
+
+        half_width = np.sqrt(2 * variance * (variance + tau2) / tau2 *
+                             (np.log(1. / self.alpha) + 0.5 * np.log((variance + tau2) / variance)))
+        self.lower = max(self.lower, delta - half_width)
+        self.upper = min(self.upper, delta + half_width)
+        return self
+
+    def to_dict(self):
+        """
+        Returns:
+            dict: JSON serializable state
+        """
+        return {'alpha'           : self.alpha,
+                'mixing_variance' : self.mixing_variance,
+                'treatment'       : list(self.treatment),
+                'control'         : list(self.control),
+                'p_value'         : self.p_value,
+                'lower'           : None if np.isinf(self.lower) else self.lower,
+                'upper'           : None if np.isinf(self.upper) else self.upper}
+
+    @classmethod
+    def from_dict(cls, state):
+        """
+        Args:
+            state (dict): state as returned by to_dict()
+
+        Returns:
+            AlwaysValidTest: the restored state
+        """
+        test = cls(state['alpha'], state['mixing_variance'])
+        test.treatment = tuple(state['treatment'])
+        test.control   = tuple(state['control'])
+        test.p_value   = state['p_value']
+        test.lower     = -np.inf if state['lower'] is None else state['lower']
+        test.upper     = np.inf if state['upper'] is None else state['upper']
+        return test
+
+
+def make_always_valid(alpha=0.05, mixing_variance=None, multi_test_correction=False, num_tests=1, state_store=None):
+    def f(x, y, key=None):
+        return always_valid(x, y, alpha, mixing_variance, multi_test_correction, num_tests, state_store, key)
+    return f
+
+
+def always_valid(x,
+                 y,
+                 alpha=0.05,
+                 mixing_variance=None,
+                 multi_test_correction=False,
+                 num_tests=1,
+                 state_store=None,
+                 key=None):
+    """
+    Always-valid sequential test on the difference of means, which may be evaluated after every
+    batch of data without inflating the type-I error.
+
+    Args:
+        x (array_like): sample of a treatment group
+        y (array_like): sample of a control group
+        alpha: type-I error rate
+        mixing_variance: variance of the normal mixture over the effect, see AlwaysValidTest
+        multi_test_correction (boolean): flag of whether the correction for multiple testing is needed
+        num_tests (integer): number of tests or reported kpis used for multiple correction
+        state_store (dict): maps keys to the serialized state of earlier evaluations; samples may only
+            grow by appending, so that only the observations beyond those seen before are added. If the
+            observations seen before changed, or alpha or mixing_variance differ, the state is started anew.
+        key: key of the analysed kpi and variant in state_store
+
+    Returns:
+        dict: early stopping statistics, with the always-valid p-value
+    """
+    if x is None or y is None:
+        raise ValueError('Please provide two non-None samples.')
+
+    _x = np.array(x, dtype=float)
+    _y = np.array(y, dtype=float)
+
+    if multi_test_correction:
+        alpha = alpha / num_tests
+
+    use_store = state_store is not None and key is not None
+    stored = state_store.get(key) if use_store else None
+    if _is_continuation(stored, _x, _y, alpha, mixing_variance):
+        test = AlwaysValidTest.from_dict(stored['state'])
+        test.update(_x[stored['treatment_rows']:], _y[stored['control_rows']:])
+    else:
+        test = AlwaysValidTest(alpha, mixing_variance).update(_x, _y)
+    if use_store:
+        state_store[key] = {'state'                 : test.to_dict(),
+                            'mixing_variance'       : mixing_variance,
+                            'treatment_rows'        : len(_x),
+                            'control_rows'          : len(_y),
+                            'treatment_fingerprint' : fingerprint(_x),
+                            'control_fingerprint'   : fingerprint(_y)}
+
+    n_x, mu_x, m2_x = test.treatment
+    n_y, mu_y, m2_y = test.control
+    interval = [{'percentile': alpha * 100 / 2,       'value': float(test.lower)},
+                {'percentile': 100 - alpha * 100 / 2, 'value': float(test.upper)}]
+    return {'stop'                  : bool(test.p_value < alpha),
             'delta'                 : float(mu_x - mu_y),
             'confidence_interval'   : interval,
+            'p_value'               : float(test.p_value),
             'treatment_sample_size' : int(n_x),
             'control_sample_size'   : int(n_y),
             'treatment_mean'        : float(mu_x),
             'control_mean'          : float(mu_y),
-            'treatment_variance'    : float(np.nanvar(_x)),
-            'control_variance'      : float(np.nanvar(_y))}
+            'treatment_variance'    : float(m2_x / n_x) if n_x else np.nan,
+            'control_variance'      : float(m2_y / n_y) if n_y else np.nan}
+
+
+def _is_continuation(stored, x, y, alpha, mixing_variance):
+    """ Whether the samples extend those of the stored state of always_valid under the same parameters. """
+    if stored is None:
+        return False
+    treatment_rows, control_rows = stored['treatment_rows'], stored['control_rows']
+    return (treatment_rows <= len(x) and control_rows <= len(y) and
+            stored['state']['alpha'] == alpha and stored.get('mixing_variance') == mixing_variance and
+            stored.get('treatment_fingerprint') == fingerprint(x[:treatment_rows]) and
+            stored.get('control_fingerprint') == fingerprint(y[:control_rows]))
 
 
 def HDI_from_MCMC(posterior_samples, credible_mass=0.95):
-    # Computes highest density interval from a sample of representative values,
-    # estimated as the shortest credible interval
-    # Takes Arguments posterior_samples (samples from posterior) and credible mass (normally .95)
-    # http://stackoverflow.com/questions/22284502/highest-posterior-density-region-and-central-credible-region
-    sorted_points = sorted(posterior_samples)
-    ciIdxInc = np.ceil(credible_mass * len(sorted_points)).astype('int')
-    nCIs = len(sorted_points) - ciIdxInc
-    ciWidth = [0] * nCIs
-    for i in range(0, nCIs):
-        ciWidth[i] = sorted_points[i + ciIdxInc] - sorted_points[i]
+    """
+    Computes the highest density interval from a sample of representative values,
+    estimated as the shortest credible interval.
+    http://stackoverflow.com/questions/22284502/highest-posterior-density-region-and-central-credible-region
+
+    Args:
+        posterior_samples (array_like): samples from the posterior, either a single trace of shape (draws,)
+            or several traces stacked along the first axes, e.g. (parameters, draws)
+        credible_mass (float or array_like): probability mass of the interval, normally .95;
+            several masses can be requested at once
+
+    Returns:
+        tuple (lower, upper) for a single trace and a single credible mass; otherwise an array
+        of shape posterior_samples.shape[:-1] + np.shape(credible_mass) + (2,)
+    """
+    sorted_points = np.sort(np.asarray(posterior_samples, dtype=float), axis=-1)
+    leading_shape = sorted_points.shape[:-1]
+    n = sorted_points.shape[-1]
+    sorted_points = sorted_points.reshape(-1, n)
+    rows = np.arange(sorted_points.shape[0])
+    masses = np.atleast_1d(credible_mass)
+
+    intervals = np.empty((sorted_points.shape[0], len(masses), 2))
+    for i, mass in enumerate(masses):
+        ciIdxInc = int(np.ceil(mass * n))
+        nCIs = n - ciIdxInc
+        # widths of all intervals covering ciIdxInc consecutive points, the first minimum wins
+        ciWidth = sorted_points[:, ciIdxInc:] - sorted_points[:, :nCIs]
+        minIdx = np.argmin(ciWidth, axis=1)
+        intervals[:, i, 0] = sorted_points[rows, minIdx]
+        intervals[:, i, 1] = sorted_points[rows, minIdx + ciIdxInc]
+    intervals = intervals.reshape(leading_shape + (len(masses), 2))
+
+    if np.ndim(credible_mass) == 0:
+        intervals = intervals[..., 0, :]
+        if intervals.ndim == 1:
+            return intervals[0], intervals[1]
+    return intervals
+
+
+def _scott_bandwidth(trace):
+    # the bandwidth scipy.stats.gaussian_kde uses for one-dimensional data
+    return np.std(trace, ddof=1) * len(trace) ** (-1. / 5)
+
+
+def _binned_kde_at_point(trace, point, grid_size=256):
+    """
+    Gaussian kernel density at a single point, with the draws within four bandwidths
+    of the point linearly binned onto a small grid; farther draws contribute less than exp(-8).
+    """
+    bandwidth = _scott_bandwidth(trace)
+    lower = point - 4 * bandwidth
+    upper = point + 4 * bandwidth
+    near = trace[(trace > lower) & (trace < upper)]
 
-    # ciWidth = np.zaeros(nCIs)
-    # ciWidth[:] = sorted_points[ciIdxInc:] - sorted_points
+    spacing = (upper - lower) / grid_size
+    positions = (near - lower) / spacing
+    indices = positions.astype(int)
+    weights = positions - indices
+    counts = np.bincount(indices, 1 - weights, minlength=grid_size + 1) + \
+             np.bincount(indices + 1, weights, minlength=grid_size + 2)[:grid_size + 1]
+    grid = lower + spacing * np.arange(grid_size + 1)
+    kernel = np.exp(-0.5 * ((point - grid) / bandwidth) ** 2)
+    return np.sum(counts * kernel) / (len(trace) * bandwidth * np.sqrt(2 * np.pi))
 
-    HDImin = sorted_points[ciWidth.index(min(ciWidth))]
-    HDImax = sorted_points[ciWidth.index(min(ciWidth)) + ciIdxInc]
-    return (HDImin, HDImax)
+
+def _histogram_at_point(trace, point):
+    """
+    Density at a single point estimated by the share of draws in a window of one bandwidth around it.
+    """
+    bandwidth = _scott_bandwidth(trace)
+    return np.count_nonzero(np.abs(trace - point) <= bandwidth) / (2. * bandwidth * len(trace))
+
+
+def density_at_point(trace, point=0., method='kde'):
+    """
+    Estimates the posterior density at a single point from MCMC draws, as needed for the
+    Savage-Dickey density ratio.
+
+    Args:
+        trace (array_like): posterior draws of a scalar parameter
+        point (float): point at which the density is evaluated
+        method: 'kde' for scipy's gaussian_kde, 'binned_kde' for a Gaussian kernel density with
+            the same bandwidth computed from the binned draws near the point (about three times
+            faster on 100k draws, relative error below 1e-3), or 'histogram' for the share of draws
+            within one bandwidth of the point (fastest, but biased where the density is curved)
+
+    Returns:
+        float: estimated density
+    """
+    _trace = np.asarray(trace, dtype=float)
+    if method == 'kde':
+        from scipy.stats import gaussian_kde
+        return gaussian_kde(_trace).evaluate(point)[0]
+    elif method == 'binned_kde':
+        return _binned_kde_at_point(_trace, point)
+    elif method == 'histogram':
+        return _histogram_at_point(_trace, point)
+    else:
+        raise NotImplementedError
 
 
 def get_or_compile_stan_model(model_file, distribution):
@@ -169,16 +739,289 @@ def get_or_compile_stan_model(model_file, distribution):
     if os.path.isfile(compiled_model_file):
         sm = pickle.load(open(compiled_model_file, 'rb'))
     else:
+        # PyStan is heavy to import and only needed by the Bayesian methods
+        from pystan import StanModel
         sm = StanModel(file=model_file)
         with open(compiled_model_file, 'wb') as f:
             pickle.dump(sm, f)
     return sm
 
 cache_sampling_results = False
-sampling_results = {} # memoized sampling results
+# memoized sampling results, keyed by a content hash of the samples and the sampling settings
+sampling_results = MemoCache(max_entries=64, max_bytes=512 * 1024 ** 2)
+
+
+def configure_sampling_cache(enabled=True, max_entries=64, max_bytes=512 * 1024 ** 2, cache_dir=None):
+    """
+    Enables or disables memoization of Bayesian sampling results and replaces the cache.
+
+    Args:
+        enabled (boolean): whether sampling results are memoized
+        max_entries (int): maximum number of sampling results kept in memory
+        max_bytes (int): maximum total size of the memoized traces in bytes
+        cache_dir (str): directory to persist sampling results in, None to keep them in memory only
+
+    Returns:
+        MemoCache: the new cache, whose stats() method reports hits and misses
+    """
+    global cache_sampling_results, sampling_results
+    cache_sampling_results = enabled
+    sampling_results = MemoCache(max_entries=max_entries, max_bytes=max_bytes, cache_dir=cache_dir)
+    return sampling_results
+
+
+# adaptation results of previous sampling runs, one store per warm start directory
+warm_start_stores = {}
+
+
+def effective_sample_size(draws):
+    """
+    Estimates the effective sample size of MCMC draws of a scalar parameter, following
+    the multi-chain estimator used by Stan (Geyer's initial monotone sequence).
+
+    Args:
+        draws (array_like): draws of shape (iterations, chains) or (iterations,)
+
+    Returns:
+        float: estimated number of effectively independent draws
+    """
+    _draws = np.array(draws, dtype=float)
+    if _draws.ndim == 1:
+        _draws = _draws.reshape(-1, 1)
+    n, m = _draws.shape
+    if n < 4:
+        return float(n * m)
+
+    # autocovariances of every chain via FFT
+    centered = _draws - _draws.mean(axis=0)
+    size = 2 ** int(np.ceil(np.log2(2 * n)))
+    transformed = np.fft.rfft(centered, n=size, axis=0)
+    acov = np.fft.irfft(transformed * np.conjugate(transformed), n=size, axis=0)[:n] / n
+
+    mean_var = (acov[0] * n / (n - 1.)).mean()
+    var_plus = mean_var * (n - 1.) / n
+    if m > 1:
+        var_plus += _draws.mean(axis=0).var(ddof=1)
+    if var_plus <= 0:
+        return float(n * m)
+
+    rho = 1. - (mean_var - acov.mean(axis=1)) / var_plus
+    rho[0] = 1.
+    half = len(rho) // 2
+    pair_sums = rho[0:2 * half:2] + rho[1:2 * half:2]
+    non_positive = np.where(pair_sums <= 0)[0]
+    if len(non_positive):
+        pair_sums = pair_sums[:non_positive[0]]
+    pair_sums = np.minimum.accumulate(pair_sums)
+
+    tau = max(-1. + 2. * pair_sums.sum(), 1. / np.log10(n * m))
+    return float(n * m / tau)
+
+
+def _get_warm_start_store(warm_start):
+    if warm_start is None or isinstance(warm_start, MemoCache):
+        return warm_start
+    if warm_start not in warm_start_stores:
+        warm_start_stores[warm_start] = MemoCache(max_entries=None, cache_dir=warm_start)
+    return warm_start_stores[warm_start]
+
+
+def _warm_start_state(fit, draws):
+    """
+    Collects the adaptation results and the last draw of every chain of a fit.
+
+    Args:
+        fit: PyStan StanFit4Model object
+        draws: unpermuted draws of the fit, of shape (iterations, chains, parameters)
+
+    Returns:
+        dict: step sizes, inverse metrics (if supported by the installed PyStan) and inits per chain
+    """
+    inits = []
+    for chain in range(draws.shape[1]):
+        last = _traces_from_draws(fit.flatnames, draws[-1:, chain:chain + 1])
+        inits.append(dict((name, float(values[0]) if values.ndim == 1 else values[0].tolist())
+                          for name, values in last.items() if name != 'lp__'))
+    state = {'inits': inits}
+    if hasattr(fit, 'get_stepsize'):
+        state['stepsize'] = [float(stepsize) for stepsize in fit.get_stepsize()]
+    if hasattr(fit, 'get_inv_metric'):
+        state['inv_metric'] = [np.array(inv_metric) for inv_metric in fit.get_inv_metric()]
+    return state
+
+
+def _warm_start_sampling_args(state, sampling_args):
+    """
+    Derives inits and adaptation hints of a sampling run from a previously stored state.
+    Chains are matched cyclically if the number of chains changed in between.
+    """
+    chains = sampling_args['chains']
+    warm_args = dict(sampling_args)
+    warm_args['init'] = [state['inits'][chain % len(state['inits'])] for chain in range(chains)]
+    control = dict(sampling_args['control'])
+    if 'stepsize' in state:
+        control['stepsize'] = float(np.mean(state['stepsize']))
+    if 'inv_metric' in state:
+        control['inv_metric'] = np.mean(state['inv_metric'], axis=0)
+    warm_args['control'] = control
+    return warm_args
+
+
+def _traces_from_draws(flatnames, draws):
+    """
+    Groups unpermuted draws by parameter like fit.extract(), e.g. the columns 'delta[1]' and 'delta[2]'
+    into draws of 'delta' of shape (draws, 2).
+
+    Args:
+        flatnames (list): names of the parameter columns of the draws, as in fit.flatnames
+        draws: draws of shape (iterations, chains, parameters), the column after the parameters being lp__
+
+    Returns:
+        dict: draws of all chains per parameter name
+    """
+    flat = draws.reshape(-1, draws.shape[2])
+    columns = OrderedDict()
+    for column, flatname in enumerate(flatnames):
+        name, _, index = flatname.partition('[')
+        index = tuple(int(i) - 1 for i in index.rstrip(']').split(',')) if index else ()
+        columns.setdefault(name, []).append((index, column))
+
+    traces = {}
+    for name, entries in columns.items():
+        shape = tuple(max(index[d] for index, _ in entries) + 1 for d in range(len(entries[0][0])))
+        values = np.empty((len(flat),) + shape)
+        for index, column in entries:
+            values[(slice(None),) + index] = flat[:, column]
+        traces[name] = values
+    if draws.shape[2] > len(flatnames):
+        traces['lp__'] = flat[:, len(flatnames)]
+    return traces
+
+
+def _adaptive_sampling(sm, fit_data, iterations, warmup, sampling_args, delta_names, target_ess=None,
+                       max_iters=None):
+    """
+    Samples the model and, if target_ess is given, continues the chains with more post-warmup iterations
+    until the smallest effective sample size of the deltas reaches it or max_iters iterations are used.
+    The continuation reuses the step sizes, inverse metrics and last draws of the chains instead of
+    repeating the warmup, and its draws are appended to the previous ones.
+
+    Args:
+        sm: compiled Stan model
+        fit_data (dict): data of the model
+        iterations: number of iterations of the first run per chain, including warmup
+        warmup: number of warmup iterations of the first run per chain
+        sampling_args (dict): further arguments of sm.sampling
+        delta_names (list): flat names of the parameters whose effective sample size is targeted
+        target_ess: target effective sample size, None to sample once
+        max_iters: upper bound of the total iterations per chain
+
+    Returns:
+        tuple: traces per parameter name, total number of iterations per chain, effective sample sizes
+            of the deltas and the last fit
+    """
+    fit = sm.sampling(data=fit_data, iter=iterations, warmup=warmup, **sampling_args)
+    draws = fit.extract(permuted=False)
+    continuations = 0
+    while True:
+        ess = [effective_sample_size(draws[:, :, fit.flatnames.index(name)]) for name in delta_names]
+        if target_ess is None or min(ess) >= target_ess or iterations >= max_iters:
+            break
+        # draw more post-warmup iterations, proportional to the missing effective sample size
+        post_warmup = int(np.ceil((iterations - warmup) * 1.1 * target_ess / max(min(ess), 1.)))
+        extra = min(max_iters, warmup + post_warmup) - iterations
+
+        continuations += 1
+        continuation_args = _warm_start_sampling_args(_warm_start_state(fit, draws), sampling_args)
+        continuation_args['control']['adapt_engaged'] = False
+        # another seed, so that the continued chains do not repeat the random numbers of the first run
+        continuation_args['seed'] = sampling_args['seed'] + continuations
+        fit = sm.sampling(data=fit_data, iter=extra, warmup=0, **continuation_args)
+        draws = np.concatenate([draws, fit.extract(permuted=False)])
+        iterations += extra
+
+    return _traces_from_draws(fit.flatnames, draws), iterations, ess, fit, draws
+
+
+def _read_elbo_trace(diagnostic_file):
+    """
+    Reads the ELBO per evaluation from the diagnostic file of variational inference.
+
+    Returns:
+        tuple: arrays of iterations and ELBO values
+    """
+    rows = []
+    with open(diagnostic_file) as f:
+        for line in f:
+            fields = line.strip().split(',')
+            if line.startswith('#') or len(fields) < 3:
+                continue
+            try:
+                rows.append((float(fields[0]), float(fields[2])))
+            except ValueError:
+                continue
+    # the first row is written before the optimization starts
+    rows = [row for row in rows if row[0] > 0]
+    if not rows:
+        return np.array([]), np.array([])
+    iterations, elbo = zip(*rows)
+    return np.array(iterations), np.array(elbo)
+
+
+def _variational_inference(sm, fit_data, num_iters=10000, tol_rel_obj=0.01, output_samples=1000,
+                           algorithm='meanfield'):
+    """
+    Approximates the posterior by automatic differentiation variational inference.
+
+    Args:
+        sm: compiled Stan model
+        fit_data (dict): data of the model
+        num_iters: maximum number of iterations of the optimization
+        tol_rel_obj: relative tolerance of the ELBO at which the optimization is deemed converged
+        output_samples: number of draws from the approximate posterior
+        algorithm: 'meanfield' or 'fullrank'
+
+    Returns:
+        tuple: traces keyed by parameter name and dict with information about the run
+    """
+    if algorithm not in ('meanfield', 'fullrank'):
+        raise NotImplementedError
+
+    handle, diagnostic_file = tempfile.mkstemp(suffix='.csv')
+    os.close(handle)
+    try:
+        start = time.time()
+        results_dict = sm.vb(data=fit_data, iter=num_iters, tol_rel_obj=tol_rel_obj, output_samples=output_samples,
+                             algorithm=algorithm, seed=1, diagnostic_file=diagnostic_file)
+        fit_time = time.time() - start
+        iterations, elbo = _read_elbo_trace(diagnostic_file)
+    finally:
+        os.remove(diagnostic_file)
+
+    traces = {}
+    for para_name, para_values in zip(results_dict['sampler_param_names'], results_dict['sampler_params']):
+        # the first value is the mean of the approximation, not a draw
+        traces[para_name] = np.array(para_values)[1:]
+
+    relative_change = None
+    if len(elbo) > 1:
+        relative_change = float(abs((elbo[-1] - elbo[-2]) / elbo[-1]))
+    converged = len(iterations) > 0 and iterations[-1] < num_iters
+    if not converged:
+        warnings.warn('Variational inference did not converge within {} iterations.'.format(num_iters))
+
+    info = {'number_of_iterations'  : int(iterations[-1]) if len(iterations) else num_iters,
+            'effective_sample_size' : None,
+            'fit_time'              : fit_time,
+            'elbo'                  : float(elbo[-1]) if len(elbo) else None,
+            'relative_elbo_change'  : relative_change,
+            'converged'             : bool(converged)}
+    return traces, info
 
 
-def _bayes_sampling(x, y, distribution='normal', num_iters=25000, inference="sampling"):
+def _bayes_sampling(x, y, distribution='normal', num_iters=25000, inference="sampling", num_chains=4, n_jobs=1,
+                    num_warmup=None, thin=1, target_ess=None, max_iters=None, warm_start=None, warm_start_key=None,
+                    tol_rel_obj=0.01, output_samples=1000, algorithm='meanfield'):
     """
     Helper function.
 
@@ -187,7 +1030,22 @@ def _bayes_sampling(x, y, distribution='normal', num_iters=25000, inference="sam
         y (array_like): sample of a control group
         distribution: name of the KPI distribution model, which assumes a
             Stan model file with the same name exists
-        num_iters: number of iterations of sampling
+        num_iters: number of iterations of sampling per chain, including warmup
+        inference: sampling or variational inference method for approximation the posterior
+        num_chains: number of Markov chains
+        n_jobs: number of processes the chains run in, -1 to use all cores
+        num_warmup: number of warmup iterations per chain, defaults to half of num_iters
+        thin: period for saving draws
+        target_ess: if given, the chains are continued with more post-warmup iterations
+            until the effective sample size of delta reaches this value
+        max_iters: upper bound of iterations per chain in the adaptive mode, defaults to 10 * num_iters
+        warm_start: directory (or MemoCache) in which the step sizes, inverse metrics and last draws
+            of the run are kept; if a previous run with the same warm_start_key is found there, its
+            results are used as inits and adaptation hints and the warmup is shortened to a fifth
+        warm_start_key (tuple): identifies the analysed samples across runs, e.g. (experiment, kpi, variant)
+        tol_rel_obj: relative tolerance of the ELBO at which variational inference is deemed converged
+        output_samples: number of draws from the approximate posterior of variational inference
+        algorithm: 'meanfield' or 'fullrank' approximation of variational inference
 
     Returns:
         tuple:
@@ -196,6 +1054,8 @@ def _bayes_sampling(x, y, distribution='normal', num_iters=25000, inference="sam
             - sample size of y
             - absolute mean of x
             - absolute mean of y
+            - dict with information about the inference run (number of iterations, effective sample size,
+              fit time and, for variational inference, the final ELBO and whether it converged)
     """
     # Checking if data was provided
     if x is None or y is None:
@@ -207,10 +1067,13 @@ def _bayes_sampling(x, y, distribution='normal', num_iters=25000, inference="sam
     _x = drop_nan(_x)
     _y = drop_nan(_y)
 
-    key = (str(_x), str(_y), num_iters, inference)
+    key = fingerprint(_x, _y, distribution, num_iters, inference, num_chains, num_warmup, thin, target_ess, max_iters,
+                      tol_rel_obj, output_samples, algorithm)
 
-    if cache_sampling_results and key in sampling_results:
-        return sampling_results[key]
+    if cache_sampling_results:
+        cached = sampling_results.get(key)
+        if cached is not None:
+            return cached
 
     mu_x = np.nanmean(_x)
     mu_y = np.nanmean(_y)
@@ -235,31 +1098,154 @@ def _bayes_sampling(x, y, distribution='normal', num_iters=25000, inference="sam
     sm = get_or_compile_stan_model(model_file, distribution)
 
     if inference == "sampling":
-        fit = sm.sampling(data=fit_data, iter=num_iters, chains=4, n_jobs=1, seed=1,
-                          control={'stepsize': 0.01, 'adapt_delta': 0.99})
-        traces = fit.extract()
+        warmup = num_iters // 2 if num_warmup is None else num_warmup
+        max_iters = max_iters or 10 * num_iters
+        iterations = num_iters
+        sampling_args = {'chains': num_chains, 'thin': thin, 'n_jobs': n_jobs, 'seed': 1,
+                         'control': {'stepsize': 0.01, 'adapt_delta': 0.99}}
+
+        store = _get_warm_start_store(warm_start)
+        state_key = None
+        if store is not None and warm_start_key is not None:
+            state_key = fingerprint(distribution, *warm_start_key)
+            state = store.get(state_key)
+            if state is not None:
+                # the previous run already adapted to a posterior that is close to the current one
+                sampling_args = _warm_start_sampling_args(state, sampling_args)
+                iterations -= warmup - warmup // 5
+                warmup = warmup // 5
+
+        start = time.time()
+        traces, iterations, ess, fit, draws = _adaptive_sampling(sm, fit_data, iterations, warmup, sampling_args,
+                                                                 ['delta'], target_ess, max_iters)
+
+        if state_key is not None:
+            store.put(state_key, _warm_start_state(fit, draws))
+
+        info = {'number_of_iterations'  : iterations,
+                'number_of_warmup'      : warmup,
+                'number_of_chains'      : num_chains,
+                'effective_sample_size' : ess[0],
+                'fit_time'              : time.time() - start}
 
     elif inference == "variational":
-        results_dict = sm.vb(data=fit_data, iter=10000)
-        traces = {}
-        for i in range(len(results_dict['sampler_param_names'])):
-            para_name = results_dict['sampler_param_names'][i]
-            para_values = np.array(results_dict['sampler_params'][i])
-            traces[para_name] = para_values
+        traces, info = _variational_inference(sm, fit_data, num_iters, tol_rel_obj, output_samples, algorithm)
+
+    else:
+        raise NotImplementedError
 
     if cache_sampling_results:
-        sampling_results[key] = (traces, n_x, n_y, mu_x, mu_y)
+        sampling_results.put(key, (traces, n_x, n_y, mu_x, mu_y, info))
 
-    return traces, n_x, n_y, mu_x, mu_y
+    return traces, n_x, n_y, mu_x, mu_y, info
 
 
-def make_bayes_factor(distribution='normal', num_iters=25000, inference='sampling'):
-    def f(x, y):
-        return bayes_factor(x, y, distribution, num_iters, inference)
+def _joint_fit_data(samples, distribution='normal'):
+    """
+    Stacks pairs of samples into the data of the joint Stan model, in which every entity
+    is labelled with the (1-based) index of its pair.
+
+    Args:
+        samples (list): pairs of treatment and control samples
+        distribution: name of the KPI distribution model
+
+    Returns:
+        tuple: data of the joint model and per pair the sample sizes and means of treatment and control
+    """
+    xs, ys, gt, gc, summaries = [], [], [], [], []
+    for k, (x, y) in enumerate(samples):
+        _x = drop_nan(np.array(x, dtype=float))
+        _y = drop_nan(np.array(y, dtype=float))
+        xs.append(_x)
+        ys.append(_y)
+        gt.append(np.full(len(_x), k + 1, dtype=int))
+        gc.append(np.full(len(_y), k + 1, dtype=int))
+        summaries.append((len(_x), len(_y), np.nanmean(_x), np.nanmean(_y)))
+
+    x = np.concatenate(xs)
+    y = np.concatenate(ys)
+    if distribution == 'poisson':
+        x = x.astype(int)
+        y = y.astype(int)
+    elif distribution != 'normal':
+        raise NotImplementedError
+
+    fit_data = {'K' : len(samples),
+                'Nc': len(y),
+                'Nt': len(x),
+                'gc': np.concatenate(gc),
+                'gt': np.concatenate(gt),
+                'x' : x,
+                'y' : y}
+    return fit_data, summaries
+
+
+def _bayes_sampling_joint(samples, distribution='normal', num_iters=25000, num_chains=4, n_jobs=1,
+                          num_warmup=None, thin=1, target_ess=None, max_iters=None):
+    """
+    Samples the posteriors of several pairs of samples, e.g. of all KPIs and variants of an experiment,
+    in a single run of a model with independent parameters per pair, so that compilation, start-up and
+    adaptation are paid once.
+
+    Args:
+        samples (list): pairs of treatment and control samples
+        distribution: name of the KPI distribution model, which assumes a
+            Stan model file with the same name and suffix '_joint' exists
+        num_iters: number of iterations of sampling per chain, including warmup
+        num_chains: number of Markov chains
+        n_jobs: number of processes the chains run in, -1 to use all cores
+        num_warmup: number of warmup iterations per chain, defaults to half of num_iters
+        thin: period for saving draws
+        target_ess: if given, the chains are continued with more post-warmup iterations
+            until the smallest effective sample size of the deltas reaches this value
+        max_iters: upper bound of iterations per chain in the adaptive mode, defaults to 10 * num_iters
+
+    Returns:
+        list: per pair, the tuple returned by _bayes_sampling
+    """
+    fit_data, summaries = _joint_fit_data(samples, distribution)
+
+    model_file = __location__ + '/../models/' + distribution + '_kpi_joint.stan'
+    sm = get_or_compile_stan_model(model_file, distribution + '_joint')
+
+    warmup = num_iters // 2 if num_warmup is None else num_warmup
+    max_iters = max_iters or 10 * num_iters
+    iterations = num_iters
+    sampling_args = {'chains': num_chains, 'thin': thin, 'n_jobs': n_jobs, 'seed': 1,
+                     'control': {'stepsize': 0.01, 'adapt_delta': 0.99}}
+
+    start = time.time()
+    traces, iterations, ess, _, _ = _adaptive_sampling(sm, fit_data, iterations, warmup, sampling_args,
+                                                       ['delta[{}]'.format(k + 1) for k in range(len(samples))],
+                                                       target_ess, max_iters)
+
+    fit_time = time.time() - start
+    results = []
+    for k, (n_x, n_y, mu_x, mu_y) in enumerate(summaries):
+        info = {'number_of_iterations'  : iterations,
+                'number_of_warmup'      : warmup,
+                'number_of_chains'      : num_chains,
+                'effective_sample_size' : ess[k],
+                'fit_time'              : fit_time}
+        traces_k = {name: values[:, k] for name, values in traces.items() if name != 'lp__'}
+        results.append((traces_k, n_x, n_y, mu_x, mu_y, info))
+    return results
+
+
+def make_bayes_factor(distribution='normal', num_iters=25000, inference='sampling', num_chains=4, n_jobs=1,
+                      num_warmup=None, thin=1, target_ess=None, max_iters=None, warm_start=None,
+                      density_estimator='kde', tol_rel_obj=0.01, output_samples=1000, algorithm='meanfield'):
+    def f(x, y, key=None):
+        return bayes_factor(x, y, distribution, num_iters, inference, num_chains=num_chains, n_jobs=n_jobs,
+                            num_warmup=num_warmup, thin=thin, target_ess=target_ess, max_iters=max_iters,
+                            warm_start=warm_start, warm_start_key=key, density_estimator=density_estimator,
+                            tol_rel_obj=tol_rel_obj, output_samples=output_samples, algorithm=algorithm)
     return f
 
 
-def bayes_factor(x, y, distribution='normal', num_iters=25000, inference='sampling'):
+def bayes_factor(x, y, distribution='normal', num_iters=25000, inference='sampling', num_chains=4, n_jobs=1,
+                 num_warmup=None, thin=1, target_ess=None, max_iters=None, warm_start=None, warm_start_key=None,
+                 density_estimator='kde', tol_rel_obj=0.01, output_samples=1000, algorithm='meanfield'):
     """
     Args:
         x (array_like): sample of a treatment group
@@ -268,19 +1254,76 @@ def bayes_factor(x, y, distribution='normal', num_iters=25000, inference='sampli
             Stan model file with the same name exists
         num_iters: number of iterations of bayes sampling
         inference: sampling or variational inference method for approximation the posterior
+        num_chains: number of Markov chains
+        n_jobs: number of processes the chains run in, -1 to use all cores
+        num_warmup: number of warmup iterations per chain, defaults to half of num_iters
+        thin: period for saving draws
+        target_ess: target effective sample size of delta for the adaptive mode, None to disable it
+        max_iters: upper bound of iterations per chain in the adaptive mode
+        warm_start: directory in which adaptation results are kept to warm-start later runs, None to disable it
+        warm_start_key (tuple): identifies the samples across runs, e.g. (experiment, kpi, variant)
+        density_estimator: method of density_at_point used for the posterior density at zero
+        tol_rel_obj: relative tolerance of the ELBO for variational inference
+        output_samples: number of draws from the approximate posterior of variational inference
+        algorithm: 'meanfield' or 'fullrank' approximation of variational inference
 
     Returns:
         dictionary with statistics
     """
-    traces, n_x, n_y, mu_x, mu_y = _bayes_sampling(x, y, distribution=distribution, num_iters=num_iters,
-                                                   inference=inference)
+    traces, n_x, n_y, mu_x, mu_y, info = _bayes_sampling(x, y, distribution=distribution, num_iters=num_iters,
+                                                         inference=inference, num_chains=num_chains, n_jobs=n_jobs,
+                                                         num_warmup=num_warmup, thin=thin, target_ess=target_ess,
+                                                         max_iters=max_iters, warm_start=warm_start,
+                                                         warm_start_key=warm_start_key, tol_rel_obj=tol_rel_obj,
+                                                         output_samples=output_samples, algorithm=algorithm)
+    return _bayes_factor_statistics(traces, n_x, n_y, mu_x, mu_y, info, distribution, density_estimator)
+
+
+def make_bayes_factor_joint(distribution='normal', num_iters=25000, num_chains=4, n_jobs=1, num_warmup=None,
+                            thin=1, target_ess=None, max_iters=None, density_estimator='kde'):
+    def f(samples):
+        return bayes_factor_joint(samples, distribution, num_iters, num_chains=num_chains, n_jobs=n_jobs,
+                                  num_warmup=num_warmup, thin=thin, target_ess=target_ess, max_iters=max_iters,
+                                  density_estimator=density_estimator)
+    return f
+
+
+def bayes_factor_joint(samples, distribution='normal', num_iters=25000, num_chains=4, n_jobs=1, num_warmup=None,
+                       thin=1, target_ess=None, max_iters=None, density_estimator='kde'):
+    """
+    Bayes factor of several pairs of samples from a single run of the joint model.
+
+    Args:
+        samples (list): pairs of treatment and control samples
+        distribution: name of the KPI distribution model
+        num_iters: number of iterations of bayes sampling
+        num_chains: number of Markov chains
+        n_jobs: number of processes the chains run in, -1 to use all cores
+        num_warmup: number of warmup iterations per chain, defaults to half of num_iters
+        thin: period for saving draws
+        target_ess: target of the smallest effective sample size of the deltas, None to disable it
+        max_iters: upper bound of iterations per chain in the adaptive mode
+        density_estimator: method of density_at_point used for the posterior density at zero
+
+    Returns:
+        list: dictionary with statistics per pair, as returned by bayes_factor
+    """
+    results = _bayes_sampling_joint(samples, distribution, num_iters, num_chains=num_chains, n_jobs=n_jobs,
+                                    num_warmup=num_warmup, thin=thin, target_ess=target_ess, max_iters=max_iters)
+    return [_bayes_factor_statistics(traces, n_x, n_y, mu_x, mu_y, info, distribution, density_estimator)
+            for traces, n_x, n_y, mu_x, mu_y, info in results]
+
+
+def _bayes_factor_statistics(traces, n_x, n_y, mu_x, mu_y, info, distribution, density_estimator='kde'):
+    """
+    Computes the Bayes factor statistics from the posterior samples of one pair of samples.
+    """
     trace_normalized_effect_size = get_trace_normalized_effect_size(distribution, traces)
     trace_absolute_effect_size = traces['delta']
 
-    kde = gaussian_kde(trace_normalized_effect_size)
     prior = cauchy.pdf(0, loc=0, scale=1)
     # BF_01
-    bf = kde.evaluate(0)[0] / prior
+    bf = density_at_point(trace_normalized_effect_size, 0, density_estimator) / prior
     stop = bf > 3 or bf < 1 / 3.
 
     credibleMass = 0.95                # another magic number
@@ -296,7 +1339,10 @@ def bayes_factor(x, y, distribution='normal', num_iters=25000, inference='sampli
             'control_sample_size'   : int(n_y),
             'treatment_mean'        : float(mu_x),
             'control_mean'          : float(mu_y),
-            'number_of_iterations'  : num_iters}
+            'number_of_iterations'  : info['number_of_iterations'],
+            'effective_sample_size' : info['effective_sample_size'],
+            'fit_time'              : info.get('fit_time'),
+            'converged'             : info.get('converged')}
 
 
 def get_trace_normalized_effect_size(distribution, traces):
@@ -309,13 +1355,21 @@ def get_trace_normalized_effect_size(distribution, traces):
         raise ValueError("model " + distribution + " is not implemented.")
 
 
-def make_bayes_precision(distribution='normal', posterior_width=0.08, num_iters=25000, inference='sampling'):
-    def f(x, y):
-        return bayes_precision(x, y, distribution, posterior_width, num_iters, inference)
+def make_bayes_precision(distribution='normal', posterior_width=0.08, num_iters=25000, inference='sampling',
+                         num_chains=4, n_jobs=1, num_warmup=None, thin=1, target_ess=None, max_iters=None,
+                         warm_start=None, tol_rel_obj=0.01, output_samples=1000, algorithm='meanfield'):
+    def f(x, y, key=None):
+        return bayes_precision(x, y, distribution, posterior_width, num_iters, inference, num_chains=num_chains,
+                               n_jobs=n_jobs, num_warmup=num_warmup, thin=thin, target_ess=target_ess,
+                               max_iters=max_iters, warm_start=warm_start, warm_start_key=key,
+                               tol_rel_obj=tol_rel_obj, output_samples=output_samples, algorithm=algorithm)
     return f
 
 
-def bayes_precision(x, y, distribution='normal', posterior_width=0.08, num_iters=25000, inference='sampling'):
+def bayes_precision(x, y, distribution='normal', posterior_width=0.08, num_iters=25000, inference='sampling',
+                    num_chains=4, n_jobs=1, num_warmup=None, thin=1, target_ess=None, max_iters=None,
+                    warm_start=None, warm_start_key=None, tol_rel_obj=0.01, output_samples=1000,
+                    algorithm='meanfield'):
     """
     Args:
         x (array_like): sample of a treatment group
@@ -326,12 +1380,69 @@ def bayes_precision(x, y, distribution='normal', posterior_width=0.08, num_iters
             width
         num_iters: number of iterations of bayes sampling
         inference: sampling or variational inference method for approximation the posterior
+        num_chains: number of Markov chains
+        n_jobs: number of processes the chains run in, -1 to use all cores
+        num_warmup: number of warmup iterations per chain, defaults to half of num_iters
+        thin: period for saving draws
+        target_ess: target effective sample size of delta for the adaptive mode, None to disable it
+        max_iters: upper bound of iterations per chain in the adaptive mode
+        warm_start: directory in which adaptation results are kept to warm-start later runs, None to disable it
+        warm_start_key (tuple): identifies the samples across runs, e.g. (experiment, kpi, variant)
+        tol_rel_obj: relative tolerance of the ELBO for variational inference
+        output_samples: number of draws from the approximate posterior of variational inference
+        algorithm: 'meanfield' or 'fullrank' approximation of variational inference
 
     Returns:
         dictionary with statistics
     """
-    traces, n_x, n_y, mu_x, mu_y = _bayes_sampling(x, y, distribution=distribution, num_iters=num_iters,
-                                                   inference=inference)
+    traces, n_x, n_y, mu_x, mu_y, info = _bayes_sampling(x, y, distribution=distribution, num_iters=num_iters,
+                                                         inference=inference, num_chains=num_chains, n_jobs=n_jobs,
+                                                         num_warmup=num_warmup, thin=thin, target_ess=target_ess,
+                                                         max_iters=max_iters, warm_start=warm_start,
+                                                         warm_start_key=warm_start_key, tol_rel_obj=tol_rel_obj,
+                                                         output_samples=output_samples, algorithm=algorithm)
+    return _bayes_precision_statistics(traces, n_x, n_y, mu_x, mu_y, info, distribution, posterior_width)
+
+
+def make_bayes_precision_joint(distribution='normal', posterior_width=0.08, num_iters=25000, num_chains=4,
+                               n_jobs=1, num_warmup=None, thin=1, target_ess=None, max_iters=None):
+    def f(samples):
+        return bayes_precision_joint(samples, distribution, posterior_width, num_iters, num_chains=num_chains,
+                                     n_jobs=n_jobs, num_warmup=num_warmup, thin=thin, target_ess=target_ess,
+                                     max_iters=max_iters)
+    return f
+
+
+def bayes_precision_joint(samples, distribution='normal', posterior_width=0.08, num_iters=25000, num_chains=4,
+                          n_jobs=1, num_warmup=None, thin=1, target_ess=None, max_iters=None):
+    """
+    Bayes precision of several pairs of samples from a single run of the joint model.
+
+    Args:
+        samples (list): pairs of treatment and control samples
+        distribution: name of the KPI distribution model
+        posterior_width: the stopping criterion, threshold of the posterior width
+        num_iters: number of iterations of bayes sampling
+        num_chains: number of Markov chains
+        n_jobs: number of processes the chains run in, -1 to use all cores
+        num_warmup: number of warmup iterations per chain, defaults to half of num_iters
+        thin: period for saving draws
+        target_ess: target of the smallest effective sample size of the deltas, None to disable it
+        max_iters: upper bound of iterations per chain in the adaptive mode
+
+    Returns:
+        list: dictionary with statistics per pair, as returned by bayes_precision
+    """
+    results = _bayes_sampling_joint(samples, distribution, num_iters, num_chains=num_chains, n_jobs=n_jobs,
+                                    num_warmup=num_warmup, thin=thin, target_ess=target_ess, max_iters=max_iters)
+    return [_bayes_precision_statistics(traces, n_x, n_y, mu_x, mu_y, info, distribution, posterior_width)
+            for traces, n_x, n_y, mu_x, mu_y, info in results]
+
+
+def _bayes_precision_statistics(traces, n_x, n_y, mu_x, mu_y, info, distribution, posterior_width=0.08):
+    """
+    Computes the Bayes precision statistics from the posterior samples of one pair of samples.
+    """
     trace_normalized_effect_size = get_trace_normalized_effect_size(distribution, traces)
     trace_absolute_effect_size = traces['delta']
 
@@ -340,8 +1451,8 @@ def bayes_precision(x, y, distribution='normal', posterior_width=0.08, num_iters
     p1           = round(leftOut/2.0, 5)
     p2           = round(1.0 - leftOut/2.0, 5)
 
-    credible_interval_delta            = HDI_from_MCMC(trace_absolute_effect_size, credibleMass)
-    credible_interval_delta_normalized = HDI_from_MCMC(trace_normalized_effect_size, credibleMass)
+    credible_interval_delta, credible_interval_delta_normalized = \
+        HDI_from_MCMC(np.vstack([trace_absolute_effect_size, trace_normalized_effect_size]), credibleMass)
 
     stop = credible_interval_delta_normalized[1] - credible_interval_delta_normalized[0] < posterior_width
 
@@ -352,4 +1463,7 @@ def bayes_precision(x, y, distribution='normal', posterior_width=0.08, num_iters
             'control_sample_size'   : int(n_y),
             'treatment_mean'        : float(mu_x),
             'control_mean'          : float(mu_y),
-            'number_of_iterations'  : num_iters}
+            'number_of_iterations'  : info['number_of_iterations'],
+            'effective_sample_size' : info['effective_sample_size'],
+            'fit_time'              : info.get('fit_time'),
+            'converged'             : info.get('converged')}
@@ -1,3 +1,4 @@
+import importlib
 import logging
 import re
 import warnings
@@ -5,11 +6,12 @@ import warnings
 import numpy as np
 import pandas as pd
 
-import expan.core.early_stopping as es
 import expan.core.statistics as statx
 from expan.core.util import get_column_names_by_type
 from expan.core.version import __version__
-from expan.core.binning import create_bins
+from expan.core.aggregated_experiment import AggregatedExperiment, grouped_statistics, segment_cells, \
+    subgroup_validity, summary_columns
+from expan.core.binning import BinSet, create_bins
 
 warnings.simplefilter('always', UserWarning)
 
@@ -23,7 +25,17 @@ class Experiment(object):
     """
     Class which adds the analysis functions to experimental data.
     """
-    def __init__(self, control_variant_name, data, metadata, report_kpi_names=None, derived_kpis=None):
+    def __init__(self, control_variant_name, data, metadata, report_kpi_names=None, derived_kpis=None, copy=True):
+        """
+        Args:
+            control_variant_name: name of the control variant
+            data (DataFrame): data of the entities with columns 'entity', 'variant' and the kpis
+            metadata (dict): metadata of the experiment
+            report_kpi_names (list): names of the kpis to analyse, by default all numerical columns
+            derived_kpis (list): dicts with the 'name' and 'formula' of derived kpis
+            copy (bool): if False, the experiment works on data itself instead of a copy, e.g. to keep
+                memory-mapped columns on disk; derived kpis are then added to data
+        """
         report_kpi_names = report_kpi_names or []
         derived_kpis = derived_kpis or []
 
@@ -65,7 +77,7 @@ class Experiment(object):
             if c not in data:
                 raise ValueError('No column %s provided'%c)
 
-        self.data                 =     data.copy()
+        self.data                 =     data.copy() if copy else data
         self.metadata             = metadata.copy()
         self.report_kpi_names     = report_kpi_names_needed
         self.derived_kpis         = derived_kpis
@@ -97,28 +109,57 @@ class Experiment(object):
         non_zeros      = len(x) - zeros_and_nans
         return non_zeros/np.nansum(x) * x
 
+    def _get_weighted_kpi(self, data, kpi, variant):
+        return self.get_kpi_by_name_and_variant(data, kpi, variant) * self._get_weights(data, kpi, variant)
+
     def delta(self, method='fixed_horizon', **worker_args):
         return self._delta(method=method, data=self.data, **worker_args)
 
-    def _delta(self, method, data, **worker_args):
+    def _delta(self, method, data, joint=False, **worker_args):
+        """
+        Args:
+            method: name of the analysis method
+            data: data frame of the experiment or of a subgroup
+            joint (boolean): if True, all kpis and variants are analysed in a single run of a joint model,
+                only for 'bayes_factor' and 'bayes_precision'
+            worker_args: arguments of the worker of the method
+
+        Returns:
+            dict: statistics per kpi and variant
+        """
         # entity should be unique
         if data.entity.duplicated().any():
             raise ValueError('Entities in data should be unique')
 
+        # worker factories are imported on first use, so that e.g. PyStan is only loaded for the Bayesian methods
         worker_table = {
-            'fixed_horizon'    : statx.make_delta,
-            'group_sequential' : es.make_group_sequential,
-            'bayes_factor'     : es.make_bayes_factor,
-            'bayes_precision'  : es.make_bayes_precision
+            'fixed_horizon'    : ('expan.core.statistics',     'make_delta'),
+            'group_sequential' : ('expan.core.early_stopping', 'make_group_sequential'),
+            'always_valid'     : ('expan.core.early_stopping', 'make_always_valid'),
+            'bayes_factor'     : ('expan.core.early_stopping', 'make_bayes_factor'),
+            'bayes_precision'  : ('expan.core.early_stopping', 'make_bayes_precision')
+        }
+        # workers analysing a list of pairs of samples at once
+        joint_worker_table = {
+            'bayes_factor'     : ('expan.core.early_stopping', 'make_bayes_factor_joint'),
+            'bayes_precision'  : ('expan.core.early_stopping', 'make_bayes_precision_joint')
         }
 
+        if joint:
+            worker_table = joint_worker_table
         if not method in worker_table:
             raise NotImplementedError
 
+        module_name, factory_name = worker_table[method]
+        make_worker = getattr(importlib.import_module(module_name), factory_name)
+
+        # workers of these methods get to know which kpi and variant they analyse, e.g. to warm-start sampling
+        keyed_methods = ('always_valid', 'bayes_factor', 'bayes_precision')
+
         if 'multi_test_correction' in worker_args:
             worker_args['num_tests'] = len(self.report_kpi_names)
 
-        worker = worker_table[method](**worker_args)
+        worker = make_worker(**worker_args)
 
         result = {'warnings': [],
                   'errors': [],
@@ -126,18 +167,33 @@ class Experiment(object):
                   'control_variant': self.control_variant_name}
         kpis = []
 
+        if joint:
+            # only the joint model needs the samples of all kpis and variants at once
+            pairs = [(kpi, variant) for kpi in self.report_kpi_names for variant in self.variant_names]
+            samples = [(self._get_weighted_kpi(data, kpi, variant),
+                        self._get_weighted_kpi(data, kpi, self.control_variant_name)) for kpi, variant in pairs]
+            with warnings.catch_warnings(record=True) as w:
+                joint_statistics = dict(zip(pairs, worker(samples)))
+            if len(w):
+                result['warnings'].append('joint model: {}'.format(w[-1].message))
+            del samples
+
         for kpi in self.report_kpi_names:
             res_kpi = {'name': kpi,
                        'variants': []}
-            control         = self.get_kpi_by_name_and_variant(data, kpi, self.control_variant_name)
-            control_weight  = self._get_weights(data, kpi, self.control_variant_name)
-            control_data    = control * control_weight
+            control_data = self._get_weighted_kpi(data, kpi, self.control_variant_name)
             for variant in self.variant_names:
-                treatment        = self.get_kpi_by_name_and_variant(data, kpi, variant)
-                treatment_weight = self._get_weights(data, kpi, variant)
-                treatment_data   = treatment * treatment_weight
+                treatment_data = self._get_weighted_kpi(data, kpi, variant)
+                worker_kwargs = {}
+                # the weights of derived kpis are renormalised over the whole sample, so that their earlier
+                # observations change with every new one and cannot be continued from a stored state
+                if method in keyed_methods and not (method == 'always_valid' and kpi in self.reference_kpis):
+                    worker_kwargs['key'] = (self.metadata.get('experiment'), kpi, variant)
                 with warnings.catch_warnings(record=True) as w:
-                    statistics = worker(x=treatment_data, y=control_data)
+                    if joint:
+                        statistics = joint_statistics[(kpi, variant)]
+                    else:
+                        statistics = worker(x=treatment_data, y=control_data, **worker_kwargs)
                     # add statistical power
                     power = statx.compute_statistical_power(treatment_data, control_data)
                     statistics['statistical_power'] = power
@@ -198,37 +254,82 @@ class Experiment(object):
 
         self.data = self.data[flags == False]
 
-    def sga(self, feature_name_to_bins, multi_test_correction=False):
+    def sga(self, feature_name_to_bins, multi_test_correction=False, min_observations=1, include_invalid=False):
         """
         Perform subgroup analysis.
         Args:
-            feature_name_to_bins (dict): a dict of feature name (key) to list of Bin objects (value). 
+            feature_name_to_bins (dict): a dict of feature name (key) to list of Bin objects or BinSet (value).
                                       This dict defines how and on which column to perform the subgroup split.
+                                      A tuple of feature names (key) with one list of Bin objects per feature
+                                      (value) defines the crossed subgroups of these features, e.g.
+                                      {('country', 'device'): [country_bins, device_bins]}.
             multi_test_correction (boolean): flag of whether the correction for multiple testing is needed.
+            min_observations (int): minimum number of entities of every variant for a subgroup to be analysed.
+            include_invalid (boolean): flag of whether subgroups that are not analysed are reported as well.
         Returns:
-            Analysis results per subgroup. 
+            Analysis results per subgroup. Crossed subgroups have the list of feature names as dimension
+            and the list of their bins as segment. The validity of every subgroup gives the number of entities
+            per variant and the reason why a subgroup was not analysed; only valid subgroups have a result.
         """
 
         for feature in feature_name_to_bins:
+            bins = feature_name_to_bins[feature]
             # check type
-            if type(feature) is not str:
-                raise TypeError("Key of the input dict needs to be string, indicating the name of dimension.")
-            if type(feature_name_to_bins[feature]) is not list:
-                raise TypeError("Value of the input dict needs to be a list of Bin objects.")
+            if type(feature) is tuple:
+                if len(feature) == 0 or any(type(name) is not str for name in feature):
+                    raise TypeError("Key of the input dict needs to be string, indicating the name of dimension, "
+                                    "or a tuple of such strings for crossed dimensions.")
+                if type(bins) not in (list, tuple) or len(bins) != len(feature) or \
+                        any(not isinstance(feature_bins, (list, BinSet)) for feature_bins in bins):
+                    raise TypeError("Value of crossed dimensions needs to be a list of lists of Bin objects "
+                                    "or BinSets, one per dimension.")
+                feature_names = feature
+            else:
+                if type(feature) is not str:
+                    raise TypeError("Key of the input dict needs to be string, indicating the name of dimension, "
+                                    "or a tuple of such strings for crossed dimensions.")
+                if not isinstance(bins, (list, BinSet)):
+                    raise TypeError("Value of the input dict needs to be a list of Bin objects or a BinSet.")
+                feature_names = [feature]
             # check whether data contains this column
-            if feature not in self.data:
-                raise KeyError("No column %s provided in data." % feature)
+            for name in feature_names:
+                if name not in self.data:
+                    raise KeyError("No column %s provided in data." % name)
+
+        variants = list(self.variant_names)
+        variant_codes = np.asarray(pd.Categorical(self.data.variant, categories=variants).codes)
 
         subgroups = []
         for feature in feature_name_to_bins:
-            for bin in feature_name_to_bins[feature]:
+            if type(feature) is tuple:
+                subgroups.extend(self._sga_crossed(feature, feature_name_to_bins[feature], multi_test_correction,
+                                                   min_observations, include_invalid))
+                continue
+            bins = feature_name_to_bins[feature]
+            # entities per bin and variant
+            if isinstance(bins, BinSet):
+                # the bins of a BinSet are disjoint, so that every entity is labelled with its bin at once
+                labels = bins.assign(self.data, feature)
+                binned = labels >= 0
+                counts = np.bincount(labels[binned] * len(variants) + variant_codes[binned],
+                                     minlength=len(bins) * len(variants)).reshape(len(bins), len(variants))
+                mask_of = lambda index: labels == index
+            else:
+                # one mask at a time, the masks of the valid bins are rebuilt when they are analysed
+                counts = np.array([np.bincount(variant_codes[bin.mask(self.data, feature)], minlength=len(variants))
+                                   for bin in bins])
+                mask_of = lambda index: bins[index].mask(self.data, feature)
+            for index, (bin, bin_counts) in enumerate(zip(bins, counts)):
                 subgroup = {'dimension': feature,
-                            'segment': str(bin.representation)}
-                subgroup_data = bin(self.data, feature)
+                            'segment': str(bin.representation),
+                            'validity': self._validity(dict(zip(variants, bin_counts)), min_observations)}
 
-                if not self._isValidForAnalysis(subgroup_data):
+                if not subgroup['validity']['valid']:
+                    if include_invalid:
+                        subgroups.append(subgroup)
                     continue
 
+                subgroup_data = self.data[mask_of(index)]
                 subgroup_res = self._delta(method='fixed_horizon', data=subgroup_data,
                                            multi_test_correction=multi_test_correction)
                 subgroup['result'] = subgroup_res
@@ -236,6 +337,43 @@ class Experiment(object):
 
         return subgroups
 
+    def _sga_crossed(self, features, feature_bins, multi_test_correction=False, min_observations=1,
+                     include_invalid=False):
+        """
+        Perform subgroup analysis on all cells of crossed features with the fixed horizon method.
+        Every entity is labelled with the cell of its bins, and the sufficient statistics of all cells,
+        variants and kpis are aggregated in a single grouped reduction, so that no subgroup data frame
+        is materialized. Cells with too few entities of some variant are skipped, like in sga.
+
+        The bins of a feature should be disjoint; an entity in several bins of a feature belongs to the first.
+
+        Args:
+            features (tuple): names of the crossed features
+            feature_bins (list): a list of Bin objects per feature
+            multi_test_correction (boolean): flag of whether the correction for multiple testing is needed.
+            min_observations (int): minimum number of entities of every variant for a cell to be analysed.
+            include_invalid (boolean): flag of whether all other cells of the cross are reported as well.
+
+        Returns:
+            list: analysis results per cell
+        """
+        data = self.data
+        if data.entity.duplicated().any():
+            raise ValueError('Entities in data should be unique')
+
+        columns = summary_columns(data, self.report_kpi_names, self.reference_kpis)
+        variants = data.variant.values
+        binned, cells = segment_cells(data, features, feature_bins)
+        cell_columns = dict((name, values[binned]) for name, values in columns.items())
+
+        aggregated = AggregatedExperiment(
+            self.control_variant_name, grouped_statistics(columns, variants), self.metadata,
+            self.report_kpi_names, self.reference_kpis,
+            {features: (feature_bins, grouped_statistics(cell_columns, [cells, variants[binned]]))})
+        # report the variants in the order of this experiment
+        aggregated.variant_names = self.variant_names
+        return aggregated.sga(multi_test_correction, min_observations, include_invalid)
+
     def _isValidForAnalysis(self, df):
         """
         Check whether the quality of data is good enough to perform analysis.
@@ -246,10 +384,18 @@ class Experiment(object):
         """
         if df is None:
             return False
-        for variant_name in self.variant_names:
-            if len(df[df["variant"] == variant_name]) < 1:
-                return False
-        return True
+        sample_sizes = df["variant"].value_counts()
+        return self._validity(dict((variant, sample_sizes.get(variant, 0)) for variant in self.variant_names),
+                              min_observations=1)['valid']
+
+    def _validity(self, sample_sizes, min_observations):
+        """
+        Check whether a subgroup has enough entities of every variant to perform analysis.
+        :param sample_sizes: dict of variant name to the number of entities of the subgroup in this variant
+        :param min_observations: minimum number of entities of every variant
+        :return: dict of whether the subgroup is valid, its sample sizes and the reason if it is not valid
+        """
+        return subgroup_validity(sample_sizes, min_observations)
 
     def sga_date(self, multi_test_correction=False):
         """
@@ -0,0 +1,234 @@
+"""Simulation of the operating characteristics of early-stopping methods.
+
+The group sequential rules are evaluated for many synthetic experiments at once: per look, only
+the sufficient statistics of the newly arriving entities are drawn, and decisions across all
+simulations and looks are made in vectorized form. The Bayesian rules need the full samples and
+run one simulated experiment per task in a process pool.
+"""
+
+import multiprocessing
+
+import numpy as np
+from scipy.stats import norm
+
+import expan.core.early_stopping as es
+
+
+def _look_sizes(sample_sizes, treatment_share):
+    """
+    Cumulative treatment and control sizes at every look.
+    """
+    sample_sizes = np.array(sample_sizes, dtype=int)
+    if len(sample_sizes) == 0 or np.any(np.diff(sample_sizes) <= 0):
+        raise ValueError('Sample sizes of the looks should be increasing.')
+    n_x = np.round(sample_sizes * treatment_share).astype(int)
+    n_y = sample_sizes - n_x
+    if n_x[0] < 2 or n_y[0] < 2:
+        raise ValueError('Every variant needs at least two entities at the first look.')
+    return n_x, n_y
+
+
+def _simulate_cumulative_statistics(n, mean, std, n_simulations, random_state):
+    """
+    Draws the cumulative mean and variance (ddof=0) of normally distributed samples growing to the
+    given sizes, for n_simulations experiments at once.
+
+    Returns:
+        tuple: two arrays of shape (n_simulations, looks)
+    """
+    batch = np.diff(np.concatenate([[0], n]))
+    # mean and sum of squared deviations of every batch of new entities
+    batch_mean = random_state.normal(mean, std / np.sqrt(batch), size=(n_simulations, len(batch)))
+    batch_m2 = std ** 2 * random_state.chisquare(np.maximum(batch - 1, 1), size=(n_simulations, len(batch)))
+    batch_m2[:, batch == 1] = 0.
+
+    cumulative_sum = np.cumsum(batch * batch_mean, axis=1)
+    cumulative_mean = cumulative_sum / n
+    # pooled sum of squared deviations: within-batch plus between-batch parts
+    cumulative_m2 = np.cumsum(batch_m2 + batch * batch_mean ** 2, axis=1) - n * cumulative_mean ** 2
+    return cumulative_mean, np.maximum(cumulative_m2, 0.) / n
+
+
+def group_sequential_bounds(sample_sizes, estimated_sample_size=None, spending_function='obrien_fleming',
+                            alpha=0.05, cap=8, planned=False, futility=False, power=0.8):
+    """
+    Efficacy (and futility) bounds of the z-score at every look.
+
+    Args:
+        sample_sizes (list): cumulative number of entities at every look
+        estimated_sample_size: sample size to be achieved towards the end of experiment,
+            defaults to the sample size of the last look
+        spending_function: name of the alpha spending function
+        alpha: type-I error rate
+        cap: upper bound of the adapted z-score
+        planned (boolean): if True, the bounds of a GroupSequentialDesign with the looks as planned
+            looks are used; otherwise every look spends alpha on its own, as group_sequential does
+            without a design
+        futility (boolean): whether futility bounds are used, only for planned designs
+        power: power of the design the futility bounds are computed for
+
+    Returns:
+        tuple: arrays of efficacy bounds, nominal alpha and futility bounds (None without futility)
+    """
+    sample_sizes = np.array(sample_sizes, dtype=float)
+    estimated_sample_size = estimated_sample_size or sample_sizes[-1]
+    fractions = np.minimum(1.0, sample_sizes / estimated_sample_size)
+
+    if planned:
+        design = es.get_group_sequential_design(tuple(fractions), alpha, spending_function, futility, power, cap)
+        return design.efficacy_bounds, design.nominal_alpha, design.futility_bounds
+
+    if futility:
+        raise ValueError('Futility bounds are only available for planned designs.')
+    nominal_alpha = np.array([es._get_spending_function(spending_function)(t, alpha=alpha) for t in fractions])
+    bounds = norm.ppf(1 - nominal_alpha / 2)
+    bounds[np.isinf(bounds)] = cap
+    return bounds, nominal_alpha, None
+
+
+def simulate_group_sequential(sample_sizes, effect=0., control_mean=0., std=1., treatment_share=0.5,
+                              n_simulations=10000, estimated_sample_size=None, spending_function='obrien_fleming',
+                              alpha=0.05, cap=8, planned=False, futility=False, power=0.8, seed=None):
+    """
+    Simulates experiments with normally distributed KPIs that are analysed with the group sequential
+    method at every look, and stop at the first look whose z-score crosses a bound.
+
+    Args:
+        sample_sizes (list): cumulative number of entities at every look, e.g. the expected traffic per day
+        effect: true difference of the means of treatment and control
+        control_mean: true mean of the control group
+        std: true standard deviation of the KPI in both groups
+        treatment_share: share of the entities assigned to treatment
+        n_simulations: number of simulated experiments
+        estimated_sample_size: sample size to be achieved towards the end of experiment,
+            defaults to the sample size of the last look
+        spending_function: name of the alpha spending function
+        alpha: type-I error rate
+        cap: upper bound of the adapted z-score
+        planned (boolean): whether the bounds of a planned GroupSequentialDesign are used
+        futility (boolean): whether futility bounds are used, only for planned designs
+        power: power of the design the futility bounds are computed for
+        seed: seed of the random number generator
+
+    Returns:
+        dict: share of simulations rejecting the null hypothesis (the type-I error if effect is 0,
+            the power otherwise), stopping for futility, stopping at every look, and expected
+            sample size and look at stopping
+    """
+    random_state = np.random.RandomState(seed)
+    n_x, n_y = _look_sizes(sample_sizes, treatment_share)
+    bounds, _, futility_bounds = group_sequential_bounds(n_x + n_y, estimated_sample_size, spending_function,
+                                                         alpha, cap, planned, futility, power)
+
+    mean_x, var_x = _simulate_cumulative_statistics(n_x, control_mean + effect, std, n_simulations, random_state)
+    mean_y, var_y = _simulate_cumulative_statistics(n_y, control_mean, std, n_simulations, random_state)
+    z = (mean_x - mean_y) / np.sqrt(var_x / n_x + var_y / n_y)
+
+    efficacy = np.abs(z) > bounds
+    if futility_bounds is not None:
+        stops_for_futility = np.abs(z) < futility_bounds
+    else:
+        stops_for_futility = np.zeros_like(efficacy)
+    stops = efficacy | stops_for_futility
+    # index of the first look with a decision, the last look if there is none
+    looks = len(bounds)
+    stopped = stops.any(axis=1)
+    stop_look = np.where(stopped, stops.argmax(axis=1), looks - 1)
+    rejected = efficacy[np.arange(n_simulations), stop_look]
+
+    total = n_x + n_y
+    return {'rejection_rate'         : float(np.mean(rejected)),
+            'futility_rate'          : float(np.mean(stopped & ~rejected)),
+            'stopping_probabilities' : (np.bincount(stop_look[stopped], minlength=looks) /
+                                        float(n_simulations)).tolist(),
+            'expected_sample_size'   : float(np.mean(total[stop_look])),
+            'expected_stopping_look' : float(np.mean(stop_look + 1)),
+            'bounds'                 : bounds.tolist()}
+
+
+def operating_characteristics(sample_sizes, effect, **kwargs):
+    """
+    Type-I error, power and expected stopping time of the group sequential method.
+
+    Args:
+        sample_sizes (list): cumulative number of entities at every look
+        effect: difference of the means under the alternative hypothesis
+        kwargs: further arguments of simulate_group_sequential
+
+    Returns:
+        dict: type_I_error, power and the expected sample sizes under both hypotheses
+    """
+    null = simulate_group_sequential(sample_sizes, effect=0., **kwargs)
+    alternative = simulate_group_sequential(sample_sizes, effect=effect, **kwargs)
+    return {'type_I_error'                      : null['rejection_rate'],
+            'power'                             : alternative['rejection_rate'],
+            'expected_sample_size_null'         : null['expected_sample_size'],
+            'expected_sample_size_alternative'  : alternative['expected_sample_size'],
+            'stopping_probabilities_null'       : null['stopping_probabilities'],
+            'stopping_probabilities_alternative': alternative['stopping_probabilities']}
+
+
+def _simulate_bayesian_experiment(args):
+    """
+    Runs one simulated experiment with a Bayesian stopping rule; a module level function so that
+    it can be sent to worker processes.
+    """
+    method, worker_args, n_x, n_y, effect, control_mean, std, seed = args
+    random_state = np.random.RandomState(seed)
+    x = random_state.normal(control_mean + effect, std, size=n_x[-1])
+    y = random_state.normal(control_mean, std, size=n_y[-1])
+
+    worker = {'bayes_factor': es.make_bayes_factor, 'bayes_precision': es.make_bayes_precision}[method](**worker_args)
+    for look in range(len(n_x)):
+        res = worker(x[:n_x[look]], y[:n_y[look]])
+        if res['stop'] or look == len(n_x) - 1:
+            bounds = [ci['value'] for ci in res['confidence_interval']]
+            return look, bool(res['stop']), min(bounds) > 0 or max(bounds) < 0
+
+
+def simulate_bayesian(sample_sizes, method='bayes_factor', effect=0., control_mean=0., std=1., treatment_share=0.5,
+                      n_simulations=100, processes=None, seed=None, **worker_args):
+    """
+    Simulates experiments with normally distributed KPIs that are analysed with a Bayesian stopping rule
+    at every look. Simulated experiments are distributed over a process pool.
+
+    Args:
+        sample_sizes (list): cumulative number of entities at every look
+        method: 'bayes_factor' or 'bayes_precision'
+        effect: true difference of the means of treatment and control
+        control_mean: true mean of the control group
+        std: true standard deviation of the KPI in both groups
+        treatment_share: share of the entities assigned to treatment
+        n_simulations: number of simulated experiments
+        processes: number of worker processes, defaults to the number of cores
+        seed: seed from which the seeds of the simulated experiments are derived
+        worker_args: arguments of the worker, e.g. num_iters
+
+    Returns:
+        dict: share of simulations stopping early, with a credible interval excluding zero at
+            stopping, stopping at every look, and expected sample size at stopping
+    """
+    if method not in ('bayes_factor', 'bayes_precision'):
+        raise NotImplementedError
+    n_x, n_y = _look_sizes(sample_sizes, treatment_share)
+    # chains run in the pool's processes already
+    worker_args.setdefault('n_jobs', 1)
+    seeds = np.random.RandomState(seed).randint(0, 2 ** 31 - 1, size=n_simulations)
+    tasks = [(method, worker_args, n_x, n_y, effect, control_mean, std, s) for s in seeds]
+
+    pool = multiprocessing.Pool(processes)
+    try:
+        outcomes = pool.map(_simulate_bayesian_experiment, tasks)
+    finally:
+        pool.close()
+        pool.join()
+
+    looks = np.array([outcome[0] for outcome in outcomes])
+    stopped = np.array([outcome[1] for outcome in outcomes])
+    excludes_zero = np.array([outcome[2] for outcome in outcomes])
+    total = n_x + n_y
+    return {'stopping_rate'          : float(np.mean(stopped)),
+            'rejection_rate'         : float(np.mean(excludes_zero)),
+            'stopping_probabilities' : (np.bincount(looks[stopped], minlength=len(total)) /
+                                        float(n_simulations)).tolist(),
+            'expected_sample_size'   : float(np.mean(total[looks]))}
@@ -113,6 +113,66 @@ def delta(x, y, assume_normal=True, percentiles=[2.5, 97.5],
             'control_variance'      : float(np.nanvar(_y))}
 
 
+def make_delta_from_statistics(assume_normal=True, percentiles=[2.5, 97.5], min_observations=20, relative=False,
+                               multi_test_correction=False, num_tests=1):
+    """ a closure to the below delta_from_statistics function, taking the statistics (n, mean, M2) of both samples """
+    if not assume_normal:
+        raise NotImplementedError('Bootstrapping requires the samples, not only their sufficient statistics.')
+
+    def f(x, y):
+        return delta_from_statistics(x[0], x[1], x[2], y[0], y[1], y[2], percentiles, min_observations,
+                                     relative, multi_test_correction, num_tests)
+
+    return f
+
+
+def delta_from_statistics(n_x, mean_x, m2_x, n_y, mean_y, m2_y, percentiles=[2.5, 97.5],
+                          min_observations=20, relative=False, multi_test_correction=False, num_tests=1):
+    """
+    Calculates the difference of means between two samples (x-y) under the normal
+    assumption, like delta, from the sufficient statistics of the samples.
+
+    Args:
+        n_x (integer): size of the treatment sample without nans
+        mean_x (float): mean of the treatment sample
+        m2_x (float): sum of squared deviations from the mean of the treatment sample
+        n_y (integer): size of the control sample without nans
+        mean_y (float): mean of the control sample
+        m2_y (float): sum of squared deviations from the mean of the control sample
+        percentiles (list): list of percentile values for confidence bounds
+        min_observations (integer): minimum number of observations needed
+        relative (boolean): if relative==True, then the confidence bounds are returned
+            as distances below and above the mean, see delta
+        multi_test_correction (boolean): flag of whether the correction for multiple testing is needed.
+        num_tests (integer): number of tests or reported kpis used for multiple correction.
+
+    Returns:
+        dict: the statistics delta returns
+    """
+    var_x = m2_x / float(n_x) if n_x > 0 else np.nan
+    var_y = m2_y / float(n_y) if n_y > 0 else np.nan
+
+    if min(n_x, n_y) < min_observations:
+        mu = np.nan
+        c_i = dict(list(zip(percentiles, np.empty(len(percentiles)) * np.nan)))
+    else:
+        mu = mean_x - mean_y
+        c_i = normal_difference(mean1=mean_x, std1=np.sqrt(var_x), n1=n_x, mean2=mean_y, std2=np.sqrt(var_y),
+                                n2=n_y, percentiles=percentiles, relative=relative,
+                                multi_test_correction=multi_test_correction, num_tests=num_tests)
+
+    c_i = [{'percentile': p, 'value': v} for (p, v) in c_i.items()]
+
+    return {'delta'                 : float(mu),
+            'confidence_interval'   : c_i,
+            'treatment_sample_size' : int(n_x),
+            'control_sample_size'   : int(n_y),
+            'treatment_mean'        : float(mean_x) if n_x > 0 else np.nan,
+            'control_mean'          : float(mean_y) if n_y > 0 else np.nan,
+            'treatment_variance'    : float(var_x),
+            'control_variance'      : float(var_y)}
+
+
 def sample_size(x):
     """
     Calculates sample size of a sample x
@@ -137,6 +197,49 @@ def sample_size(x):
     return len(x) - x_nan
 
 
+def sufficient_statistics(x):
+    """
+    Calculates the sufficient statistics of a numerical sample for normal-theory tests.
+
+    Args:
+        x (array_like): sample, nans are ignored
+
+    Returns:
+        tuple: sample size, mean and sum of squared deviations from the mean
+    """
+    _x = np.array(x, dtype=float)
+    _x = _x[~np.isnan(_x)]
+    if len(_x) == 0:
+        return 0, 0., 0.
+    mean = _x.mean()
+    return len(_x), float(mean), float(((_x - mean) ** 2).sum())
+
+
+def merge_sufficient_statistics(stats1, stats2):
+    """
+    Combines the sufficient statistics of two disjoint samples (Chan et al.), so that samples
+    can be summarised batch by batch. Works elementwise on arrays of statistics as well.
+
+    Args:
+        stats1 (tuple): sample size, mean and sum of squared deviations of the first sample
+        stats2 (tuple): sample size, mean and sum of squared deviations of the second sample
+
+    Returns:
+        tuple: sample size, mean and sum of squared deviations of the combined sample
+    """
+    n1, mean1, m2_1 = stats1
+    n2, mean2, m2_2 = stats2
+    n = n1 + n2
+    with np.errstate(invalid='ignore', divide='ignore'):
+        weight = np.where(n > 0, np.true_divide(n2, n), 0.)
+    diff = np.subtract(mean2, mean1)
+    mean = mean1 + diff * weight
+    m2 = m2_1 + m2_2 + diff ** 2 * n1 * weight
+    if np.ndim(mean) == 0:
+        return n, float(mean), float(m2)
+    return n, mean, m2
+
+
 def estimate_sample_size(x, mde, r, alpha=0.05, beta=0.2):
     """
     Estimates sample size based on sample mean and variance given MDE (Minimum Detectable effect), number of variants and variant split ratio
@@ -560,6 +663,27 @@ def compute_statistical_power(x, y, alpha=0.05):
     return _get_power(mean1, std1, n1, mean2, std2, n2, z_1_minus_alpha)
 
 
+def statistical_power_from_statistics(n_x, mean_x, m2_x, n_y, mean_y, m2_y, alpha=0.05):
+    """
+    Compute statistical power from the sufficient statistics of the samples.
+    Args:
+        n_x (integer): size of the treatment sample without nans
+        mean_x (float): mean of the treatment sample
+        m2_x (float): sum of squared deviations from the mean of the treatment sample
+        n_y (integer): size of the control sample without nans
+        mean_y (float): mean of the control sample
+        m2_y (float): sum of squared deviations from the mean of the control sample
+        alpha: Type I error (false positive rate)
+
+    Returns:
+        float: statistical power, see compute_statistical_power
+    """
+    z_1_minus_alpha = stats.norm.ppf(1 - alpha/2.)
+    std1 = np.sqrt(m2_x / float(n_x)) if n_x > 0 else np.nan
+    std2 = np.sqrt(m2_y / float(n_y)) if n_y > 0 else np.nan
+    return _get_power(mean_x, std1, n_x, mean_y, std2, n_y, z_1_minus_alpha)
+
+
 def _get_power(mean1, std1, n1, mean2, std2, n2, z_1_minus_alpha):
     """
     Compute statistical power.
@@ -1,3 +1,8 @@
+import hashlib
+import os
+import pickle
+import sys
+from collections import OrderedDict
 from warnings import warn
 
 import numpy as np
@@ -12,7 +17,8 @@ def is_number_and_nan(obj):
     return obj != obj
 
 def get_column_names_by_type(df, dtype):
-    return [c for c in df.columns if np.issubdtype(df.dtypes[c], dtype)]
+    # pandas extension dtypes such as categoricals are not numpy dtypes, select_dtypes would copy the frame
+    return [c for c, t in zip(df.columns, df.dtypes) if isinstance(t, np.dtype) and np.issubdtype(t, dtype)]
 
 def drop_nan(np_array):
     if np_array.ndim == 1:
@@ -21,6 +27,170 @@ def drop_nan(np_array):
         return np_array[~np.isnan(np_array).any(axis=1)]
 
 
+def fingerprint(*items):
+    """
+    Computes a content hash of the given arrays and scalars.
+
+    Arrays are hashed over their raw bytes together with dtype and shape, so two arrays
+    only share a fingerprint if they hold the same values. Other items are hashed via repr().
+
+    Args:
+        items: numpy arrays, lists or scalars to be hashed
+
+    Returns:
+        str: hex digest identifying the items
+    """
+    digest = hashlib.sha1()
+    for item in items:
+        if isinstance(item, (np.ndarray, list, pd.Series)):
+            array = np.ascontiguousarray(item)
+            if array.dtype == object:
+                digest.update(repr(array.tolist()).encode('utf-8'))
+            else:
+                digest.update(str(array.dtype).encode('utf-8'))
+                digest.update(str(array.shape).encode('utf-8'))
+                digest.update(array.tobytes())
+        else:
+            digest.update(repr(item).encode('utf-8'))
+        digest.update(b'|')
+    return digest.hexdigest()
+
+
+def nbytes(obj):
+    """
+    Estimates the memory footprint of an object, counting numpy arrays by their buffer size
+    and descending into dicts, lists and tuples.
+
+    Args:
+        obj: object to be measured
+
+    Returns:
+        int: approximate size in bytes
+    """
+    if isinstance(obj, np.ndarray):
+        return obj.nbytes
+    if isinstance(obj, dict):
+        return sum(nbytes(k) + nbytes(v) for k, v in obj.items())
+    if isinstance(obj, (list, tuple)):
+        return sum(nbytes(v) for v in obj)
+    return sys.getsizeof(obj)
+
+
+class MemoCache(object):
+    """
+    Least-recently-used memoization store bounded by number of entries and by bytes,
+    with optional persistence of the entries as pickle files in a directory.
+    """
+    def __init__(self, max_entries=128, max_bytes=None, cache_dir=None):
+        """
+        Args:
+            max_entries (int): maximum number of entries kept in memory, None for no limit
+            max_bytes (int): maximum total size of the entries kept in memory, None for no limit
+            cache_dir (str): directory for on-disk persistence, None to keep entries in memory only
+        """
+        self.max_entries = max_entries
+        self.max_bytes   = max_bytes
+        self.cache_dir   = cache_dir
+        self.hits        = 0
+        self.misses      = 0
+        self._entries    = OrderedDict()
+        self._sizes      = {}
+        self._total_bytes = 0
+
+        if cache_dir is not None and not os.path.isdir(cache_dir):
+            os.makedirs(cache_dir)
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, key):
+        path = self._disk_path(key)
+        return key in self._entries or (path is not None and os.path.isfile(path))
+
+    def _disk_path(self, key):
+        if self.cache_dir is None:
+            return None
+        return os.path.join(self.cache_dir, str(key) + '.pkl')
+
+    def get(self, key, default=None):
+        """
+        Looks up an entry in memory and then on disk, counting hits and misses.
+
+        Args:
+            key (str): key of the entry
+            default: value returned on a miss
+
+        Returns:
+            the cached value or default
+        """
+        if key in self._entries:
+            value = self._entries.pop(key)
+            self._entries[key] = value
+            self.hits += 1
+            return value
+
+        path = self._disk_path(key)
+        if path is not None and os.path.isfile(path):
+            with open(path, 'rb') as f:
+                value = pickle.load(f)
+            self._insert(key, value)
+            self.hits += 1
+            return value
+
+        self.misses += 1
+        return default
+
+    def put(self, key, value):
+        """
+        Stores an entry, evicting least recently used entries from memory if a limit is exceeded.
+
+        Args:
+            key (str): key of the entry
+            value: picklable value to be cached
+        """
+        self._insert(key, value)
+        path = self._disk_path(key)
+        if path is not None:
+            with open(path, 'wb') as f:
+                pickle.dump(value, f, protocol=pickle.HIGHEST_PROTOCOL)
+
+    def _insert(self, key, value):
+        if key in self._entries:
+            self._evict(key)
+        size = nbytes(value)
+        self._entries[key] = value
+        self._sizes[key] = size
+        self._total_bytes += size
+
+        while self._entries and ((self.max_entries is not None and len(self._entries) > self.max_entries) or
+                                 (self.max_bytes is not None and self._total_bytes > self.max_bytes)):
+            self._evict(next(iter(self._entries)))
+
+    def _evict(self, key):
+        del self._entries[key]
+        self._total_bytes -= self._sizes.pop(key)
+
+    def clear(self):
+        """
+        Removes all entries from memory; persisted files are kept. Statistics are reset.
+        """
+        self._entries.clear()
+        self._sizes.clear()
+        self._total_bytes = 0
+        self.hits = 0
+        self.misses = 0
+
+    def stats(self):
+        """
+        Returns:
+            dict: hits, misses, number of entries and bytes currently held in memory
+        """
+        return {'hits'    : self.hits,
+                'misses'  : self.misses,
+                'entries' : len(self._entries),
+                'bytes'   : self._total_bytes}
+
+
 def scale_range(x, new_min=0.0, new_max=1.0, old_min=None, old_max=None, squash_outside_range=True, squash_inf=False, ):
     """
     Scales a sequence to fit within a new range.
@@ -1,4 +1,4 @@
 """ExpAn data module.
 """
 
-__all__ = ["csv_fetcher"]
+__all__ = ["columnar_fetcher", "csv_fetcher", "sql_fetcher"]
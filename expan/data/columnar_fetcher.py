@@ -0,0 +1,263 @@
+"""Columnar fetcher module.
+
+Reads the metrics of an experiment from a columnar layout instead of CSV text:
+ - a Parquet file with 'metrics' in the filename ending in .parquet
+ - a Feather file with 'metrics' in the filename ending in .feather
+ - a directory with 'metrics' in its name holding one NumPy .npy file per column
+
+Parquet and Feather are decoded by pandas and need pyarrow. The .npy columns are memory-mapped,
+so that the numerical kpis of the Experiment are read-only views on the files instead of copies in memory.
+Non-numerical columns are stored as the int32 codes of a categorical in <column>.npy and its categories
+in <column>.categories.json.
+
+The metrics can be split into several shards, e.g. metrics-part-0.parquet, metrics-part-1.parquet, ...,
+which are read in the natural order of their names like in csv_fetcher.
+"""
+
+import logging
+from os import listdir, makedirs
+from os.path import exists, isdir, isfile, join
+
+import numpy as np
+import pandas as pd
+import simplejson as json
+
+from expan.core.experiment import Experiment
+from expan.data.csv_fetcher import required_columns, sorted_metrics_files, _check_unique_entities, _concat_shards
+
+logger = logging.getLogger(__name__)
+
+FORMATS = ['npy', 'parquet', 'feather']
+
+
+def get_data(controlVariantName, folder_path, report_kpi_names=None, derived_kpis=None, features=None,
+             memory_map=True):
+    """
+    Expects as input a folder containing the following files:
+     - the metrics in one of the columnar layouts of this module, or several shards of them
+     - one .txt or .json containing 'metadata' in the filename
+
+    Only the columns needed for the kpis and features are read (all columns if no report_kpi_names are given)
+    and the data is not copied into the Experiment, so .npy columns stay memory-mapped. Several shards are
+    concatenated in memory, their entities need to be unique across all of them.
+
+    Args:
+        controlVariantName: name of the control variant
+        folder_path: folder with the metrics and metadata
+        report_kpi_names: names of the kpis to analyse, by default all numerical columns
+        derived_kpis: derived kpis as for Experiment, they are computed in memory
+        features: names of further columns to read, e.g. the features for sga
+        memory_map: if False, .npy columns are loaded into memory
+
+    Returns:
+        Experiment: Experiment object with the loaded data
+
+    """
+    entries = listdir(folder_path)
+
+    try:
+        assert ('metrics' in '-'.join(entries))
+        assert ('metadata' in '-'.join(entries))
+
+        metadata = None
+
+        for f in entries:
+
+            if 'metadata' in f and isfile(join(folder_path, f)):
+                with open(join(folder_path, f), 'r') as input_json:
+                    metadata = json.load(input_json)
+
+        metrics_paths = [join(folder_path, f) for f in sorted_metrics_files(entries)]
+
+        columns = required_columns(report_kpi_names, derived_kpis, features)
+        metrics = _concat_shards([_read_metrics(path, columns, memory_map) for path in metrics_paths],
+                                 metrics_paths)
+
+        if 'variant' in metrics and not pd.api.types.is_categorical_dtype(metrics['variant']):
+            metrics['variant'] = metrics['variant'].astype('category')
+
+        return Experiment(controlVariantName, metrics, metadata, report_kpi_names, derived_kpis, copy=False)
+
+    except AssertionError as e:
+        logger.error("An error occured when fetching columnar data.")
+        raise e
+
+
+def convert(folder_path, output_path, metrics_format='npy', chunksize=None):
+    """
+    Converts a folder in the layout of csv_fetcher (one or more metrics .csv or .csv.gz and metadata)
+    into a folder in a columnar layout of this module. Several metrics files are written as one.
+
+    Args:
+        folder_path: folder with the metrics and metadata files of csv_fetcher
+        output_path: folder to write the metrics and metadata to, created if needed
+        metrics_format: one of 'npy', 'parquet' and 'feather'
+        chunksize: if given, the csv files are parsed twice in chunks of this many rows, first to find the
+            number of rows, the dtypes and the categories of the columns and then to write the chunks into
+            the .npy files, so that only one chunk is held in memory; only supported for 'npy'
+
+    Returns:
+        str: path of the written metrics
+
+    """
+    if metrics_format not in FORMATS:
+        raise ValueError('metrics_format should be one of {}'.format(', '.join(FORMATS)))
+    if chunksize and metrics_format != 'npy':
+        raise ValueError('chunksize is only supported for the npy format')
+
+    files = [f for f in listdir(folder_path) if isfile(join(folder_path, f))]
+
+    try:
+        assert ('metrics' in '-'.join(files))
+        assert ('metadata' in '-'.join(files))
+
+        metadata = None
+
+        for f in files:
+
+            if 'metadata' in f:
+                with open(join(folder_path, f), 'r') as input_json:
+                    metadata = json.load(input_json)
+
+        metrics_files = [join(folder_path, f) for f in sorted_metrics_files(files)]
+
+    except AssertionError as e:
+        logger.error("An error occured when fetching data from csv file.")
+        raise e
+
+    if not exists(output_path):
+        makedirs(output_path)
+
+    with open(join(output_path, 'metadata.json'), 'w') as output_json:
+        json.dump(metadata, output_json)
+
+    if metrics_format == 'npy' and chunksize:
+        metrics_path = join(output_path, 'metrics')
+        _write_npy_columns_in_chunks(metrics_files, metrics_path, chunksize)
+        return metrics_path
+
+    metrics = _concat_shards([pd.read_csv(f) for f in metrics_files], metrics_files)
+    if metrics_format == 'npy':
+        metrics_path = join(output_path, 'metrics')
+        _write_npy_columns(metrics, metrics_path)
+    elif metrics_format == 'parquet':
+        metrics_path = join(output_path, 'metrics.parquet')
+        metrics.to_parquet(metrics_path)
+    else:
+        metrics_path = join(output_path, 'metrics.feather')
+        metrics.reset_index(drop=True).to_feather(metrics_path)
+
+    return metrics_path
+
+
+def _read_metrics(metrics_path, columns, memory_map):
+    """ Data frame of the columns of a metrics file or .npy directory. """
+    if isdir(metrics_path):
+        return _read_npy_columns(metrics_path, columns, memory_map)
+    elif metrics_path.endswith('.parquet'):
+        return pd.read_parquet(metrics_path, columns=columns)
+    elif metrics_path.endswith('.feather'):
+        return pd.read_feather(metrics_path, columns=columns)
+    raise ValueError('Unknown format of metrics {}'.format(metrics_path))
+
+
+def _write_npy_columns(metrics, metrics_path):
+    """ Writes every column to its own .npy file, non-numerical columns as categorical codes and categories. """
+    if not exists(metrics_path):
+        makedirs(metrics_path)
+
+    with open(join(metrics_path, 'columns.json'), 'w') as output_json:
+        json.dump([str(column) for column in metrics.columns], output_json)
+
+    for column in metrics.columns:
+        values = metrics[column]
+        if np.issubdtype(values.dtype, np.number):
+            np.save(join(metrics_path, '{}.npy'.format(column)), np.ascontiguousarray(values.values))
+        else:
+            categorical = pd.Categorical(values)
+            np.save(join(metrics_path, '{}.npy'.format(column)), categorical.codes.astype(np.int32))
+            with open(join(metrics_path, '{}.categories.json'.format(column)), 'w') as output_json:
+                json.dump(categorical.categories.tolist(), output_json)
+
+
+def _write_npy_columns_in_chunks(metrics_files, metrics_path, chunksize):
+    """
+    Writes the columns of the csv files like _write_npy_columns, but into memory-mapped .npy files chunk by chunk.
+    A column is categorical if any chunk of it is non-numerical, numerical chunks of it may only hold nans.
+    """
+    def chunks():
+        for metrics_file in metrics_files:
+            for chunk in pd.read_csv(metrics_file, chunksize=chunksize):
+                yield metrics_file, chunk
+
+    rows, columns, dtypes, categories = 0, None, {}, {}
+    numerical, entities = set(), dict((metrics_file, []) for metrics_file in metrics_files)
+    for metrics_file, chunk in chunks():
+        if columns is None:
+            columns = list(chunk.columns)
+        rows += len(chunk)
+        entities[metrics_file].append(chunk.entity.values)
+        for column in columns:
+            values = chunk[column]
+            if np.issubdtype(values.dtype, np.number):
+                dtypes[column] = np.result_type(dtypes.get(column, values.dtype), values.dtype)
+                if values.notnull().any():
+                    numerical.add(column)
+            else:
+                categories.setdefault(column, set()).update(values.dropna().unique())
+        mixed = numerical & set(categories)
+        if mixed:
+            raise ValueError('Columns {} are numerical in some chunks only'.format(', '.join(sorted(mixed))))
+    _check_unique_entities([np.concatenate(entities[f]) for f in metrics_files], metrics_files)
+
+    if not exists(metrics_path):
+        makedirs(metrics_path)
+
+    with open(join(metrics_path, 'columns.json'), 'w') as output_json:
+        json.dump([str(column) for column in columns], output_json)
+
+    arrays = {}
+    for column in columns:
+        if column in categories:
+            # sorted like the categories of pd.Categorical in _write_npy_columns
+            categories[column] = pd.Categorical(list(categories[column])).categories
+            with open(join(metrics_path, '{}.categories.json'.format(column)), 'w') as output_json:
+                json.dump(categories[column].tolist(), output_json)
+        arrays[column] = np.lib.format.open_memmap(join(metrics_path, '{}.npy'.format(column)), mode='w+',
+                                                   dtype=np.int32 if column in categories else dtypes[column],
+                                                   shape=(rows,))
+
+    start = 0
+    for _, chunk in chunks():
+        for column in columns:
+            if column in categories:
+                values = pd.Categorical(chunk[column], categories=categories[column]).codes
+            else:
+                values = chunk[column].values
+            arrays[column][start:start + len(chunk)] = values
+        start += len(chunk)
+
+    for array in arrays.values():
+        array.flush()
+
+
+def _read_npy_columns(metrics_path, columns, memory_map):
+    """ Data frame of the .npy columns, whose numerical columns are views on the (memory-mapped) arrays. """
+    with open(join(metrics_path, 'columns.json'), 'r') as input_json:
+        all_columns = json.load(input_json)
+    if columns is None:
+        columns = all_columns
+
+    values = {}
+    for column in columns:
+        if column not in all_columns:
+            raise ValueError('No column %s provided' % column)
+        array = np.load(join(metrics_path, '{}.npy'.format(column)), mmap_mode='r' if memory_map else None)
+        categories_file = join(metrics_path, '{}.categories.json'.format(column))
+        if exists(categories_file):
+            with open(categories_file, 'r') as input_json:
+                array = pd.Categorical.from_codes(np.asarray(array), json.load(input_json))
+        values[column] = array
+
+    # a data frame built from a dict keeps one block per column instead of copying them into one array
+    return pd.DataFrame(values, columns=[column for column in all_columns if column in values], copy=False)
@@ -2,26 +2,48 @@
 """
 
 import logging
+import multiprocessing
+import re
 from os import listdir
 from os.path import isfile, join
 
+import numpy as np
 import pandas as pd
 import simplejson as json
 
+from expan.core.aggregated_experiment import AggregatedExperiment, kpi_name_pattern
 from expan.core.experiment import Experiment
+from expan.core.util import get_column_names_by_type
 
 logger = logging.getLogger(__name__)
 
-def get_data(controlVariantName, folder_path):
+def get_data(controlVariantName, folder_path, report_kpi_names=None, derived_kpis=None, features=None, dtypes=None,
+             downcast=True, processes=None):
     """
     Expects as input a folder containing the following files:
-     - one .csv or .csv.gz with 'metrics' in the filename
+     - one or more .csv or .csv.gz with 'metrics' in the filename, e.g. shards metrics-part-0.csv.gz,
+       metrics-part-1.csv.gz, ...
      - one .txt containing 'metadata' in the filename
 
     Opens the files and uses them to create an Experiment object which it then returns.
 
+    Several metrics files are parsed in parallel and concatenated in the natural order of their names
+    (part-2 before part-10). Entities need to be unique across all of them.
+
+    If report_kpi_names are given, only the entity and variant columns, the report kpis, the inputs of the
+    derived kpis and the features are read. The variant column is read as a categorical and, if downcast is
+    True, integer columns are stored in the smallest integer type holding their values. The dtypes of
+    further columns can be given in dtypes or in a 'dtypes' dict of the metadata file.
+
     Args:
-        folder_path:
+        controlVariantName: name of the control variant
+        folder_path: folder with the metrics and metadata files
+        report_kpi_names: names of the kpis to analyse, by default all numerical columns
+        derived_kpis: derived kpis as for Experiment
+        features: names of further columns to read, e.g. the features for sga
+        dtypes: column name to dtype, takes precedence over the dtypes of the metadata file
+        downcast: if True, integer columns are downcast
+        processes: number of processes parsing several metrics files, defaults to the number of cores
 
     Returns:
         Experiment: Experiment object with loaded csv data
@@ -33,19 +55,173 @@ def get_data(controlVariantName, folder_path):
         assert ('metrics' in '-'.join(files))
         assert ('metadata' in '-'.join(files))
 
-        metrics = metadata = None
+        metadata = None
 
         for f in files:
 
-            if 'metrics' in f:
-                metrics = pd.read_csv(join(folder_path, f))
+            if 'metadata' in f:
+                with open(join(folder_path, f), 'r') as input_json:
+                    metadata = json.load(input_json)
+
+        metrics_files = [join(folder_path, f) for f in sorted_metrics_files(files)]
+
+        usecols = required_columns(report_kpi_names, derived_kpis, features)
+        column_dtypes = _column_dtypes(metadata, dtypes, usecols)
+        shards = _map(_read_shard, [(f, usecols, column_dtypes) for f in metrics_files], processes)
+        metrics = _concat_shards(shards, metrics_files)
+        if downcast:
+            for column in get_column_names_by_type(metrics, np.integer):
+                metrics[column] = pd.to_numeric(metrics[column], downcast='integer')
+
+        return Experiment(controlVariantName, metrics, metadata, report_kpi_names, derived_kpis)
+
+    except AssertionError as e:
+        logger.error("An error occured when fetching data from csv file.")
+        raise e
+
+
+def get_data_streaming(controlVariantName, folder_path, chunksize=100000, report_kpi_names=None, derived_kpis=None,
+                       feature_name_to_bins=None, dtypes=None, processes=None):
+    """
+    Expects the same folder as get_data, but reads the metrics files in chunks and only accumulates
+    the sufficient statistics of the kpis per variant, so that the metrics never need to fit into memory.
+
+    The statistics of several metrics files are accumulated in parallel and then merged. Only the entities
+    are kept in memory to check that they are unique across all chunks and files.
+
+    Args:
+        controlVariantName: name of the control variant
+        folder_path: folder with the metrics and metadata files
+        chunksize: number of rows read at once
+        report_kpi_names: names of the kpis to analyse, by default all numerical columns
+        derived_kpis: derived kpis as for Experiment
+        feature_name_to_bins: bins of features as for Experiment.sga, whose statistics are accumulated for sga
+        dtypes: column name to dtype as for get_data
+        processes: number of processes reading several metrics files, defaults to the number of cores
+
+    Returns:
+        AggregatedExperiment: experiment supporting the normal-theory methods and sga of the declared features
+
+    """
+    files = [f for f in listdir(folder_path) if isfile(join(folder_path, f))]
+
+    try:
+        assert ('metrics' in '-'.join(files))
+        assert ('metadata' in '-'.join(files))
+
+        metadata = None
 
-            elif 'metadata' in f:
+        for f in files:
+
+            if 'metadata' in f:
                 with open(join(folder_path, f), 'r') as input_json:
                     metadata = json.load(input_json)
 
-        return Experiment(controlVariantName, metrics, metadata)
+        metrics_files = [join(folder_path, f) for f in sorted_metrics_files(files)]
+
+        features = []
+        for dimension in (feature_name_to_bins or {}):
+            features.extend(dimension if isinstance(dimension, tuple) else [dimension])
+        usecols = required_columns(report_kpi_names, derived_kpis, features)
+        column_dtypes = _column_dtypes(metadata, dtypes, usecols)
+        tasks = [(controlVariantName, f, chunksize, usecols, column_dtypes, metadata, report_kpi_names,
+                  derived_kpis, feature_name_to_bins) for f in metrics_files]
+        shards = _map(_aggregate_shard, tasks, processes)
+
+        _check_unique_entities([entities for _, entities in shards], metrics_files)
+        aggregated = shards[0][0]
+        for shard, _ in shards[1:]:
+            aggregated = aggregated.merge(shard)
+        return aggregated
 
     except AssertionError as e:
         logger.error("An error occured when fetching data from csv file.")
         raise e
+
+
+def required_columns(report_kpi_names, derived_kpis, features):
+    """ Columns needed for the given kpis and features, None to read all columns if no kpis are given. """
+    if not report_kpi_names:
+        return None
+    if isinstance(report_kpi_names, str):
+        report_kpi_names = [report_kpi_names]
+
+    derived_kpis = derived_kpis or []
+    derived_kpi_names = set(k['name'] for k in derived_kpis)
+    columns = set(['entity', 'variant']) | (set(report_kpi_names) - derived_kpi_names) | set(features or [])
+    for k in derived_kpis:
+        columns |= set(re.findall(kpi_name_pattern, k['formula']))
+    return sorted(columns)
+
+
+def _column_dtypes(metadata, dtypes, usecols):
+    """ Dtypes of the columns to read: categorical variants, then the metadata file's dtypes, then dtypes. """
+    column_dtypes = {'variant': 'category'}
+    column_dtypes.update(metadata.get('dtypes', {}))
+    column_dtypes.update(dtypes or {})
+    if usecols is not None:
+        column_dtypes = dict((column, dtype) for column, dtype in column_dtypes.items() if column in usecols)
+    return column_dtypes
+
+
+def sorted_metrics_files(files):
+    """ Names of the metrics files in natural order, so that part-2 comes before part-10. """
+    def natural_key(name):
+        return [int(part) if part.isdigit() else part for part in re.split('([0-9]+)', name)]
+    return sorted([f for f in files if 'metrics' in f], key=natural_key)
+
+
+def _map(function, tasks, processes):
+    """ Maps function over the tasks in a process pool if there are several of them, keeping their order. """
+    if len(tasks) == 1 or processes == 1:
+        return [function(task) for task in tasks]
+
+    pool = multiprocessing.Pool(processes)
+    try:
+        return pool.map(function, tasks)
+    finally:
+        pool.close()
+        pool.join()
+
+
+def _read_shard(task):
+    metrics_file, usecols, column_dtypes = task
+    return pd.read_csv(metrics_file, usecols=usecols, dtype=column_dtypes)
+
+
+def _aggregate_shard(task):
+    """ Aggregated experiment and entities of a metrics file. """
+    (controlVariantName, metrics_file, chunksize, usecols, column_dtypes, metadata, report_kpi_names,
+     derived_kpis, feature_name_to_bins) = task
+    entities = []
+
+    def chunks():
+        for chunk in pd.read_csv(metrics_file, chunksize=chunksize, usecols=usecols, dtype=column_dtypes):
+            entities.append(chunk.entity.values)
+            yield chunk
+
+    aggregated = AggregatedExperiment.from_chunks(controlVariantName, chunks(), metadata, report_kpi_names,
+                                                  derived_kpis, feature_name_to_bins)
+    return aggregated, np.concatenate(entities)
+
+
+def _check_unique_entities(entities, metrics_files):
+    """ Raises a ValueError naming the metrics files if an entity occurs more than once. """
+    duplicated = pd.Series(np.concatenate(entities)).duplicated(keep=False).values
+    if duplicated.any():
+        shards = np.repeat(np.arange(len(entities)), [len(e) for e in entities])
+        names = [metrics_files[i] for i in np.unique(shards[duplicated])]
+        raise ValueError('Entities in data should be unique, duplicates in {}'.format(', '.join(names)))
+
+
+def _concat_shards(shards, metrics_files):
+    """ Concatenates the data of the metrics files, keeping categorical columns categorical. """
+    if len(shards) == 1:
+        return shards[0]
+
+    _check_unique_entities([shard.entity.values for shard in shards], metrics_files)
+    metrics = pd.concat(shards, ignore_index=True)
+    for column in shards[0].columns:
+        if pd.api.types.is_categorical_dtype(shards[0][column]):
+            metrics[column] = pd.api.types.union_categoricals([shard[column] for shard in shards])
+    return metrics
@@ -0,0 +1,256 @@
+"""SQL fetcher module.
+
+Computes the sufficient statistics of the kpis in the database instead of fetching the rows of all entities.
+Works with any DB-API 2.0 connection, e.g. of sqlite3, whose SQL supports CASE, COUNT, SUM and AVG.
+
+The table needs the columns 'entity', 'variant' and the kpis. NULLs are treated like NaNs in an Experiment,
+in particular a derived kpi needs to evaluate to NULL where its formula divides by zero (as in SQLite).
+"""
+
+import functools
+import logging
+import re
+
+import numpy as np
+import pandas as pd
+
+from expan.core.aggregated_experiment import AggregatedExperiment, kpi_name_pattern
+from expan.core.experiment import Experiment
+from expan.data.csv_fetcher import required_columns
+
+logger = logging.getLogger(__name__)
+
+
+def get_data(controlVariantName, connection, table, metadata, report_kpi_names, derived_kpis=None,
+             feature_name_to_bins=None, where=None):
+    """
+    Aggregates the count, sum and sum of squares of every kpi per variant (and per cell of the bins of
+    feature_name_to_bins) in the database, in one query for the experiment and one per sga dimension
+    after a query of the overall means that the sums are centered on for numerical accuracy.
+
+    The returned experiment fetches the rows of the entities only if delta is called with a method that
+    needs the samples, i.e. bootstrapping or the Bayesian methods.
+
+    Args:
+        controlVariantName: name of the control variant
+        connection: DB-API connection
+        table: name of the table or a parenthesised subquery with alias
+        metadata: metadata of the experiment
+        report_kpi_names: names of the kpis to analyse
+        derived_kpis: derived kpis as for Experiment, their formulas are evaluated in SQL
+        feature_name_to_bins: bins of features as for Experiment.sga, whose statistics are aggregated for sga
+        where: optional SQL condition on the rows of the table
+
+    Returns:
+        AggregatedExperiment: experiment of the aggregated statistics
+
+    """
+    if not report_kpi_names:
+        raise ValueError('report_kpi_names need to be given to aggregate in the database')
+    if type(report_kpi_names) is str:
+        report_kpi_names = [report_kpi_names]
+    derived_kpis = derived_kpis or []
+    feature_name_to_bins = feature_name_to_bins or {}
+
+    reference_kpis = dict((kpi['name'], re.sub(kpi_name_pattern + '/', '', kpi['formula'])) for kpi in derived_kpis)
+    columns = summary_expressions(report_kpi_names, derived_kpis)
+    names = sorted(columns)
+    condition = ' WHERE {}'.format(where) if where else ''
+
+    # center the sums on the overall means, so that the sums of squares do not cancel out
+    means = _fetchall(connection, 'SELECT {} FROM {}{}'.format(
+        ', '.join('AVG({})'.format(columns[name]) for name in names), table, condition))[0]
+    shifts = dict((name, float(mean) if mean is not None else 0.) for name, mean in zip(names, means))
+
+    statistics = _grouped_statistics(connection, table, condition, columns, shifts, [])
+
+    segments = {}
+    for dimension in feature_name_to_bins:
+        if type(dimension) is tuple:
+            features, feature_bins = dimension, list(feature_name_to_bins[dimension])
+        else:
+            features, feature_bins = (dimension,), [feature_name_to_bins[dimension]]
+        labels = [bins_expression(feature, bins) for feature, bins in zip(features, feature_bins)]
+        binned = ' AND '.join('{} >= 0'.format(label) for label in labels)
+        segment_condition = '{} AND ({})'.format(condition, binned) if condition else ' WHERE {}'.format(binned)
+        segment_statistics = _grouped_statistics(connection, table, segment_condition, columns, shifts, labels)
+
+        # the cell is the raveled index of the bins of the features, as in Experiment.sga
+        n = segment_statistics[0]
+        cells = np.ravel_multi_index(tuple(np.asarray(n.index.get_level_values(i), dtype=np.int64)
+                                           for i in range(len(labels))),
+                                     tuple(len(bins) for bins in feature_bins))
+        index = pd.MultiIndex.from_arrays([cells, n.index.get_level_values(len(labels))])
+        for frame in segment_statistics:
+            frame.index = index
+        segments[dimension] = (feature_bins, segment_statistics)
+
+    row_loader = functools.partial(get_rows, controlVariantName, connection, table, metadata, report_kpi_names,
+                                   derived_kpis, where=where)
+    return AggregatedExperiment(controlVariantName, statistics, metadata, report_kpi_names, reference_kpis,
+                                segments, row_loader)
+
+
+def get_rows(controlVariantName, connection, table, metadata, report_kpi_names=None, derived_kpis=None,
+             features=None, where=None):
+    """
+    Fetches the rows of the entities, restricted to the columns needed for the kpis and features.
+
+    Args:
+        controlVariantName: name of the control variant
+        connection: DB-API connection
+        table: name of the table or a parenthesised subquery with alias
+        metadata: metadata of the experiment
+        report_kpi_names: names of the kpis to analyse, by default all numerical columns (and all columns
+            are fetched)
+        derived_kpis: derived kpis as for Experiment
+        features: names of further columns to fetch, e.g. the features for sga
+        where: optional SQL condition on the rows of the table
+
+    Returns:
+        Experiment: Experiment object with the fetched data
+
+    """
+    columns = required_columns(report_kpi_names, derived_kpis, features)
+    selected = ', '.join(quote_identifier(column) for column in columns) if columns else '*'
+    condition = ' WHERE {}'.format(where) if where else ''
+
+    cursor = connection.cursor()
+    try:
+        cursor.execute('SELECT {} FROM {}{}'.format(selected, table, condition))
+        names = [description[0] for description in cursor.description]
+        rows = cursor.fetchall()
+    finally:
+        cursor.close()
+
+    data = pd.DataFrame.from_records(rows, columns=names, coerce_float=True)
+    # NULLs of numerical columns become nans
+    for column in data.columns:
+        if data[column].dtype == object and column not in ('entity', 'variant'):
+            converted = pd.to_numeric(data[column], errors='coerce')
+            if converted.notnull().sum() == data[column].notnull().sum():
+                data[column] = converted
+    return Experiment(controlVariantName, data, metadata, report_kpi_names, derived_kpis)
+
+
+def quote_identifier(name):
+    """ Quotes a column name as an SQL identifier. """
+    return '"{}"'.format(name.replace('"', '""'))
+
+
+def quote_literal(value):
+    """ SQL literal of a number or string. """
+    if isinstance(value, (bool, np.bool_)):
+        return str(int(value))
+    if isinstance(value, (int, float, np.integer, np.floating)):
+        return repr(float(value))
+    return "'{}'".format(str(value).replace("'", "''"))
+
+
+def summary_expressions(report_kpi_names, derived_kpis):
+    """
+    SQL expressions of the summary columns of the kpis, see aggregated_experiment.summary_columns.
+
+    Args:
+        report_kpi_names (iterable): names of the kpis to summarise
+        derived_kpis (list): derived kpis as for Experiment
+
+    Returns:
+        dict: summary column name to SQL expression, 'rows' counts the entities
+    """
+    formulas = dict((kpi['name'], kpi['formula']) for kpi in derived_kpis)
+    columns = {'rows': '1.0'}
+    for kpi in report_kpi_names:
+        if kpi in formulas:
+            # like astype(float) in Experiment, so that integer columns are not divided as integers
+            value = re.sub(kpi_name_pattern, lambda match: '(1.0 * {})'.format(quote_identifier(match.group(1))),
+                           formulas[kpi])
+            reference = '(1.0 * {})'.format(quote_identifier(re.sub(kpi_name_pattern + '/', '', formulas[kpi])))
+            columns['non_zeros ' + kpi] = 'CASE WHEN {} <> 0 THEN 1.0 ELSE 0.0 END'.format(reference)
+            columns['reference ' + kpi] = reference
+            columns['kpi ' + kpi] = '(({}) * {})'.format(value, reference)
+        else:
+            columns['kpi ' + kpi] = '(1.0 * {})'.format(quote_identifier(kpi))
+    return columns
+
+
+def bin_condition(feature, bin):
+    """
+    SQL condition of the rows in a bin, like Bin.mask.
+
+    Args:
+        feature (str): name of the feature column
+        bin (Bin): numerical or categorical bin
+
+    Returns:
+        str: SQL condition
+    """
+    column = quote_identifier(feature)
+    representation = bin.representation
+    if bin.bin_type == "numerical":
+        # if either bound is nan, only nans exist in the bin
+        if np.isnan(representation.lower) or np.isnan(representation.upper):
+            return '{} IS NULL'.format(column)
+        conditions = []
+        if not np.isinf(representation.lower):
+            conditions.append('{} {} {}'.format(column, '>=' if representation.lower_closed else '>',
+                                                quote_literal(representation.lower)))
+        if not np.isinf(representation.upper):
+            conditions.append('{} {} {}'.format(column, '<=' if representation.upper_closed else '<',
+                                                quote_literal(representation.upper)))
+        return ' AND '.join(conditions) or '{} IS NOT NULL'.format(column)
+
+    categories = [category for category in representation.categories if category == category]
+    conditions = ['{} IS NULL'.format(column)] if len(categories) < len(representation.categories) else []
+    if categories:
+        conditions.append('{} IN ({})'.format(column, ', '.join(quote_literal(c) for c in categories)))
+    return ' OR '.join(conditions) or '1 = 0'
+
+
+def bins_expression(feature, bins):
+    """ SQL expression of the index of the first bin containing a row, -1 if there is none, like assign_bins. """
+    return '(CASE {} ELSE -1 END)'.format(
+        ' '.join('WHEN {} THEN {}'.format(bin_condition(feature, bin), i) for i, bin in enumerate(bins)))
+
+
+def _fetchall(connection, query):
+    cursor = connection.cursor()
+    try:
+        cursor.execute(query)
+        return cursor.fetchall()
+    finally:
+        cursor.close()
+
+
+def _grouped_statistics(connection, table, condition, columns, shifts, labels):
+    """
+    Sufficient statistics of the summary columns per labels and variant from the counts and centered sums
+    and sums of squares, like aggregated_experiment.grouped_statistics.
+    """
+    names = sorted(columns)
+    keys = labels + [quote_identifier('variant')]
+    aggregates = []
+    for name in names:
+        centered = '({} - {})'.format(columns[name], quote_literal(shifts[name]))
+        aggregates += ['COUNT({})'.format(columns[name]), 'SUM({})'.format(centered),
+                       'SUM({} * {})'.format(centered, centered)]
+    query = 'SELECT {}, {} FROM {}{} GROUP BY {}'.format(', '.join(keys), ', '.join(aggregates), table, condition,
+                                                         ', '.join(keys))
+    rows = _fetchall(connection, query)
+
+    if len(keys) == 1:
+        index = pd.Index([row[0] for row in rows])
+    else:
+        index = pd.MultiIndex.from_arrays([[row[i] for row in rows] for i in range(len(keys))])
+    sums = np.array([[np.nan if value is None else value for value in row[len(keys):]] for row in rows],
+                    dtype=float).reshape(len(rows), 3 * len(names))
+
+    n = sums[:, 0::3]
+    with np.errstate(invalid='ignore', divide='ignore'):
+        centered_mean = np.where(n > 0, sums[:, 1::3] / n, 0.)
+        m2 = np.where(n > 0, sums[:, 2::3] - sums[:, 1::3] * centered_mean, 0.)
+    mean = np.where(n > 0, centered_mean + np.array([shifts[name] for name in names]), 0.)
+
+    return (pd.DataFrame(n.astype(np.int64), index=index, columns=names),
+            pd.DataFrame(mean, index=index, columns=names),
+            pd.DataFrame(np.maximum(m2, 0.), index=index, columns=names))
@@ -0,0 +1,181 @@
+import unittest
+
+import numpy as np
+import pandas as pd
+
+from expan.core.aggregated_experiment import AggregatedExperiment, grouped_statistics, merge_grouped_statistics
+from expan.core.binning import Bin, create_bins
+from expan.core.experiment import Experiment
+from expan.core.util import generate_random_data, find_list_of_dicts_element
+
+
+class AggregatedExperimentTestCase(unittest.TestCase):
+    """
+    Defines the setUp() and tearDown() functions for the aggregated experiment test cases.
+    """
+
+    def setUp(self):
+        np.random.seed(0)
+        data, metadata = generate_random_data()
+        data.loc[::37, 'normal_shifted'] = np.nan
+        self.data, self.metadata = data, metadata
+        self.kpis = ['normal_same', 'normal_shifted', 'derived_kpi_1']
+        self.derived_kpis = [{'name': 'derived_kpi_1', 'formula': 'normal_same/normal_shifted'}]
+        self.experiment = Experiment('B', data, metadata, self.kpis, self.derived_kpis)
+
+    def tearDown(self):
+        pass
+
+    def getChunks(self, chunksize=777):
+        return (self.data.iloc[i:i + chunksize] for i in range(0, len(self.data), chunksize))
+
+    def assertResultsAlmostEqual(self, result, expected):
+        self.assertEqual(result['warnings'], expected['warnings'])
+        for expected_kpi in expected['kpis']:
+            kpi = find_list_of_dicts_element(result['kpis'], 'name', expected_kpi['name'], 'variants')
+            for expected_variant in expected_kpi['variants']:
+                statistics = find_list_of_dicts_element(kpi, 'name', expected_variant['name'], 'delta_statistics')
+                expected_statistics = expected_variant['delta_statistics']
+                self.assertEqual(set(statistics), set(expected_statistics))
+                for key in expected_statistics:
+                    if key == 'confidence_interval':
+                        for interval, expected_interval in zip(statistics[key], expected_statistics[key]):
+                            self.assertEqual(interval['percentile'], expected_interval['percentile'])
+                            self.assertAlmostEqual(interval['value'], expected_interval['value'])
+                    else:
+                        self.assertAlmostEqual(statistics[key], expected_statistics[key])
+
+
+class AggregatedExperimentTestCases(AggregatedExperimentTestCase):
+    """
+    Test cases for experiments accumulated from chunks of data.
+    """
+
+    def test_merge_grouped_statistics(self):
+        values = np.random.normal(size=100)
+        keys = np.random.choice(['a', 'b', 'c'], size=100)
+        keys[:50] = 'a'
+        merged = merge_grouped_statistics(grouped_statistics({'x': values[:50]}, keys[:50]),
+                                          grouped_statistics({'x': values[50:]}, keys[50:]))
+        expected = grouped_statistics({'x': values}, keys)
+        for frame, expected_frame in zip(merged, expected):
+            np.testing.assert_allclose(frame.values, expected_frame.values)
+
+    def test_fixed_horizon_delta(self):
+        aggregated = AggregatedExperiment.from_chunks('B', self.getChunks(), self.metadata, self.kpis,
+                                                      self.derived_kpis)
+        self.assertEqual(aggregated.variant_names, set(['A', 'B']))
+        self.assertEqual(int(aggregated.statistics[0]['rows'].sum()), len(self.data))
+        self.assertResultsAlmostEqual(aggregated.delta(), self.experiment.delta())
+        self.assertResultsAlmostEqual(aggregated.delta(multi_test_correction=True, percentiles=[5, 95]),
+                                      self.experiment.delta(multi_test_correction=True, percentiles=[5, 95]))
+
+    def test_group_sequential_delta(self):
+        aggregated = AggregatedExperiment.from_chunks('B', self.getChunks(), self.metadata, self.kpis,
+                                                      self.derived_kpis)
+        self.assertResultsAlmostEqual(aggregated.delta('group_sequential', estimated_sample_size=20000),
+                                      self.experiment.delta('group_sequential', estimated_sample_size=20000))
+
+    def test_unsupported_methods(self):
+        aggregated = AggregatedExperiment.from_chunks('B', self.getChunks(), self.metadata, ['normal_same'])
+        with self.assertRaises(NotImplementedError):
+            aggregated.delta('bayes_factor')
+        with self.assertRaises(NotImplementedError):
+            aggregated.delta(assume_normal=False)
+
+    def test_default_kpis(self):
+        aggregated = AggregatedExperiment.from_chunks('B', self.getChunks(), self.metadata)
+        self.assertEqual(aggregated.report_kpi_names, Experiment('B', self.data, self.metadata).report_kpi_names)
+
+    def test_duplicate_entities(self):
+        with self.assertRaises(ValueError):
+            AggregatedExperiment.from_chunks('B', [self.data.iloc[[0, 0, 1]]], self.metadata, self.kpis)
+
+    def test_merge(self):
+        feature_name_to_bins = {'feature': [Bin("categorical", ["has"]), Bin("categorical", ["non"])]}
+        first, second = [AggregatedExperiment.from_chunks('B', [data], self.metadata, self.kpis, self.derived_kpis,
+                                                          feature_name_to_bins)
+                         for data in [self.data.iloc[:4000], self.data.iloc[4000:]]]
+        merged = first.merge(second)
+        expected = AggregatedExperiment.from_chunks('B', self.getChunks(), self.metadata, self.kpis,
+                                                    self.derived_kpis, feature_name_to_bins)
+        self.assertResultsAlmostEqual(merged.delta(), expected.delta())
+        for res, expected_res in zip(merged.sga(), expected.sga()):
+            self.assertEqual(res['segment'], expected_res['segment'])
+            self.assertResultsAlmostEqual(res['result'], expected_res['result'])
+
+        with self.assertRaises(ValueError):
+            first.merge(AggregatedExperiment.from_chunks('B', self.getChunks(), self.metadata, ['normal_same']))
+
+    def getSummaryTable(self, data, keys, kpis):
+        rows = []
+        for key, group in data.groupby(keys):
+            key = key if isinstance(key, tuple) else (key,)
+            for kpi in kpis:
+                values = group[kpi].dropna()
+                row = {'kpi': kpi, 'count': len(values), 'sum': values.sum(), 'sum_squares': (values ** 2).sum(),
+                       'entities': len(group)}
+                row.update(zip(keys, key))
+                rows.append(row)
+        return pd.DataFrame(rows)
+
+    def test_from_summary_tables(self):
+        kpis = ['normal_same', 'normal_shifted']
+        summary = self.getSummaryTable(self.data, ['variant'], kpis)
+        segment_summary = self.getSummaryTable(self.data.assign(dimension='feature', segment=self.data.feature),
+                                               ['dimension', 'segment', 'variant'], kpis)
+        aggregated = AggregatedExperiment.from_summary_tables('B', summary, self.metadata, segment_summary)
+        experiment = Experiment('B', self.data, self.metadata, kpis)
+
+        self.assertEqual(aggregated.report_kpi_names, set(kpis))
+        self.assertResultsAlmostEqual(aggregated.delta(), experiment.delta())
+        self.assertResultsAlmostEqual(aggregated.delta('group_sequential', estimated_sample_size=20000),
+                                      experiment.delta('group_sequential', estimated_sample_size=20000))
+
+        feature_name_to_bins = {'feature': [Bin("categorical", ["feature that only has one data point"]),
+                                            Bin("categorical", ["has"]), Bin("categorical", ["non"])]}
+        sga_result = aggregated.sga(include_invalid=True)
+        expected = experiment.sga(feature_name_to_bins, include_invalid=True)
+        self.assertEqual(len(sga_result), 3)
+        for res, expected_res in zip(sga_result, expected):
+            self.assertEqual(res['segment'], expected_res['segment'])
+            self.assertEqual(res['validity'], expected_res['validity'])
+            if 'result' in expected_res:
+                self.assertResultsAlmostEqual(res['result'], expected_res['result'])
+
+        # without the number of entities, the largest count of a kpi is taken
+        aggregated = AggregatedExperiment.from_summary_tables('B', summary.drop('entities', axis=1), self.metadata)
+        self.assertEqual(int(aggregated.statistics[0]['rows'].sum()), len(self.data))
+
+    def test_from_summary_tables_invalid(self):
+        summary = self.getSummaryTable(self.data, ['variant'], ['normal_same'])
+        with self.assertRaises(ValueError):
+            AggregatedExperiment.from_summary_tables('B', summary.drop('sum_squares', axis=1), self.metadata)
+        with self.assertRaises(ValueError):
+            AggregatedExperiment.from_summary_tables('B', pd.concat([summary, summary]), self.metadata)
+        with self.assertRaises(ValueError):
+            AggregatedExperiment.from_summary_tables('B', summary, self.metadata, summary)
+
+    def test_sga(self):
+        feature_name_to_bins = {
+            'feature': [Bin("categorical", ["has"]), Bin("categorical", ["non"]),
+                        Bin("categorical", ["feature that only has one data point"])],
+            ('normal_same', 'treatment_start_time'): [create_bins(self.data.normal_same, 3),
+                                                      create_bins(self.data.treatment_start_time, 2)]
+        }
+        aggregated = AggregatedExperiment.from_chunks('B', self.getChunks(), self.metadata, self.kpis,
+                                                      self.derived_kpis, feature_name_to_bins)
+        sga_result = aggregated.sga(include_invalid=True)
+        expected = self.experiment.sga(feature_name_to_bins, include_invalid=True)
+        self.assertEqual(len(sga_result), 9)
+        self.assertEqual(len([res for res in sga_result if 'result' in res]), 8)
+        for res, expected_res in zip(sga_result, expected):
+            self.assertEqual(res['dimension'], expected_res['dimension'])
+            self.assertEqual(res['segment'], expected_res['segment'])
+            self.assertEqual(res['validity'], expected_res['validity'])
+            if 'result' in expected_res:
+                self.assertResultsAlmostEqual(res['result'], expected_res['result'])
+
+
+if __name__ == '__main__':
+    unittest.main()
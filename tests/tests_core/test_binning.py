@@ -1,4 +1,7 @@
+import json
+import shutil
 import sys
+import tempfile
 import unittest
 
 import pandas as pd
@@ -130,6 +133,22 @@ class CreateNumericalBinsTestCase(BinningTestCase):
         bins_repr_expected = [NumericalRepresentation(0, 0, True, True)]
         self.assertCollectionEqual(bins_repr_source, bins_repr_expected)
 
+    def test_creation_single_bin_nan(self):
+        data = [np.nan, 0, 1, 2]
+        bins = create_bins(data, 1)
+        bins_repr_source = toBinRepresentation(bins)
+        bins_repr_expected = [NumericalRepresentation(np.nan, np.nan, True, True),
+                              NumericalRepresentation(0, 2, True, True)]
+        self.assertCollectionEqual(bins_repr_source, bins_repr_expected)
+
+    def test_creation_partitions_data(self):
+        """ Every value falls into exactly one bin, ties never span two bins. """
+        data = np.round(np.random.exponential(size=10000), 1)
+        data[::50] = np.nan
+        df = pd.DataFrame({'feature': data})
+        bins = create_bins(data, 20)
+        self.assertEqual(sum(len(bin(df, 'feature')) for bin in bins), len(data))
+
     def test_creation_more_bins_than_data(self):
         data = [0] * 100 + [1] * 10
         nbins = 3
@@ -174,6 +193,147 @@ class CreateNumericalBinsTestCase(BinningTestCase):
         self.assertCollectionEqual(bins_repr_source, bins_repr_expected)
 
 
+class ApproximateNumericalBinsTestCase(BinningTestCase):
+    """
+    Test cases for quantile sketches and bins created from them.
+    """
+    def test_sketch_rank_error(self):
+        data = np.random.RandomState(0).lognormal(size=200000)
+        sketch = QuantileSketch(k=200, seed=0).update(data)
+        self.assertEqual(len(sketch), len(data))
+        self.assertEqual(sketch.min, data.min())
+        self.assertEqual(sketch.max, data.max())
+
+        quantiles = np.linspace(0.01, 0.99, 99)
+        ranks = np.searchsorted(np.sort(data), sketch.quantile(quantiles)) / float(len(data))
+        self.assertLess(np.max(np.abs(ranks - quantiles)), sketch.rank_error())
+
+    def test_sketch_small_input_is_exact(self):
+        sketch = QuantileSketch(k=200).update(np.arange(100.))
+        np.testing.assert_array_equal(sketch.quantile([0.1, 0.5, 0.9]), [9., 49., 89.])
+        bins_repr_source = toBinRepresentation(create_bins(sketch, 2))
+        bins_repr_expected = toBinRepresentation(create_bins(np.arange(100.), 2))
+        self.assertCollectionEqual(bins_repr_source, bins_repr_expected)
+
+    def test_sketch_merge(self):
+        data = np.random.RandomState(1).normal(size=100000)
+        data[::100] = np.nan
+        sketch = QuantileSketch(k=200, seed=0)
+        for i, chunk in enumerate(np.array_split(data, 10)):
+            sketch.merge(QuantileSketch(k=200, seed=i).update(chunk))
+        self.assertEqual(len(sketch), 99000)
+        self.assertEqual(sketch.n_nans, 1000)
+        self.assertEqual(sketch.min, np.nanmin(data))
+        self.assertEqual(sketch.max, np.nanmax(data))
+
+        quantiles = np.linspace(0.01, 0.99, 99)
+        values = np.sort(data[~np.isnan(data)])
+        ranks = np.searchsorted(values, sketch.quantile(quantiles)) / float(len(values))
+        self.assertLess(np.max(np.abs(ranks - quantiles)), sketch.rank_error())
+
+    def test_create_approximate(self):
+        data = np.random.RandomState(2).exponential(size=200000)
+        data[::50] = np.nan
+        df = pd.DataFrame({'feature': data})
+        bins = create_bins(data, 10, approximate=True)
+        self.assertEqual(len(bins), 10)
+        self.assertTrue(np.isnan(bins[0].representation.lower))
+
+        # every value is binned and the bins have about the same size
+        sizes = np.array([len(bin(df, 'feature')) for bin in bins[1:]])
+        self.assertEqual(sizes.sum() + len(bins[0](df, 'feature')), len(data))
+        expected = (len(data) - 4000) / 9.
+        self.assertLess(np.max(np.abs(sizes / expected - 1)), 9 * 2 * QuantileSketch().rank_error())
+
+    def test_create_approximate_small_input_fallback(self):
+        data = list(range(100))
+        bins_repr_source = toBinRepresentation(create_bins(data, 8, approximate=True))
+        bins_repr_expected = toBinRepresentation(create_bins(data, 8))
+        self.assertCollectionEqual(bins_repr_source, bins_repr_expected)
+
+
+class BinSetTestCase(BinningTestCase):
+    """
+    Test cases for array-backed collections of bins.
+    """
+    def test_numerical_bin_set(self):
+        bins = create_bins([np.nan] + list(range(100)), 3)
+        self.assertTrue(isinstance(bins, BinSet))
+        self.assertEqual(len(bins), 3)
+        self.assertEqual(bins[-1], Bin("numerical", 50, 99, True, True))
+        self.assertEqual(bins, [Bin("numerical", np.nan, np.nan, True, True),
+                                Bin("numerical", 0, 50, True, False),
+                                Bin("numerical", 50, 99, True, True)])
+        self.assertEqual(bins[1:], BinSet.from_bins(list(bins)[1:]))
+        self.assertNotEqual(bins[1:], bins[:2])
+        with self.assertRaises(IndexError):
+            bins[3]
+
+    def test_categorical_bin_set(self):
+        bins = create_bins(pd.Series(["a"] * 5 + ["b"] * 3 + ["c"] * 2 + [np.nan]), 2)
+        self.assertTrue(isinstance(bins, BinSet))
+        self.assertEqual(bins, [Bin("categorical", ["b", "c"]), Bin("categorical", ["a", np.nan])])
+
+        data = pd.DataFrame({'feature': ["c", "a", np.nan, "d", "b"]})
+        np.testing.assert_array_equal(bins.assign(data, 'feature'), [0, 1, 1, -1, 0])
+        np.testing.assert_array_equal(assign_bins(data, 'feature', list(bins)), [0, 1, 1, -1, 0])
+
+    def test_bin_set_disjoint(self):
+        with self.assertRaises(ValueError):
+            BinSet.from_bins([Bin("categorical", ["a", "b"]), Bin("categorical", ["b"])])
+        with self.assertRaises(ValueError):
+            BinSet.from_bins([Bin("categorical", ["a"]), Bin("numerical", 0, 1, True, True)])
+
+
+class SerializeBinsTestCase(BinningTestCase):
+    """
+    Test cases for serializing and caching bins.
+    """
+    def test_bins_round_trip(self):
+        data = np.random.exponential(size=1000)
+        data[::10] = np.nan
+        bins = list(create_bins(data, 5)) + [Bin("categorical", ["a", "b"]), Bin("categorical", [np.nan, "c"])]
+        state = json.loads(json.dumps([bin.to_dict() for bin in bins]))
+        self.assertEqual(state[0], {'type': 'numerical', 'lower': None, 'upper': None,
+                                    'lower_closed': True, 'upper_closed': True})
+        self.assertEqual(state[6], {'type': 'categorical', 'categories': [None, 'c']})
+        self.assertEqual([Bin.from_dict(bin) for bin in state], bins)
+
+    def test_bin_cache(self):
+        data = np.arange(100.)
+        cache = BinCache()
+        bins = cache.create_bins('feature', data, 4)
+        self.assertEqual(bins, create_bins(data, 4))
+        self.assertTrue(cache.create_bins('feature', data, 4) is bins)
+        self.assertFalse(cache.create_bins('feature', data + 1, 4) is bins)
+        self.assertFalse(cache.create_bins('feature', data, 3) is bins)
+        self.assertTrue(cache.get('feature', data_fingerprint(data), 4) is bins)
+        self.assertIsNone(cache.get('other_feature', data_fingerprint(data), 4))
+
+    def test_bin_cache_directory(self):
+        directory = tempfile.mkdtemp()
+        try:
+            bins = BinCache(directory).create_bins('feature', np.arange(100.), 4, fingerprint='2018-01-01/2018-01-31')
+            # a new cache finds the bins without data
+            cache = BinCache(directory)
+            self.assertEqual(cache.get('feature', '2018-01-01/2018-01-31', 4), bins)
+            self.assertEqual(cache.create_bins('feature', None, 4, fingerprint='2018-01-01/2018-01-31'), bins)
+            self.assertIsNone(cache.get('feature', '2018-02-01/2018-02-28', 4))
+
+            # the bins loaded from disk are a BinSet like the computed ones
+            loaded = BinCache(directory).create_bins('feature', None, 4, fingerprint='2018-01-01/2018-01-31')
+            self.assertTrue(isinstance(loaded, BinSet))
+            self.assertEqual(loaded[1:], bins[1:])
+            data = pd.DataFrame({'feature': [-1., 0., 50., 99., np.nan]})
+            np.testing.assert_array_equal(loaded.assign(data, 'feature'), bins.assign(data, 'feature'))
+
+            # a list of bins is stored as a BinSet
+            cache.put('other_feature', 'fingerprint', 2, [Bin("categorical", ["a"]), Bin("categorical", ["b"])])
+            self.assertTrue(isinstance(BinCache(directory).get('other_feature', 'fingerprint', 2), BinSet))
+        finally:
+            shutil.rmtree(directory)
+
+
 class ApplyNumericalBinsTestCase(BinningTestCase):
     """
     Test cases for applying bins to numerical data.
@@ -198,6 +358,41 @@ class ApplyNumericalBinsTestCase(BinningTestCase):
         data_applied_bin4 = pd.DataFrame(np.tile(np.array([np.arange(900, 1000)]).T, (1, 3)), columns=list('ABC'))
         np.testing.assert_array_equal(data_applied_bin4, bin4(data, dimension))
 
+    def test_assign_bins(self):
+        data = pd.DataFrame({'feature': [0., 1., 2., 3., np.nan, 10.]})
+        bins = [Bin("numerical", np.nan, np.nan, True, True),
+                Bin("numerical", 0, 2, True, False),
+                Bin("numerical", 2, 3, True, True)]
+        np.testing.assert_array_equal(assign_bins(data, 'feature', bins), [1, 1, 2, 2, 0, -1])
+
+    def test_assign_bin_set_edges(self):
+        data = pd.DataFrame({'feature': [np.nan, -1., 0., 0.5, 1., 1.5, 2., 3., 4., 5., np.inf]})
+        bins = [Bin("numerical", 0, 1, False, True),
+                Bin("numerical", 1, 2, False, False),
+                Bin("numerical", 2, 2, True, True),
+                Bin("numerical", 3, 4, True, False),
+                Bin("numerical", np.nan, np.nan, True, True),
+                Bin("numerical", 4, np.inf, False, True)]
+        expected = [4, -1, -1, 0, 0, 1, 2, 3, -1, 5, 5]
+        np.testing.assert_array_equal(BinSet.from_bins(bins).assign(data, 'feature'), expected)
+        np.testing.assert_array_equal(assign_bins(data, 'feature', bins), expected)
+
+    def test_assign_bin_set_overlapping(self):
+        # overlapping bins assign a row to the first bin containing it
+        data = pd.DataFrame({'feature': np.arange(10.)})
+        bins = [Bin("numerical", 2, 5, True, True), Bin("numerical", 0, 9, True, False)]
+        np.testing.assert_array_equal(BinSet.from_bins(bins).assign(data, 'feature'),
+                                      [1, 1, 0, 0, 0, 0, 1, 1, 1, -1])
+
+    def test_assign_bin_set_many_bins(self):
+        data = pd.DataFrame({'feature': np.random.normal(size=10000)})
+        data.loc[::100, 'feature'] = np.nan
+        bins = create_bins(data.feature, 50)
+        expected = np.full(len(data), -1)
+        for i, bin in enumerate(bins):
+            expected[np.asarray(bin.mask(data, 'feature'))] = i
+        np.testing.assert_array_equal(bins.assign(data, 'feature'), expected)
+
     def test_assign_unseen_data(self):
         data = pd.DataFrame(np.tile(np.array([np.arange(1000)]).T, (1,3)), columns=list('ABC'))
         dimension = 'A'
@@ -251,6 +446,28 @@ class CreateCategoricalBinsTestCase(BinningTestCase):
         bins = create_bins(data, 4)
         self.assertEqual(len(bins), 3)
 
+    def test_categorical_binning_series(self):
+        """ Categorical pandas series are binned from their codes, unused categories are ignored. """
+        data = pd.Series(['a'] * 10 + ['b'] * 5 + ['c'] * 5).astype('category')
+        data = data.cat.add_categories(['unused'])
+        bins = create_bins(data, 2)
+        bins_repr_source = toBinRepresentation(bins)
+        bins_repr_expected = [
+            CategoricalRepresentation(["a"]),
+            CategoricalRepresentation(["c", "b"])
+        ]
+        self.assertCollectionEqual(bins_repr_source, bins_repr_expected)
+
+    def test_categorical_binning_nan(self):
+        """ Missing values form a category, but do not count as a distinct value. """
+        data = np.array(['a'] * 10 + [np.nan] * 6 + ['b'] * 5, dtype=object)
+        with warnings.catch_warnings(record=True) as w:
+            bins = create_bins(data, 3)
+            self.assertEqual(len(w), 1)
+        self.assertEqual(len(bins), 2)
+        df = pd.DataFrame({'feature': data})
+        self.assertEqual(sum(len(bin(df, 'feature')) for bin in bins), len(data))
+
     def test_binning_date_1(self):
         data = ['2017-05-01'] * 10 + ['2017-06-01'] * 5 + ['2017-07-01'] * 5
 
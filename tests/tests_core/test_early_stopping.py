@@ -1,9 +1,15 @@
+import json
+import os
+import shutil
+import tempfile
 import unittest
+import warnings
 
 import numpy as np
 
 import expan.core.early_stopping as es
-from expan.core.util import find_list_of_dicts_element
+import expan.core.statistics as statx
+from expan.core.util import find_list_of_dicts_element, fingerprint
 
 
 class EarlyStoppingTestCase(unittest.TestCase):
@@ -101,6 +107,212 @@ class GroupSequentialTestCases(EarlyStoppingTestCase):
         np.testing.assert_almost_equal (value975,                     -0.07312917030429833, decimal=5)
 
 
+    def test_pocock(self):
+        """
+        Check the Pocock spending function.
+        """
+        np.testing.assert_almost_equal(es.pocock(np.array([0.5, 1.0])), [0.03100573, 0.05])
+
+    def test_hwang_shih_decani(self):
+        """
+        Check the Hwang-Shih-DeCani spending functions.
+        """
+        self.assertAlmostEqual(es.hwang_shih_decani(1.0), 0.05)
+        self.assertAlmostEqual(es.hwang_shih_decani(0.5, gamma=0), 0.025)
+        self.assertAlmostEqual(es.hwang_shih_decani(0.5, gamma=-4), 0.00596014, places=7)
+
+    def test_group_sequential_unknown_spending_function(self):
+        with self.assertRaises(NotImplementedError):
+            es.group_sequential(self.rand_s1, self.rand_s2, spending_function='obrien')
+
+    def test_group_sequential_pocock(self):
+        res = es.group_sequential(self.rand_s1, self.rand_s2, spending_function='pocock',
+                                  estimated_sample_size=4000)
+        self.assertEqual(res['stop'], True)
+        value025 = find_list_of_dicts_element(res['confidence_interval'], 'percentile', 1.55029, 'value')
+        self.assertLess(value025, -0.24461812530841959)
+
+
+    def test_group_sequential_from_statistics(self):
+        """
+        Check that the vectorized method on sufficient statistics agrees with group_sequential.
+        """
+        pairs = [(self.rand_s1, self.rand_s2), (self.rand_s5, self.rand_s6), (self.rand_s3, self.rand_s4)]
+        stats_x = np.array([statx.sufficient_statistics(x) for x, _ in pairs]).T
+        stats_y = np.array([statx.sufficient_statistics(y) for _, y in pairs]).T
+        res = es.group_sequential_from_statistics(*np.concatenate([stats_x, stats_y]), estimated_sample_size=4000)
+
+        for i, (x, y) in enumerate(pairs):
+            expected = es.group_sequential(x, y, estimated_sample_size=4000)
+            self.assertEqual(res['stop'][i], expected['stop'])
+            self.assertAlmostEqual(res['delta'][i], expected['delta'])
+            self.assertAlmostEqual(res['lower_bound'][i], expected['confidence_interval'][0]['value'])
+            self.assertAlmostEqual(res['upper_bound'][i], expected['confidence_interval'][1]['value'])
+            self.assertAlmostEqual(res['treatment_variance'][i], expected['treatment_variance'])
+
+    def test_group_sequential_from_statistics_design(self):
+        design = es.get_group_sequential_design(5, futility=True)
+        res = es.group_sequential_from_statistics([250, 1000, 2500], 0.1, [250, 1000, 2500],
+                                                  [250, 1000, 2500], 0., [250, 1000, 2500],
+                                                  estimated_sample_size=5000, design=design)
+        np.testing.assert_array_equal(res['stop'], [False, False, True])
+        np.testing.assert_allclose(res['lower_percentile'], design.nominal_alpha[[0, 1, 4]] * 50)
+
+    def test_group_sequential_zero_variance(self):
+        """
+        Check that samples without variance do not divide by zero.
+        """
+        with warnings.catch_warnings():
+            warnings.simplefilter('error', RuntimeWarning)
+            same = es.group_sequential(np.ones(10), np.ones(10))
+            different = es.group_sequential(np.ones(10), np.zeros(10))
+        self.assertEqual(same['stop'], False)
+        self.assertEqual(different['stop'], True)
+        self.assertEqual(different['confidence_interval'][0]['value'], 1.0)
+
+
+class GroupSequentialDesignTestCases(EarlyStoppingTestCase):
+    """
+      Test cases for the planned group sequential boundaries in core.early_stopping.
+      """
+
+    def test_single_look(self):
+        design = es.GroupSequentialDesign([1.0])
+        np.testing.assert_almost_equal(design.efficacy_bounds, [1.959964], decimal=5)
+
+    def test_pocock_boundaries(self):
+        # Jennison & Turnbull (2000), table 7.6: Pocock-type spending, 5 equally spaced looks
+        design = es.GroupSequentialDesign(np.linspace(0.2, 1, 5), spending_function='pocock')
+        np.testing.assert_almost_equal(design.efficacy_bounds, [2.438, 2.427, 2.410, 2.397, 2.386], decimal=3)
+
+    def test_obrien_fleming_boundaries(self):
+        design = es.GroupSequentialDesign(np.linspace(0.2, 1, 5))
+        # the first look spends exactly what the spending function allows
+        self.assertAlmostEqual(design.nominal_alpha[0], es.obrien_fleming(0.2), places=10)
+        np.testing.assert_almost_equal(design.efficacy_bounds, [4.3826, 3.0997, 2.5534, 2.2538, 2.0635], decimal=3)
+        self.assertTrue(np.all(np.diff(design.efficacy_bounds) < 0))
+
+    def test_futility_boundaries(self):
+        design = es.GroupSequentialDesign(np.linspace(0.2, 1, 5), futility=True)
+        self.assertTrue(np.all(np.diff(design.futility_bounds) > 0))
+        self.assertTrue(np.all(design.futility_bounds <= design.efficacy_bounds))
+        self.assertAlmostEqual(design.futility_bounds[-1], design.efficacy_bounds[-1])
+
+    def test_invalid_fractions(self):
+        with self.assertRaises(ValueError):
+            es.GroupSequentialDesign([0.5, 0.4])
+        with self.assertRaises(ValueError):
+            es.GroupSequentialDesign([0.5, 1.5])
+
+    def test_look(self):
+        design = es.get_group_sequential_design(4)
+        self.assertEqual(design.look(0.1), 0)
+        self.assertEqual(design.look(0.25), 0)
+        self.assertEqual(design.look(0.6), 1)
+        self.assertEqual(design.look(1.0), 3)
+
+    def test_design_cache(self):
+        self.assertIs(es.get_group_sequential_design(5, spending_function='pocock'),
+                      es.get_group_sequential_design(5, spending_function='pocock'))
+        self.assertIsNot(es.get_group_sequential_design(5, spending_function='pocock'),
+                         es.get_group_sequential_design(5, spending_function='obrien_fleming'))
+
+    def test_make_group_sequential_with_looks(self):
+        worker = es.make_group_sequential(estimated_sample_size=2500, looks=5)
+        res = worker(self.rand_s1, self.rand_s2)
+        # 2000 of 2500 entities reach the fourth look
+        design = es.get_group_sequential_design(5)
+        self.assertEqual(res['stop'], True)
+        self.assertAlmostEqual(res['confidence_interval'][0]['percentile'],
+                               round(design.nominal_alpha[3] * 100 / 2, 5))
+
+    def test_make_group_sequential_futility(self):
+        worker = es.make_group_sequential(estimated_sample_size=2500, looks=5, futility=True)
+        res = worker(self.rand_s1, self.rand_s1 + 0.001)
+        self.assertEqual(res['stop'], True)
+
+
+class AlwaysValidTestCases(EarlyStoppingTestCase):
+    """
+      Test cases for the always-valid sequential test in core.early_stopping.
+      """
+
+    def test_always_valid(self):
+        res = es.always_valid(self.rand_s1, self.rand_s5[1:])
+        self.assertEqual(res['stop'], False)
+        self.assertAlmostEqual(res['delta'], np.mean(self.rand_s1) - np.mean(self.rand_s5[1:]))
+        self.assertEqual(res['treatment_sample_size'], 1000)
+        lower = find_list_of_dicts_element(res['confidence_interval'], 'percentile',  2.5, 'value')
+        upper = find_list_of_dicts_element(res['confidence_interval'], 'percentile', 97.5, 'value')
+        self.assertLess(lower, res['delta'])
+        self.assertGreater(upper, res['delta'])
+        self.assertGreater(res['p_value'], 0.05)
+
+    def test_always_valid_nan(self):
+        res = es.always_valid(self.rand_s5, self.rand_s6)
+        self.assertEqual(res['treatment_sample_size'], 999)
+        self.assertEqual(res['control_sample_size'], 998)
+
+    def test_always_valid_stop(self):
+        res = es.always_valid(self.rand_s1, self.rand_s1 + 0.5)
+        self.assertEqual(res['stop'], True)
+        self.assertLess(res['p_value'], 0.05)
+
+    def test_batch_updates(self):
+        """ Updating batch by batch gives the statistics of the full samples. """
+        test = es.AlwaysValidTest(mixing_variance=0.01)
+        for start in range(0, 1000, 100):
+            test.update(self.rand_s1[start:start + 100], self.rand_s2[start:start + 100])
+        res = es.always_valid(self.rand_s1, self.rand_s2, mixing_variance=0.01)
+        self.assertEqual(test.treatment[0], 1000)
+        self.assertAlmostEqual(test.treatment[1], res['treatment_mean'])
+        self.assertAlmostEqual(test.control[2] / 1000., res['control_variance'])
+        # the running p-value is the minimum over all looks
+        self.assertLessEqual(test.p_value, res['p_value'])
+
+    def test_type_I_error(self):
+        """ Looking after every batch keeps the type-I error. """
+        random_state = np.random.RandomState(0)
+        rejections = 0
+        for _ in range(200):
+            test = es.AlwaysValidTest(mixing_variance=0.01)
+            for _ in range(50):
+                test.update(random_state.normal(size=100), random_state.normal(size=100))
+                if test.p_value < 0.05:
+                    rejections += 1
+                    break
+        self.assertLessEqual(rejections / 200., 0.05)
+
+    def test_state_store(self):
+        """ Only the appended observations are added to the stored state, which is JSON serializable. """
+        store = {}
+        es.always_valid(self.rand_s1[:500], self.rand_s2[:500], state_store=store, key='kpi')
+        res = es.always_valid(self.rand_s1, self.rand_s2, state_store=store, key='kpi')
+        self.assertEqual(res['treatment_sample_size'], 1000)
+        self.assertAlmostEqual(res['treatment_mean'], np.mean(self.rand_s1))
+
+        restored = json.loads(json.dumps(store))
+        self.assertEqual(restored['kpi']['treatment_rows'], 1000)
+        test = es.AlwaysValidTest.from_dict(restored['kpi']['state'])
+        self.assertEqual(test.to_dict(), store['kpi']['state'])
+
+        # a shorter sample starts the state anew
+        res = es.always_valid(self.rand_s1[:100], self.rand_s2[:100], state_store=store, key='kpi')
+        self.assertEqual(res['treatment_sample_size'], 100)
+
+    def test_state_store_changed_samples(self):
+        """ Changed earlier observations or another mixing variance start the state anew. """
+        store = {}
+        es.always_valid(self.rand_s1[:500], self.rand_s2[:500], state_store=store, key='kpi')
+        changed = self.rand_s1 * 2
+        res = es.always_valid(changed, self.rand_s2, state_store=store, key='kpi')
+        self.assertEqual(res, es.always_valid(changed, self.rand_s2))
+
+        es.always_valid(self.rand_s1[:500], self.rand_s2[:500], state_store=store, key='kpi')
+        res = es.always_valid(self.rand_s1, self.rand_s2, mixing_variance=0.5, state_store=store, key='kpi')
+        self.assertEqual(res, es.always_valid(self.rand_s1, self.rand_s2, mixing_variance=0.5))
+
+
 class BayesFactorTestCases(EarlyStoppingTestCase):
     """
       Test cases for the bayes_factor function in core.early_stopping.
@@ -149,17 +361,302 @@ class BayesFactorTestCases(EarlyStoppingTestCase):
         res= es.bayes_factor(self.rand_s5, self.rand_s6, num_iters=2000)
         self.assertEqual(res['stop'], True)
 
+    def test_sampling_cache(self):
+        """
+        Check that memoized sampling results are looked up by the content of the samples.
+        """
+        cache = es.configure_sampling_cache(enabled=True, max_entries=2)
+        try:
+            x = np.array(self.rand_s1, dtype=float)
+            y = np.array(self.rand_s2, dtype=float)
+            key = fingerprint(x, y, 'normal', 2000, 'sampling', 4, None, 1, None, None, 0.01, 1000, 'meanfield')
+            cached = ({'delta': np.zeros(10), 'alpha': np.zeros(10)}, 1000, 1000, 0.0, 0.0, {})
+            cache.put(key, cached)
+
+            self.assertIs(es._bayes_sampling(self.rand_s1, self.rand_s2, num_iters=2000), cached)
+            self.assertEqual(cache.stats()['hits'], 1)
+        finally:
+            es.configure_sampling_cache(enabled=False)
+
     def test_variational_inference(self):
         """
         Check bayesian sampling using variational bayes.
         """
-        traces, n_x, n_y, mu_x, mu_y = es._bayes_sampling(self.rand_s1, self.rand_s2, num_iters=2000, inference="variational")
+        traces, n_x, n_y, mu_x, mu_y, _ = es._bayes_sampling(self.rand_s1, self.rand_s2, num_iters=2000,
+                                                             inference="variational")
 
         self.assertEqual(len(traces), 4)
-        self.assertEqual(len(traces['delta']), 1001)
+        self.assertEqual(len(traces['delta']), 1000)
         self.assertEqual(n_x, 1000)
         self.assertEqual(n_y, 1000)
 
+    def test_variational_inference_options(self):
+        traces, _, _, _, _, info = es._bayes_sampling(self.rand_s1, self.rand_s2, num_iters=2000,
+                                                      inference="variational", output_samples=500,
+                                                      algorithm='fullrank', tol_rel_obj=0.001)
+        self.assertEqual(len(traces['delta']), 500)
+        self.assertEqual(info['converged'], True)
+        self.assertLessEqual(info['number_of_iterations'], 2000)
+        self.assertLess(info['relative_elbo_change'], 0.01)
+        self.assertGreater(info['fit_time'], 0)
+
+    def test_variational_inference_unknown_algorithm(self):
+        with self.assertRaises(NotImplementedError):
+            es._variational_inference(None, {}, algorithm='stochastic')
+
+    def test_read_elbo_trace(self):
+        handle, diagnostic_file = tempfile.mkstemp(suffix='.csv')
+        with os.fdopen(handle, 'w') as f:
+            f.write('# Stan diagnostics\n# iter,time_in_seconds,ELBO\n0,0,0\n'
+                    '100,0.02,-1512.3\n200,0.04,-1450.1\n300,0.06,-1449.8\n')
+        try:
+            iterations, elbo = es._read_elbo_trace(diagnostic_file)
+        finally:
+            os.remove(diagnostic_file)
+        np.testing.assert_array_equal(iterations, [100, 200, 300])
+        np.testing.assert_allclose(elbo, [-1512.3, -1450.1, -1449.8])
+
+
+    def test_bayes_factor_parallel_chains(self):
+        """
+        Check the Bayes factor function with chains sampled in parallel and a thinned trace.
+        """
+        res = es.bayes_factor(self.rand_s1, self.rand_s2, num_iters=2000, num_chains=2, n_jobs=2, thin=2)
+        self.assertEqual(res['stop'], True)
+        self.assertEqual(res['number_of_iterations'], 2000)
+        self.assertGreater(res['effective_sample_size'], 0)
+
+    def test_bayes_factor_target_ess(self):
+        """
+        Check that the adaptive mode draws until the target effective sample size is reached.
+        """
+        res = es.bayes_factor(self.rand_s1, self.rand_s2, num_iters=200, num_warmup=100, target_ess=1000)
+        self.assertGreaterEqual(res['number_of_iterations'], 200)
+        self.assertTrue(res['effective_sample_size'] >= 1000 or res['number_of_iterations'] == 2000)
+
+    def test_bayes_factor_warm_start(self):
+        """
+        Check that a second run on slightly more data is warm-started from the first one.
+        """
+        warm_start_dir = tempfile.mkdtemp()
+        try:
+            key = ('experiment', 'kpi', 'A')
+            es.bayes_factor(self.rand_s1[:900], self.rand_s2[:900], num_iters=2000,
+                            warm_start=warm_start_dir, warm_start_key=key)
+            res = es.bayes_factor(self.rand_s1, self.rand_s2, num_iters=2000,
+                                  warm_start=warm_start_dir, warm_start_key=key)
+
+            self.assertEqual(res['stop'], True)
+            # only the warmup is shortened, the number of kept draws stays the same
+            self.assertEqual(res['number_of_iterations'], 1200)
+            value025 = find_list_of_dicts_element(res['confidence_interval'], 'percentile', 2.5, 'value')
+            self.assertAlmostEqual(value025, -0.2429, delta=0.01)
+        finally:
+            shutil.rmtree(warm_start_dir)
+
+
+class JointModelTestCases(EarlyStoppingTestCase):
+    """
+      Test cases for the joint Bayesian model of several pairs of samples in core.early_stopping.
+      """
+
+    def test_joint_fit_data(self):
+        fit_data, summaries = es._joint_fit_data([(self.rand_s1, self.rand_s2), (self.rand_s5, self.rand_s6)])
+        self.assertEqual(fit_data['K'], 2)
+        self.assertEqual(fit_data['Nt'], 1999)
+        self.assertEqual(fit_data['Nc'], 1998)
+        self.assertEqual(list(np.bincount(fit_data['gt'])), [0, 1000, 999])
+        self.assertEqual(list(np.bincount(fit_data['gc'])), [0, 1000, 998])
+        self.assertEqual(summaries[1][:2], (999, 998))
+        self.assertAlmostEqual(summaries[0][2], np.mean(self.rand_s1))
+
+    def test_joint_fit_data_unknown_distribution(self):
+        with self.assertRaises(NotImplementedError):
+            es._joint_fit_data([(self.rand_s1, self.rand_s2)], 'gamma')
+
+    def test_bayes_factor_joint(self):
+        """ Every pair gets the same statistics as from its own model. """
+        res = es.bayes_factor_joint([(self.rand_s1, self.rand_s2), (self.rand_s3, self.rand_s4)], num_iters=2000)
+        self.assertEqual(len(res), 2)
+        self.assertAlmostEqual(res[0]['delta'], -0.15887364780635896)
+        value025 = find_list_of_dicts_element(res[0]['confidence_interval'], 'percentile',  2.5, 'value')
+        value975 = find_list_of_dicts_element(res[0]['confidence_interval'], 'percentile', 97.5, 'value')
+        self.assertAlmostEqual(value025, -0.2429, places=2)
+        self.assertAlmostEqual(value975, -0.0751, places=2)
+        self.assertEqual(res[1]['treatment_sample_size'], 1000)
+
+    def test_bayes_precision_joint(self):
+        res = es.bayes_precision_joint([(self.rand_s1, self.rand_s2)], num_iters=2000)
+        self.assertEqual(res[0]['stop'], False)
+        self.assertEqual(res[0]['number_of_iterations'], 2000)
+
+
+class HDITestCases(EarlyStoppingTestCase):
+    """
+      Test cases for the HDI_from_MCMC function in core.early_stopping.
+      """
+
+    @staticmethod
+    def shortest_interval(points, credible_mass):
+        # straightforward reference: scan all intervals covering the credible mass
+        points = sorted(points)
+        size = int(np.ceil(credible_mass * len(points)))
+        widths = [points[i + size] - points[i] for i in range(len(points) - size)]
+        i = widths.index(min(widths))
+        return points[i], points[i + size]
+
+    def test_single_trace(self):
+        res = es.HDI_from_MCMC(self.rand_s1, 0.95)
+        self.assertEqual(res, self.shortest_interval(self.rand_s1, 0.95))
+
+    def test_skewed_trace(self):
+        trace = np.random.exponential(size=5000)
+        lower, upper = es.HDI_from_MCMC(trace, 0.9)
+        self.assertEqual((lower, upper), self.shortest_interval(trace, 0.9))
+        # the shortest interval of an exponential distribution starts at its mode
+        self.assertLess(lower, 0.01)
+
+    def test_stacked_traces_and_masses(self):
+        traces = np.vstack([self.rand_s1, self.rand_s2, self.rand_s3])
+        masses = [0.5, 0.9, 0.95]
+        res = es.HDI_from_MCMC(traces, masses)
+        self.assertEqual(res.shape, (3, 3, 2))
+        for i in range(3):
+            for j in range(3):
+                self.assertEqual(tuple(res[i, j]), self.shortest_interval(traces[i], masses[j]))
+
+        self.assertEqual(es.HDI_from_MCMC(traces, 0.95).shape, (3, 2))
+        self.assertEqual(es.HDI_from_MCMC(self.rand_s1, masses).shape, (3, 2))
+
+
+class DensityAtPointTestCases(EarlyStoppingTestCase):
+    """
+      Test cases for the density_at_point function in core.early_stopping.
+      """
+
+    def setUp(self):
+        super(DensityAtPointTestCases, self).setUp()
+        self.trace = np.random.normal(loc=0.3, size=100000)
+
+    def test_kde(self):
+        self.assertAlmostEqual(es.density_at_point(self.trace, 0, 'kde'), 0.3813878, delta=0.005)
+
+    def test_binned_kde(self):
+        for point in [0., 0.3, -2.]:
+            expected = es.density_at_point(self.trace, point, 'kde')
+            self.assertAlmostEqual(es.density_at_point(self.trace, point, 'binned_kde') / expected, 1.0, delta=1e-3)
+
+    def test_histogram(self):
+        expected = es.density_at_point(self.trace, 0, 'kde')
+        self.assertAlmostEqual(es.density_at_point(self.trace, 0, 'histogram') / expected, 1.0, delta=0.03)
+
+    def test_point_outside_trace(self):
+        self.assertEqual(es.density_at_point(self.trace, 100., 'binned_kde'), 0.)
+
+    def test_not_implemented(self):
+        with self.assertRaises(NotImplementedError):
+            es.density_at_point(self.trace, 0, 'logspline')
+
+
+class EffectiveSampleSizeTestCases(EarlyStoppingTestCase):
+    """
+      Test cases for the effective_sample_size function in core.early_stopping.
+      """
+
+    def test_independent_draws(self):
+        draws = np.random.normal(size=(5000, 4))
+        ess = es.effective_sample_size(draws)
+        self.assertAlmostEqual(ess / 20000., 1.0, delta=0.1)
+
+    def test_autocorrelated_draws(self):
+        phi = 0.9
+        draws = np.zeros((20000, 2))
+        noise = np.random.normal(size=draws.shape)
+        for i in range(1, len(draws)):
+            draws[i] = phi * draws[i - 1] + noise[i]
+        ess = es.effective_sample_size(draws)
+        expected = 40000. * (1 - phi) / (1 + phi)
+        self.assertAlmostEqual(ess / expected, 1.0, delta=0.2)
+
+    def test_single_chain(self):
+        ess = es.effective_sample_size(np.random.normal(size=1000))
+        self.assertAlmostEqual(ess / 1000., 1.0, delta=0.15)
+
+
+class RecordingModel(object):
+    """ Stands in for a compiled Stan model with independent normal draws of 'mu' and 'delta[1]', 'delta[2]'. """
+
+    class Fit(object):
+        flatnames = ['mu', 'delta[1]', 'delta[2]']
+
+        def __init__(self, draws):
+            self.draws = draws
+
+        def extract(self, permuted=True):
+            return self.draws
+
+        def get_stepsize(self):
+            return [0.5] * self.draws.shape[1]
+
+    def __init__(self):
+        self.calls = []
+        self.fits = []
+
+    def sampling(self, data, iter, warmup, chains, seed, **kwargs):
+        self.calls.append(dict(kwargs, iter=iter, warmup=warmup, seed=seed))
+        self.fits.append(self.Fit(np.random.RandomState(seed).normal(size=(iter - warmup, chains, 4))))
+        return self.fits[-1]
+
+
+class AdaptiveSamplingTestCases(EarlyStoppingTestCase):
+    """
+      Test cases for the continuation of chains in the adaptive mode of the Bayesian methods.
+      """
+
+    def test_traces_from_draws(self):
+        draws = np.arange(24.).reshape(3, 2, 4)
+        traces = es._traces_from_draws(['mu', 'delta[1]', 'delta[2]'], draws)
+        self.assertEqual(set(traces), set(['mu', 'delta', 'lp__']))
+        np.testing.assert_array_equal(traces['mu'], [0, 4, 8, 12, 16, 20])
+        np.testing.assert_array_equal(traces['delta'][:, 1], [2, 6, 10, 14, 18, 22])
+        np.testing.assert_array_equal(traces['lp__'], [3, 7, 11, 15, 19, 23])
+
+    def test_single_run(self):
+        sm = RecordingModel()
+        args = {'chains': 2, 'seed': 1, 'control': {'adapt_delta': 0.99}}
+        traces, iterations, ess, _, _ = es._adaptive_sampling(sm, {}, 200, 100, args, ['delta[1]'])
+        self.assertEqual(len(sm.calls), 1)
+        self.assertEqual(iterations, 200)
+        self.assertEqual(traces['delta'].shape, (200, 2))
+        self.assertEqual(len(ess), 1)
+
+    def test_continuation(self):
+        sm = RecordingModel()
+        args = {'chains': 2, 'seed': 1, 'control': {'adapt_delta': 0.99}}
+        traces, iterations, ess, fit, draws = es._adaptive_sampling(sm, {}, 200, 100, args,
+                                                                    ['delta[1]', 'delta[2]'], 500, 2000)
+        self.assertGreater(len(sm.calls), 1)
+        self.assertGreaterEqual(min(ess), 500)
+        self.assertEqual(sm.calls[0]['warmup'], 100)
+        self.assertEqual(iterations, sum(call['iter'] for call in sm.calls))
+        # the draws of all runs are kept and only the first run has a warmup
+        self.assertEqual(len(draws), iterations - 100)
+        self.assertEqual(traces['delta'].shape, (2 * (iterations - 100), 2))
+        for previous, call in zip(sm.calls, sm.calls[1:]):
+            self.assertEqual(call['warmup'], 0)
+            self.assertNotEqual(call['seed'], previous['seed'])
+            self.assertEqual(call['control'], {'adapt_delta': 0.99, 'adapt_engaged': False, 'stepsize': 0.5})
+        # the chains continue from their last draws
+        last = sm.fits[-2].draws[-1, 1]
+        self.assertEqual(sm.calls[-1]['init'][1], {'mu': last[0], 'delta': list(last[1:3])})
+
+    def test_max_iters(self):
+        sm = RecordingModel()
+        args = {'chains': 2, 'seed': 1, 'control': {}}
+        _, iterations, _, _, _ = es._adaptive_sampling(sm, {}, 200, 100, args, ['delta[1]'], 10 ** 6, 1000)
+        self.assertEqual(iterations, 1000)
+        self.assertEqual(sum(call['iter'] for call in sm.calls), 1000)
+
 
 class BayesPrecisionTestCases(EarlyStoppingTestCase):
     """
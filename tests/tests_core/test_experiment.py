@@ -1,9 +1,11 @@
+import subprocess
+import sys
 import unittest
 import warnings
 
 import numpy as np
 
-from expan.core.binning import Bin
+from expan.core.binning import Bin, BinSet, create_bins
 from expan.core.experiment import Experiment
 # from expan.core.results import Results
 from expan.core.util import generate_random_data, get_column_names_by_type, find_list_of_dicts_element
@@ -180,6 +182,39 @@ class ExperimentClassTestCases(ExperimentTestCase):
                            [self.derived_kpi_1, self.derived_kpi_2]).delta('group_sequential')
 
 
+    def test_always_valid_delta(self):
+        res = self.getExperiment(['normal_same']).delta(method='always_valid')
+
+        variants = find_list_of_dicts_element(res['kpis'], 'name', 'normal_same', 'variants')
+        aStats   = find_list_of_dicts_element(variants, 'name', 'A', 'delta_statistics')
+        self.assertNumericalEqual(aStats['delta'], 0.033053, 5)
+        self.assertEqual(aStats['treatment_sample_size'], 6108)
+        self.assertEqual(aStats['control_sample_size'],   3892)
+        self.assertEqual(aStats['stop'], False)
+
+    def test_always_valid_delta_state_store(self):
+        store = {}
+        self.getExperiment(['normal_same']).delta(method='always_valid', state_store=store)
+        self.assertIn(('random_data_generation', 'normal_same', 'A'), store)
+
+    def test_always_valid_delta_state_store_derived_kpi(self):
+        """ Derived kpis are reweighted over the whole sample, their result equals a fresh evaluation. """
+        store = {}
+        kpis = ['normal_same', self.derived_kpi_1['name']]
+        experiment = self.getExperiment(kpis, [self.derived_kpi_1])
+        Experiment('B', self.data.iloc[:5000], self.metadata, kpis,
+                   [self.derived_kpi_1]).delta(method='always_valid', state_store=store)
+        res = experiment.delta(method='always_valid', state_store=store)
+        expected = experiment.delta(method='always_valid')
+
+        variants = find_list_of_dicts_element(res['kpis'], 'name', self.derived_kpi_1['name'], 'variants')
+        expected_variants = find_list_of_dicts_element(expected['kpis'], 'name', self.derived_kpi_1['name'],
+                                                       'variants')
+        self.assertEqual(find_list_of_dicts_element(variants, 'name', 'A', 'delta_statistics'),
+                         find_list_of_dicts_element(expected_variants, 'name', 'A', 'delta_statistics'))
+        self.assertNotIn(('random_data_generation', self.derived_kpi_1['name'], 'A'), store)
+
+
     # @unittest.skip("sometimes takes too much time")
     def test_bayes_factor_delta(self):
         ndecimals = 5
@@ -210,6 +245,22 @@ class ExperimentClassTestCases(ExperimentTestCase):
         res = exp.delta(method='bayes_factor', num_iters=2000)
 
 
+    def test_bayes_factor_delta_joint(self):
+        res = self.getExperiment(['normal_same', 'normal_shifted']).delta(method='bayes_factor', joint=True,
+                                                                           num_iters=2000)
+        variants = find_list_of_dicts_element(res['kpis'], 'name', 'normal_same', 'variants')
+        aStats   = find_list_of_dicts_element(variants, 'name', 'A', 'delta_statistics')
+        self.assertNumericalEqual(aStats['delta'], 0.033053, 5)
+        self.assertNumericalEqual(aStats['confidence_interval'][0]['value'], -0.00829, 2)
+        self.assertNumericalEqual(aStats['confidence_interval'][1]['value'],  0.07127, 2)
+        self.assertEqual(aStats['treatment_sample_size'], 6108)
+        self.assertNumericalEqual(aStats['statistical_power'], 0.36401, 5)
+
+    def test_joint_delta_unsupported_method(self):
+        with self.assertRaises(NotImplementedError):
+            self.getExperiment(['normal_same']).delta(method='group_sequential', joint=True)
+
+
     # @unittest.skip("sometimes takes too much time")
     def test_bayes_precision_delta(self):
         ndecimals = 5
@@ -383,6 +434,103 @@ class ExperimentClassTestCases(ExperimentTestCase):
         self.assertEqual(len(sga_result), 4)
 
 
+    def test_sga_bin_set(self):
+        exp = self.getExperiment([self.derived_kpi_1['name']], [self.derived_kpi_1])
+        bins = create_bins(exp.data.normal_same, 4)
+        self.assertTrue(isinstance(bins, BinSet))
+        sga_result = exp.sga({"normal_same": bins})
+        expected = exp.sga({"normal_same": list(bins)})
+        self.assertEqual(len(sga_result), 4)
+        for res, expected_res in zip(sga_result, expected):
+            self.assertEqual(res['segment'], expected_res['segment'])
+            self.assertEqual(res['validity'], expected_res['validity'])
+            self.assertEqual(res['result']['kpis'], expected_res['result']['kpis'])
+
+
+    def test_sga_validity(self):
+        exp = self.getExperiment([self.derived_kpi_1['name']], [self.derived_kpi_1])
+        dimension_to_bin = {
+            "feature": [
+                Bin("categorical", ["has"]),
+                Bin("categorical", ["feature that only has one data point"]),
+                Bin("categorical", ["feature without data"])
+            ]
+        }
+        sga_result = exp.sga(dimension_to_bin, include_invalid=True)
+        self.assertEqual(len(sga_result), 3)
+        self.assertTrue(sga_result[0]['validity']['valid'])
+        self.assertEqual(sum(sga_result[0]['validity']['sample_sizes'].values()),
+                         len(dimension_to_bin["feature"][0](exp.data, "feature")))
+        self.assertTrue("result" in sga_result[0])
+
+        self.assertFalse(sga_result[1]['validity']['valid'])
+        self.assertEqual(sga_result[1]['validity']['sample_sizes'], {'A': 1, 'B': 0})
+        self.assertEqual(sga_result[1]['validity']['reason'], 'less than 1 entities in variants: B')
+        self.assertFalse("result" in sga_result[1])
+        self.assertEqual(sga_result[2]['validity']['reason'], 'no data')
+
+
+    def test_sga_min_observations(self):
+        exp = self.getExperiment([self.derived_kpi_1['name']], [self.derived_kpi_1])
+        dimension_to_bin = {"normal_same": [Bin("numerical", 1, 2, True, False), Bin("numerical", 2, 3, True, False)]}
+        sample_sizes = [res['validity']['sample_sizes'] for res in exp.sga(dimension_to_bin)]
+        threshold = min(sample_sizes[1].values()) + 1
+        sga_result = exp.sga(dimension_to_bin, min_observations=threshold)
+        self.assertEqual(len(sga_result), 1)
+        self.assertEqual(sga_result[0]['segment'], '[1, 2)')
+
+        crossed_dimension_to_bin = {("normal_same", "feature"): [dimension_to_bin["normal_same"],
+                                                                  [Bin("categorical", ["has"])]]}
+        sga_result = exp.sga(crossed_dimension_to_bin, min_observations=threshold, include_invalid=True)
+        self.assertEqual(len(sga_result), 2)
+        self.assertFalse(sga_result[1]['validity']['valid'])
+        self.assertTrue('less than {} entities'.format(threshold) in sga_result[1]['validity']['reason'])
+
+
+    def test_sga_crossed(self):
+        exp = self.getExperiment(['normal_same', self.derived_kpi_1['name']], [self.derived_kpi_1])
+        numerical_bins = [Bin("numerical", -10, 0, True, False), Bin("numerical", 0, 10, True, True)]
+        categorical_bins = [Bin("categorical", ["has"]), Bin("categorical", ["non"])]
+        sga_result = exp.sga({("normal_same", "feature"): [numerical_bins, categorical_bins]})
+
+        self.assertEqual(len(sga_result), 4)
+        subgroup_res = sga_result[1]
+        self.assertEqual(subgroup_res['dimension'], ['normal_same', 'feature'])
+        self.assertEqual(subgroup_res['segment'], ['[-10, 0)', "['non']"])
+
+        # the cell is analysed like the data of its subgroup
+        subgroup_data = categorical_bins[1](numerical_bins[0](exp.data, "normal_same"), "feature")
+        expected = exp._delta(method='fixed_horizon', data=subgroup_data, multi_test_correction=False)
+        for kpi, expected_kpi in zip(subgroup_res['result']['kpis'], expected['kpis']):
+            self.assertEqual(kpi['name'], expected_kpi['name'])
+            for variant, expected_variant in zip(kpi['variants'], expected_kpi['variants']):
+                statistics, expected_statistics = variant['delta_statistics'], expected_variant['delta_statistics']
+                self.assertEqual(statistics['treatment_sample_size'], expected_statistics['treatment_sample_size'])
+                self.assertEqual(statistics['control_sample_size'], expected_statistics['control_sample_size'])
+                for key in ['delta', 'treatment_mean', 'control_variance', 'statistical_power']:
+                    self.assertAlmostEqual(statistics[key], expected_statistics[key])
+
+
+    def test_sga_crossed_not_valid_cells(self):
+        exp = self.getExperiment([self.derived_kpi_1['name']], [self.derived_kpi_1])
+        numerical_bins = [Bin("numerical", 1, 2, True, False),
+                          Bin("numerical", 999998, 999999, False, False)]  # bin which does not have any data
+        categorical_bins = [Bin("categorical", ["has"]),
+                            Bin("categorical", ["non"]),
+                            Bin("categorical", ["feature that only has one data point"])]
+        sga_result = exp.sga({("normal_same", "feature"): [numerical_bins, categorical_bins],
+                              "feature": categorical_bins})
+        self.assertEqual(len(sga_result), 4)
+        self.assertEqual(len([res for res in sga_result if res['dimension'] == 'feature']), 2)
+
+
+    def test_sga_crossed_invalid_bin_list_type(self):
+        exp = self.getExperiment([self.derived_kpi_1['name']], [self.derived_kpi_1])
+        dimension_to_bin = {("normal_same", "feature"): [[Bin("numerical", 1, 10, True, True)]]}
+        with self.assertRaisesRegexp(TypeError, "Value of crossed dimensions needs to be a list of lists"):
+            exp.sga(dimension_to_bin)
+
+
     def test_sga_date(self):
         exp = self.getExperiment([self.derived_kpi_1['name']], [self.derived_kpi_1])
 
@@ -392,5 +540,22 @@ class ExperimentClassTestCases(ExperimentTestCase):
         self.assertEqual(numerical_dimension_name, 'date')
 
 
+class ImportTestCases(unittest.TestCase):
+    """
+    Test cases guarding the import time of the package.
+    """
+
+    def test_heavy_dependencies_are_imported_lazily(self):
+        code = ("import time; start = time.time(); import expan; elapsed = time.time() - start; "
+                "import sys; print(elapsed); "
+                "print('pystan' in sys.modules); print('expan.core.early_stopping' in sys.modules)")
+        output = subprocess.check_output([sys.executable, '-c', code]).decode().split()
+        elapsed, pystan_loaded, early_stopping_loaded = output[-3:]
+        self.assertEqual(pystan_loaded, 'False')
+        self.assertEqual(early_stopping_loaded, 'False')
+        # PyStan alone used to take several seconds to import
+        self.assertLess(float(elapsed), 5.0)
+
+
 if __name__ == '__main__':
     unittest.main()
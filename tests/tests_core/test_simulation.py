@@ -0,0 +1,65 @@
+import unittest
+
+import numpy as np
+
+import expan.core.simulation as sim
+
+
+class SimulationTestCase(unittest.TestCase):
+    """
+    Checks the simulated operating characteristics of the group sequential method.
+    """
+
+    def setUp(self):
+        self.sample_sizes = [2000, 4000, 6000, 8000, 10000]
+
+    def test_cumulative_statistics(self):
+        """ The simulated cumulative statistics have the distribution of the statistics of growing samples. """
+        n = np.array([100, 300, 1000])
+        mean, var = sim._simulate_cumulative_statistics(n, 1.0, 2.0, 20000, np.random.RandomState(0))
+        self.assertEqual(mean.shape, (20000, 3))
+        np.testing.assert_allclose(mean.mean(axis=0), 1.0, atol=0.01)
+        np.testing.assert_allclose(mean.std(axis=0), 2.0 / np.sqrt(n), rtol=0.03)
+        np.testing.assert_allclose(var.mean(axis=0), 4.0 * (n - 1) / n, rtol=0.01)
+
+    def test_type_I_error_planned(self):
+        """ The planned design keeps the type-I error. """
+        res = sim.simulate_group_sequential(self.sample_sizes, n_simulations=50000, planned=True, seed=1)
+        self.assertAlmostEqual(res['rejection_rate'], 0.05, delta=0.005)
+        self.assertEqual(len(res['stopping_probabilities']), 5)
+        self.assertAlmostEqual(sum(res['stopping_probabilities']), res['rejection_rate'])
+        self.assertAlmostEqual(res['bounds'][0], 4.3826, places=3)
+
+    def test_type_I_error_unplanned(self):
+        """ Spending alpha anew at every look inflates the type-I error. """
+        res = sim.simulate_group_sequential(self.sample_sizes, n_simulations=50000, seed=1)
+        self.assertGreater(res['rejection_rate'], 0.055)
+        self.assertEqual(res['futility_rate'], 0.0)
+
+    def test_operating_characteristics(self):
+        """ A design for 80% power has that power and stops earlier than the maximum sample size. """
+        res = sim.operating_characteristics(self.sample_sizes, 0.06, n_simulations=50000, planned=True,
+                                            futility=True, seed=2)
+        self.assertLess(res['type_I_error'], 0.05)
+        self.assertAlmostEqual(res['power'], 0.8, delta=0.02)
+        self.assertLess(res['expected_sample_size_null'], 10000)
+        self.assertLess(res['expected_sample_size_alternative'], 10000)
+
+    def test_reproducible(self):
+        res1 = sim.simulate_group_sequential(self.sample_sizes, effect=0.05, n_simulations=1000, seed=3)
+        res2 = sim.simulate_group_sequential(self.sample_sizes, effect=0.05, n_simulations=1000, seed=3)
+        self.assertEqual(res1, res2)
+
+    def test_invalid_looks(self):
+        with self.assertRaises(ValueError):
+            sim.simulate_group_sequential([1000, 500])
+        with self.assertRaises(ValueError):
+            sim.simulate_group_sequential(self.sample_sizes, futility=True)
+
+    def test_bayesian_unknown_method(self):
+        with self.assertRaises(NotImplementedError):
+            sim.simulate_bayesian(self.sample_sizes, method='group_sequential')
+
+
+if __name__ == '__main__':
+    unittest.main()
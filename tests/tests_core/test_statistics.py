@@ -152,6 +152,31 @@ class DeltaTestCases(StatisticsTestCase):
         # Checking if sample size 2 is correct
         self.assertEqual(res['control_sample_size'], 65)
 
+    def test__delta_from_statistics(self):
+        """
+        Result of delta_from_statistics() equals the result of delta() on the samples.
+        """
+        x = self.samples.temperature[self.samples.gender == 1]
+        y = self.samples.temperature[self.samples.gender == 2]
+        expected = statx.delta(x, y, percentiles=[2.5, 97.5])
+        res = statx.delta_from_statistics(*(statx.sufficient_statistics(x) + statx.sufficient_statistics(y)))
+        for key in expected:
+            if key == 'confidence_interval':
+                for p in [2.5, 97.5]:
+                    self.assertAlmostEqual(find_list_of_dicts_element(res[key], 'percentile', p, 'value'),
+                                           find_list_of_dicts_element(expected[key], 'percentile', p, 'value'))
+            else:
+                self.assertAlmostEqual(res[key], expected[key])
+
+    def test__delta_from_statistics__min_observations(self):
+        """
+        Result of delta_from_statistics() has no delta for too few observations.
+        """
+        res = statx.delta_from_statistics(10, 1., 5., 30, 0., 20.)
+        self.assertTrue(np.isnan(res['delta']))
+        self.assertEqual(res['treatment_sample_size'], 10)
+        self.assertAlmostEqual(res['treatment_variance'], 0.5)
+
 
 class ChiSquareTestCases(StatisticsTestCase):
     """
@@ -295,6 +320,36 @@ class SampleSizeTestCases(StatisticsTestCase):
         self.assertEqual(statx.sample_size(x), 5)
 
 
+class SufficientStatisticsTestCases(StatisticsTestCase):
+    """
+    Test cases for the sufficient statistics of samples and their merging.
+    """
+
+    def test_sufficient_statistics(self):
+        x = np.array([1.0, 2.0, np.nan, 4.0])
+        n, mean, m2 = statx.sufficient_statistics(x)
+        self.assertEqual(n, 3)
+        self.assertAlmostEqual(mean, 7 / 3.)
+        self.assertAlmostEqual(m2, np.var([1.0, 2.0, 4.0]) * 3)
+
+    def test_sufficient_statistics_empty(self):
+        self.assertEqual(statx.sufficient_statistics([np.nan]), (0, 0., 0.))
+
+    def test_merge_sufficient_statistics(self):
+        merged = statx.merge_sufficient_statistics(statx.sufficient_statistics(self.rand_s1[:300]),
+                                                   statx.sufficient_statistics(self.rand_s1[300:]))
+        np.testing.assert_allclose(merged, statx.sufficient_statistics(self.rand_s1))
+
+    def test_merge_sufficient_statistics_arrays(self):
+        """ Statistics of several samples are merged elementwise, empty samples are neutral. """
+        first = np.array([0, 300]), np.array([0., 0.1]), np.array([0., 250.])
+        second = np.array([5, 0]), np.array([1., 0.]), np.array([4., 0.])
+        n, mean, m2 = statx.merge_sufficient_statistics(first, second)
+        np.testing.assert_array_equal(n, [5, 300])
+        np.testing.assert_allclose(mean, [1., 0.1])
+        np.testing.assert_allclose(m2, [4., 250.])
+
+
 class EstimateSampleSizeTestCases(StatisticsTestCase):
     """
     Test cases for the estimate_sample_size() function in core.statistics.
@@ -539,6 +594,11 @@ class StatisticalPowerTestCases(StatisticsTestCase):
         power = statx._get_power(0, 1, 13, 1, 1, 12, z_1_minus_alpha)
         self.assertAlmostEqual(power, 0.8, 2)
 
+    def test_statistical_power_from_statistics(self):
+        power = statx.statistical_power_from_statistics(*(statx.sufficient_statistics(self.rand_s1) +
+                                                          statx.sufficient_statistics(self.rand_s2)))
+        self.assertAlmostEqual(power, statx.compute_statistical_power(self.rand_s1, self.rand_s2))
+
 
 if __name__ == '__main__':
     unittest.main()
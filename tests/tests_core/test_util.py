@@ -1,3 +1,5 @@
+import shutil
+import tempfile
 import unittest
 
 import numpy as np
@@ -40,6 +42,50 @@ class UtilFunctionsTestCase(unittest.TestCase):
                          {'bla': 5, 'blu': 6}]
         self.assertEqual(util.find_list_of_dicts_element(list_of_dicts, 'bla', 5, 'blu'), 6)
 
+    def test_fingerprint(self):
+        x = np.arange(10000, dtype=float)
+        y = x.copy()
+        y[5000] = -1.0
+        # str() of both arrays is identical due to numpy's truncated repr
+        self.assertEqual(str(x), str(y))
+        self.assertNotEqual(util.fingerprint(x), util.fingerprint(y))
+        self.assertEqual(util.fingerprint(x, 'normal', 100), util.fingerprint(x.copy(), 'normal', 100))
+        self.assertNotEqual(util.fingerprint(x, 'normal'), util.fingerprint(x, 'poisson'))
+
+
+class MemoCacheTestCase(unittest.TestCase):
+    def test_lru_entries(self):
+        cache = util.MemoCache(max_entries=2)
+        cache.put('a', 1)
+        cache.put('b', 2)
+        self.assertEqual(cache.get('a'), 1)
+        cache.put('c', 3)
+        # 'b' is the least recently used entry
+        self.assertTrue('b' not in cache)
+        self.assertEqual(cache.get('b'), None)
+        self.assertEqual(cache.get('c'), 3)
+        self.assertEqual(cache.stats(), {'hits': 2, 'misses': 1, 'entries': 2, 'bytes': cache.stats()['bytes']})
+
+    def test_lru_bytes(self):
+        cache = util.MemoCache(max_entries=None, max_bytes=1000 * 8)
+        cache.put('a', {'delta': np.zeros(600)})
+        cache.put('b', {'delta': np.zeros(600)})
+        self.assertEqual(len(cache), 1)
+        self.assertTrue('b' in cache)
+        self.assertLessEqual(cache.stats()['bytes'], 1000 * 8)
+
+    def test_persistence(self):
+        cache_dir = tempfile.mkdtemp()
+        try:
+            cache = util.MemoCache(cache_dir=cache_dir)
+            cache.put('a', {'delta': np.arange(3.)})
+
+            restored = util.MemoCache(cache_dir=cache_dir)
+            np.testing.assert_array_equal(restored.get('a')['delta'], np.arange(3.))
+            self.assertEqual(restored.stats()['hits'], 1)
+        finally:
+            shutil.rmtree(cache_dir)
+
 
 if __name__ == '__main__':
     unittest.main()
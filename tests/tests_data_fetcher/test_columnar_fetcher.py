@@ -0,0 +1,155 @@
+import unittest
+from os import rmdir, makedirs, getcwd, remove, rename, walk
+from os.path import dirname, join, realpath, exists
+
+import numpy as np
+import pandas as pd
+import simplejson as json
+
+import expan.core.util
+import expan.data.columnar_fetcher as columnar_fetcher
+import expan.data.csv_fetcher as csv_fetcher
+from expan.core.util import find_list_of_dicts_element
+
+try:
+    import pyarrow
+except ImportError:
+    pyarrow = None
+
+__location__ = realpath(join(getcwd(), dirname(__file__)))
+
+CSV_FOLDER = join(__location__, 'test_columnar_csv_folder')
+TEST_FOLDER = join(__location__, 'test_columnar_folder')
+
+
+class ColumnarFetcherTestCase(unittest.TestCase):
+    def setUp(self):
+
+        # create test folder
+        if not exists(CSV_FOLDER):
+            makedirs(CSV_FOLDER)
+
+        # generate metrics and metadata
+        (metrics, metadata) = expan.core.util.generate_random_data()
+        metrics.loc[::10, 'feature'] = np.nan
+        self.metrics = metrics
+
+        # save metrics to .csv.gz file and metadata to .json file in test folder
+        metrics.to_csv(path_or_buf=join(CSV_FOLDER, 'metrics.csv.gz'), compression='gzip', index=False)
+        with open(join(CSV_FOLDER, 'metadata.json'), 'w') as f:
+            json.dump(metadata, f)
+
+        self.kpis = ['normal_same', 'derived']
+        self.derived_kpis = [{'name': 'derived', 'formula': 'normal_shifted/treatment_start_time'}]
+
+    def tearDown(self):
+
+        # remove all test files and test folders
+        for folder in [CSV_FOLDER, TEST_FOLDER]:
+            if not exists(folder):
+                continue
+            for root, dirs, files in walk(folder, topdown=False):
+                for name in files:
+                    remove(join(root, name))
+                for name in dirs:
+                    rmdir(join(root, name))
+            rmdir(folder)
+
+    def assertSameAsCsv(self, experiment):
+        expected = csv_fetcher.get_data('B', CSV_FOLDER, self.kpis, self.derived_kpis, features=['feature'])
+        self.assertEqual(experiment.data.shape, expected.data.shape)
+        self.assertEqual(list(experiment.data.feature.isnull()), list(expected.data.feature.isnull()))
+        result = experiment.delta()
+        expected_result = expected.delta()
+        for kpi in self.kpis:
+            self.assertEqual(find_list_of_dicts_element(result['kpis'], 'name', kpi, 'variants'),
+                             find_list_of_dicts_element(expected_result['kpis'], 'name', kpi, 'variants'))
+
+    def test_npy_columns(self):
+        metrics_path = columnar_fetcher.convert(CSV_FOLDER, TEST_FOLDER)
+        self.assertTrue(exists(join(metrics_path, 'normal_same.npy')))
+        self.assertTrue(exists(join(metrics_path, 'variant.categories.json')))
+
+        experiment = columnar_fetcher.get_data('B', TEST_FOLDER, self.kpis, self.derived_kpis, features=['feature'])
+        self.assertEqual(set(experiment.data.columns), set(['entity', 'variant', 'normal_same', 'normal_shifted',
+                                                            'treatment_start_time', 'feature', 'derived']))
+        self.assertEqual(experiment.data.variant.dtype.name, 'category')
+        # the kpis are views on the memory-mapped files
+        self.assertIsInstance(experiment.data.normal_same.values.base, np.memmap)
+        self.assertSameAsCsv(experiment)
+
+        experiment = columnar_fetcher.get_data('B', TEST_FOLDER, self.kpis, self.derived_kpis, features=['feature'],
+                                               memory_map=False)
+        self.assertNotIsInstance(experiment.data.normal_same.values.base, np.memmap)
+        self.assertSameAsCsv(experiment)
+
+        # all columns are read without report kpis
+        experiment = columnar_fetcher.get_data('B', TEST_FOLDER)
+        self.assertEqual(len(experiment.data.columns), 9)
+
+        with self.assertRaises(ValueError):
+            columnar_fetcher.get_data('B', TEST_FOLDER, ['not_a_kpi'])
+
+    @unittest.skipIf(pyarrow is None, 'pyarrow is not installed')
+    def test_parquet_and_feather(self):
+        for metrics_format in ['parquet', 'feather']:
+            columnar_fetcher.convert(CSV_FOLDER, join(TEST_FOLDER, metrics_format), metrics_format)
+            experiment = columnar_fetcher.get_data('B', join(TEST_FOLDER, metrics_format), self.kpis,
+                                                   self.derived_kpis, features=['feature'])
+            self.assertSameAsCsv(experiment)
+
+    def test_convert(self):
+        with self.assertRaises(ValueError):
+            columnar_fetcher.convert(CSV_FOLDER, TEST_FOLDER, 'hdf5')
+        with self.assertRaises(AssertionError):
+            columnar_fetcher.convert(join(__location__, '..'), TEST_FOLDER)
+        with self.assertRaises(AssertionError):
+            columnar_fetcher.get_data('B', join(__location__, '..'))
+
+        columnar_fetcher.convert(CSV_FOLDER, TEST_FOLDER, chunksize=1000)
+        self.assertSameAsCsv(columnar_fetcher.get_data('B', TEST_FOLDER, self.kpis, self.derived_kpis,
+                                                       features=['feature']))
+
+    def test_shards(self):
+        shard_folder = join(CSV_FOLDER, 'shards')
+        makedirs(shard_folder)
+        metrics = self.metrics
+        for part, rows in zip([2, 10], [slice(0, 5000), slice(5000, None)]):
+            metrics.iloc[rows].to_csv(join(shard_folder, 'metrics-part-{}.csv.gz'.format(part)),
+                                      compression='gzip', index=False)
+        with open(join(shard_folder, 'metadata.json'), 'w') as f:
+            json.dump(json.load(open(join(CSV_FOLDER, 'metadata.json'))), f)
+
+        # all shards are converted into one metrics folder, with or without chunks
+        for chunksize in [None, 777]:
+            output_path = join(TEST_FOLDER, str(chunksize))
+            columnar_fetcher.convert(shard_folder, output_path, chunksize=chunksize)
+            experiment = columnar_fetcher.get_data('B', output_path, self.kpis, self.derived_kpis,
+                                                   features=['feature'])
+            self.assertEqual(list(experiment.data.entity), list(metrics.entity))
+            self.assertSameAsCsv(experiment)
+
+        # shards of .npy columns are concatenated
+        columnar_folder = join(TEST_FOLDER, 'shards')
+        makedirs(columnar_folder)
+        parsed = pd.read_csv(join(CSV_FOLDER, 'metrics.csv.gz'))
+        for part, rows in zip([2, 10], [slice(0, 5000), slice(5000, None)]):
+            columnar_fetcher._write_npy_columns(parsed.iloc[rows],
+                                                join(columnar_folder, 'metrics-part-{}'.format(part)))
+        rename(join(TEST_FOLDER, 'None', 'metadata.json'), join(columnar_folder, 'metadata.json'))
+        experiment = columnar_fetcher.get_data('B', columnar_folder, self.kpis, self.derived_kpis,
+                                               features=['feature'])
+        self.assertEqual(list(experiment.data.entity), list(metrics.entity))
+        self.assertSameAsCsv(experiment)
+
+        # entities need to be unique across shards
+        metrics.iloc[:10].to_csv(join(shard_folder, 'metrics-part-11.csv.gz'), compression='gzip', index=False)
+        for chunksize in [None, 777]:
+            with self.assertRaises(ValueError):
+                columnar_fetcher.convert(shard_folder, join(TEST_FOLDER, 'duplicates'), chunksize=chunksize)
+        columnar_fetcher._write_npy_columns(parsed.iloc[:10], join(columnar_folder, 'metrics-part-11'))
+        with self.assertRaises(ValueError):
+            columnar_fetcher.get_data('B', columnar_folder)
+
+        with self.assertRaises(ValueError):
+            columnar_fetcher.convert(shard_folder, TEST_FOLDER, 'parquet', chunksize=1000)
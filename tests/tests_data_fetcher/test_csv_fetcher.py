@@ -2,9 +2,11 @@ import unittest
 from os import rmdir, makedirs, getcwd, remove, walk
 from os.path import dirname, join, realpath, exists
 
+import numpy as np
 import simplejson as json
 
 import expan.core.util
+from expan.core.util import find_list_of_dicts_element
 import expan.data.csv_fetcher as csv_fetcher
 
 __location__ = realpath(join(getcwd(), dirname(__file__)))
@@ -46,3 +48,81 @@ class CsvFetcherTestCase(unittest.TestCase):
         # should not work:
         with self.assertRaises(AssertionError):
             csv_fetcher.get_data('B', join(__location__, '..'))
+
+    def test_csv_fetcher_typed_columns(self):
+        experiment = csv_fetcher.get_data('B', TEST_FOLDER, ['normal_same', 'derived'],
+                                          [{'name': 'derived', 'formula': 'normal_shifted/treatment_start_time'}],
+                                          features=['feature'], dtypes={'normal_same': 'float32'})
+        self.assertEqual(set(experiment.data.columns), set(['entity', 'variant', 'normal_same', 'normal_shifted',
+                                                            'treatment_start_time', 'feature', 'derived']))
+        self.assertEqual(experiment.data.variant.dtype.name, 'category')
+        self.assertEqual(experiment.data.normal_same.dtype, np.float32)
+        self.assertEqual(experiment.data.treatment_start_time.dtype, np.int8)
+        self.assertEqual(experiment.data.entity.dtype, np.int16)
+
+        expected = csv_fetcher.get_data('B', TEST_FOLDER, ['derived'], experiment.derived_kpis, downcast=False)
+        self.assertEqual(expected.data.entity.dtype, np.int64)
+        self.assertEqual(find_list_of_dicts_element(experiment.delta()['kpis'], 'name', 'derived', 'variants'),
+                         find_list_of_dicts_element(expected.delta()['kpis'], 'name', 'derived', 'variants'))
+
+    def test_csv_fetcher_dtypes_from_metadata(self):
+        with open(join(TEST_FOLDER, 'metadata.json'), 'r') as f:
+            metadata = json.load(f)
+        metadata['dtypes'] = {'entity': 'str', 'variant': 'object'}
+        with open(join(TEST_FOLDER, 'metadata.json'), 'w') as f:
+            json.dump(metadata, f)
+
+        experiment = csv_fetcher.get_data('B', TEST_FOLDER, ['normal_same'])
+        self.assertEqual(experiment.data.entity.dtype, object)
+        self.assertEqual(experiment.data.variant.dtype, object)
+
+    def test_csv_fetcher_streaming(self):
+        experiment = csv_fetcher.get_data('B', TEST_FOLDER)
+        aggregated = csv_fetcher.get_data_streaming('B', TEST_FOLDER, chunksize=1000)
+        self.assertEqual(aggregated.report_kpi_names, experiment.report_kpi_names)
+        self.assertEqual(int(aggregated.statistics[0]['rows'].sum()), len(experiment.data))
+
+        result = aggregated.delta()
+        expected = experiment.delta()
+        for kpi, expected_kpi in zip(sorted(result['kpis'], key=lambda kpi: kpi['name']),
+                                     sorted(expected['kpis'], key=lambda kpi: kpi['name'])):
+            for variant in kpi['variants']:
+                expected_delta = [v['delta_statistics']['delta'] for v in expected_kpi['variants']
+                                  if v['name'] == variant['name']][0]
+                self.assertAlmostEqual(variant['delta_statistics']['delta'], expected_delta)
+
+        with self.assertRaises(AssertionError):
+            csv_fetcher.get_data_streaming('B', join(__location__, '..'))
+
+    def test_csv_fetcher_shards(self):
+        shard_folder = join(TEST_FOLDER, 'shards')
+        makedirs(shard_folder)
+        (metrics, metadata) = expan.core.util.generate_random_data()
+        # part-10 should come after part-2
+        for part, rows in zip([0, 2, 10], [slice(0, 3000), slice(3000, 7000), slice(7000, None)]):
+            metrics.iloc[rows].to_csv(join(shard_folder, 'metrics-part-{}.csv.gz'.format(part)),
+                                      compression='gzip', index=False)
+        with open(join(shard_folder, 'metadata.json'), 'w') as f:
+            json.dump(metadata, f)
+
+        experiment = csv_fetcher.get_data('B', shard_folder, ['normal_same'], processes=2)
+        self.assertEqual(list(experiment.data.entity), list(metrics.entity))
+        self.assertEqual(experiment.data.variant.dtype.name, 'category')
+
+        aggregated = csv_fetcher.get_data_streaming('B', shard_folder, chunksize=1000, report_kpi_names=['normal_same'],
+                                                    processes=2)
+        self.assertEqual(int(aggregated.statistics[0]['rows'].sum()), len(metrics))
+        self.assertAlmostEqual(aggregated.delta()['kpis'][0]['variants'][0]['delta_statistics']['delta'],
+                               experiment.delta()['kpis'][0]['variants'][0]['delta_statistics']['delta'])
+
+        # entities need to be unique across shards
+        metrics.iloc[:10].to_csv(join(shard_folder, 'metrics-part-11.csv.gz'), compression='gzip', index=False)
+        with self.assertRaises(ValueError):
+            csv_fetcher.get_data('B', shard_folder, ['normal_same'], processes=1)
+        with self.assertRaises(ValueError):
+            csv_fetcher.get_data_streaming('B', shard_folder, report_kpi_names=['normal_same'], processes=1)
+
+    def test_sorted_metrics_files(self):
+        self.assertEqual(csv_fetcher.sorted_metrics_files(['metrics-part-10.csv', 'metadata.json',
+                                                           'metrics-part-2.csv', 'metrics-part-1.csv']),
+                         ['metrics-part-1.csv', 'metrics-part-2.csv', 'metrics-part-10.csv'])
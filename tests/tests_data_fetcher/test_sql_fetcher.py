@@ -0,0 +1,105 @@
+import sqlite3
+import unittest
+
+import numpy as np
+
+import expan.core.util
+import expan.data.sql_fetcher as sql_fetcher
+from expan.core.binning import Bin, create_bins
+from expan.core.experiment import Experiment
+from expan.core.util import find_list_of_dicts_element
+
+
+class SqlFetcherTestCase(unittest.TestCase):
+    def setUp(self):
+        np.random.seed(0)
+        (metrics, metadata) = expan.core.util.generate_random_data()
+        metrics['orders'] = np.random.randint(0, 5, len(metrics))
+        metrics.loc[::37, 'normal_shifted'] = np.nan
+        metrics.loc[::53, 'feature'] = np.nan
+
+        self.connection = sqlite3.connect(':memory:')
+        metrics.to_sql('metrics', self.connection, index=False)
+
+        self.metrics, self.metadata = metrics, metadata
+        self.kpis = ['normal_same', 'normal_shifted', 'ratio']
+        self.derived_kpis = [{'name': 'ratio', 'formula': 'normal_shifted/orders'}]
+        self.experiment = Experiment('B', metrics, metadata, self.kpis, self.derived_kpis)
+
+    def tearDown(self):
+        self.connection.close()
+
+    def assertResultsAlmostEqual(self, result, expected):
+        self.assertEqual(result['warnings'], expected['warnings'])
+        for expected_kpi in expected['kpis']:
+            kpi = find_list_of_dicts_element(result['kpis'], 'name', expected_kpi['name'], 'variants')
+            for expected_variant in expected_kpi['variants']:
+                statistics = find_list_of_dicts_element(kpi, 'name', expected_variant['name'], 'delta_statistics')
+                expected_statistics = expected_variant['delta_statistics']
+                self.assertEqual(set(statistics), set(expected_statistics))
+                for key in expected_statistics:
+                    if key == 'confidence_interval':
+                        for interval, expected_interval in zip(statistics[key], expected_statistics[key]):
+                            self.assertAlmostEqual(interval['value'], expected_interval['value'])
+                    else:
+                        self.assertAlmostEqual(statistics[key], expected_statistics[key])
+
+    def test_sql_fetcher(self):
+        aggregated = sql_fetcher.get_data('B', self.connection, 'metrics', self.metadata, self.kpis, self.derived_kpis)
+        self.assertEqual(aggregated.variant_names, set(['A', 'B']))
+        self.assertResultsAlmostEqual(aggregated.delta(), self.experiment.delta())
+        self.assertResultsAlmostEqual(aggregated.delta('group_sequential', estimated_sample_size=20000),
+                                      self.experiment.delta('group_sequential', estimated_sample_size=20000))
+
+        with self.assertRaises(ValueError):
+            sql_fetcher.get_data('B', self.connection, 'metrics', self.metadata, [])
+
+    def test_sql_fetcher_where(self):
+        aggregated = sql_fetcher.get_data('B', self.connection, 'metrics', self.metadata, ['normal_same'],
+                                          where="feature = 'has'")
+        expected = Experiment('B', self.metrics[self.metrics.feature == 'has'], self.metadata, ['normal_same'])
+        self.assertResultsAlmostEqual(aggregated.delta(), expected.delta())
+
+    def test_sql_fetcher_sga(self):
+        feature_name_to_bins = {
+            'feature': create_bins(self.metrics.feature, 3),
+            'normal_shifted': [Bin('numerical', -np.inf, 0, False, True), Bin('numerical', 0, np.inf, False, False)],
+            ('normal_same', 'orders'): [create_bins(self.metrics.normal_same, 3), create_bins(self.metrics.orders, 2)]
+        }
+        aggregated = sql_fetcher.get_data('B', self.connection, 'metrics', self.metadata, self.kpis,
+                                          self.derived_kpis, feature_name_to_bins)
+        sga_result = aggregated.sga(include_invalid=True)
+        expected = self.experiment.sga(feature_name_to_bins, include_invalid=True)
+        self.assertEqual(len(sga_result), len(expected))
+        for expected_res in expected:
+            res = [r for r in sga_result
+                   if r['dimension'] == expected_res['dimension'] and r['segment'] == expected_res['segment']][0]
+            self.assertEqual(res['validity'], expected_res['validity'])
+            if 'result' in expected_res:
+                self.assertResultsAlmostEqual(res['result'], expected_res['result'])
+
+    def test_row_fallback(self):
+        aggregated = sql_fetcher.get_data('B', self.connection, 'metrics', self.metadata, self.kpis, self.derived_kpis)
+        result = aggregated.delta(assume_normal=False, nruns=100)
+        self.assertEqual(len(result['kpis']), 3)
+        self.assertEqual(len(aggregated._experiment.data), len(self.metrics))
+        self.assertEqual(set(aggregated._experiment.data.columns),
+                         set(['entity', 'variant', 'normal_same', 'normal_shifted', 'orders', 'ratio']))
+
+        experiment = sql_fetcher.get_rows('B', self.connection, 'metrics', self.metadata, self.kpis, self.derived_kpis)
+        self.assertEqual(int(experiment.data.normal_shifted.isnull().sum()),
+                         int(self.metrics.normal_shifted.isnull().sum()))
+
+    def test_bin_condition(self):
+        self.assertEqual(sql_fetcher.bin_condition('x', Bin('numerical', 0, 1, True, False)),
+                         '"x" >= 0.0 AND "x" < 1.0')
+        self.assertEqual(sql_fetcher.bin_condition('x', Bin('numerical', -np.inf, np.inf, False, False)),
+                         '"x" IS NOT NULL')
+        self.assertEqual(sql_fetcher.bin_condition('x', Bin('numerical', np.nan, np.nan, True, True)),
+                         '"x" IS NULL')
+        self.assertEqual(sql_fetcher.bin_condition('x', Bin('categorical', ["it's", np.nan])),
+                         '"x" IS NULL OR "x" IN (\'it\'\'s\')')
+
+
+if __name__ == '__main__':
+    unittest.main()